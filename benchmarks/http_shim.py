@@ -0,0 +1,121 @@
+"""
+Multi-worker HTTP shim that serves ``src.main.main`` locally, for load
+tests on one Linux box.
+
+    python -m benchmarks.http_shim --port 8080 --workers 4 --threads 8
+
+The listening socket is opened once and shared by ``--workers`` forked
+processes (pre-fork, like gunicorn's sync workers); each handles up to
+``--threads`` requests at a time with HTTP/1.1 keep-alive. Requests are
+turned into a stand-in Appwrite context (src/context.py).
+
+``GET /__server/status`` (src.context.STATUS_PATH, as on src/server.py)
+answers from whichever worker gets it with the PID, current RSS and peak
+RSS of every worker.
+"""
+import argparse
+import json
+import os
+import signal
+import socketserver
+import sys
+import threading
+from http.server import HTTPServer
+
+from src.context import LocalContext, LocalHandler, LocalRequest
+from src.metrics import process_memory_mb
+
+class _Handler(LocalHandler):
+    server_version = 'resi-merger-shim'
+
+    def status(self):
+        return worker_stats()
+
+    def call(self, method, url, headers, body):
+        from src.main import main
+
+        return main(LocalContext(LocalRequest(method, url, headers, body), log_stream=self.server.log_stream))
+
+class _Server(socketserver.ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address, threads, log_stream):
+        super().__init__(address, _Handler)
+        self.slots = threading.BoundedSemaphore(threads)
+        self.log_stream = log_stream
+
+    def process_request(self, request, client_address):
+        # At most ``threads`` connections handled at once per worker
+        self.slots.acquire()
+        super().process_request(request, client_address)
+
+    def shutdown_request(self, request):
+        super().shutdown_request(request)
+        self.slots.release()
+
+def worker_stats():
+    """
+    RSS and peak RSS in MB of every worker, the siblings of this process
+    """
+    parent = os.getppid()
+    try:
+        with open(f'/proc/{parent}/task/{parent}/children') as f:
+            pids = [int(pid) for pid in f.read().split()]
+    except OSError:
+        pids = [os.getpid()]
+    workers = []
+    for pid in sorted(pids):
+        memory = process_memory_mb(pid)
+        if memory is not None:
+            workers.append(dict({'pid': pid}, **memory))
+    return {'workers': workers}
+
+def serve(host='127.0.0.1', port=8080, workers=2, threads=8, quiet=True):
+    """
+    Fork ``workers`` processes serving main on one shared socket and wait
+    for them; SIGINT or SIGTERM stops them all
+    """
+    log_stream = None if quiet else sys.stderr
+    server = _Server((host, port), threads, log_stream)
+    children = []
+    for _ in range(workers):
+        pid = os.fork()
+        if pid == 0:
+            signal.signal(signal.SIGTERM, lambda *_: os._exit(0))
+            try:
+                server.serve_forever()
+            finally:
+                os._exit(0)
+        children.append(pid)
+
+    def stop(*_):
+        for child in children:
+            try:
+                os.kill(child, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    signal.signal(signal.SIGTERM, stop)
+    print(json.dumps({'listening': f'http://{host}:{server.server_address[1]}', 'workers': children}), flush=True)
+    try:
+        for child in children:
+            os.waitpid(child, 0)
+    except KeyboardInterrupt:
+        stop()
+    finally:
+        server.server_close()
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Serve src.main over HTTP with several worker processes')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--workers', type=int, default=2)
+    parser.add_argument('--threads', type=int, default=8, help='concurrent requests per worker')
+    parser.add_argument('--verbose', action='store_true', help='print the function logs')
+    args = parser.parse_args(argv)
+    serve(args.host, args.port, args.workers, args.threads, quiet=not args.verbose)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
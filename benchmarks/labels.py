@@ -0,0 +1,154 @@
+"""
+Synthetic shipping labels for the benchmarks, generated with reportlab so
+no real customer data is needed.
+
+Variants:
+    vector   label drawn as PDF text and vector barcode (marketplace exports)
+    dense    vector label plus a packing list in small print filling the page
+    scanned  the label as a noisy, slightly rotated 200 DPI image (phone scans)
+"""
+import random
+from io import BytesIO
+
+COURIERS = ('JNE', 'J&T', 'SiCepat', 'AnterAja', 'Ninja', 'POS')
+VARIANTS = ('vector', 'dense', 'scanned')
+
+# Resolution of the scanned variant's page image
+SCAN_DPI = 200
+
+def make_label_pdf(seed=0, pages=1, variant='vector'):
+    """
+    PDF bytes of a label sheet with ``pages`` pages of one of VARIANTS.
+    Each page carries a label in the top-left region the default crop
+    preset cuts out: a Code 128 barcode, courier name, addresses and a few
+    lines of text. The same arguments always give the same document.
+    """
+    from reportlab.lib.pagesizes import A4
+    from reportlab.pdfgen import canvas
+
+    if variant not in VARIANTS:
+        raise ValueError(f"Unknown label variant: {variant}")
+
+    rng = random.Random(f'{variant}-{seed}')
+    buffer = BytesIO()
+    c = canvas.Canvas(buffer, pagesize=A4, invariant=1)
+    for page in range(pages):
+        fields = _label_fields(rng, page, pages)
+        if variant == 'scanned':
+            _draw_scanned_page(c, fields, rng)
+        else:
+            _draw_vector_page(c, fields, rng, dense=variant == 'dense')
+        c.showPage()
+    c.save()
+    return buffer.getvalue()
+
+def make_corpus(count, pages=1, variant='vector', seed=0, distinct=None):
+    """
+    ``count`` label PDFs, see make_label_pdf. With ``distinct`` only that
+    many different documents are generated and repeated, which keeps large
+    scanned batches quick to build.
+    """
+    documents = [make_label_pdf(seed + number, pages, variant) for number in range(min(count, distinct or count))]
+    return [documents[number % len(documents)] for number in range(count)]
+
+def _label_fields(rng, page, pages):
+    def words(low, high):
+        return ' '.join(
+            ''.join(rng.choice('abcdefghijklmnopqrstuvwxyz') for _ in range(rng.randint(3, 9)))
+            for _ in range(rng.randint(low, high))
+        )
+
+    return {
+        'courier': rng.choice(COURIERS),
+        'tracking': ''.join(rng.choice('0123456789') for _ in range(12)),
+        'page': f'Page {page + 1}/{pages}',
+        'addresses': [('Penerima', [words(3, 6) for _ in range(4)]), ('Pengirim', [words(3, 6) for _ in range(4)])],
+        'items': [f'item {line + 1} {words(1, 3)} x{rng.randint(1, 9)}' for line in range(30)],
+    }
+
+def _draw_vector_page(c, fields, rng, dense=False):
+    from reportlab.graphics.barcode.code128 import Code128
+    from reportlab.lib.pagesizes import A4
+
+    width, height = A4
+    left, top = 24, height - 24
+    label_width = width * 0.5 - 36
+
+    c.setLineWidth(1.5)
+    c.rect(left, height * 0.3, label_width, top - height * 0.3)
+    c.setFont('Helvetica-Bold', 18)
+    c.drawString(left + 10, top - 30, fields['courier'])
+    c.setFont('Helvetica', 9)
+    c.drawRightString(left + label_width - 10, top - 28, fields['page'])
+
+    Code128(fields['tracking'], barHeight=48, barWidth=1.1).drawOn(c, left + 10, top - 100)
+    c.setFont('Courier-Bold', 12)
+    c.drawString(left + 20, top - 116, fields['tracking'])
+
+    y = top - 145
+    for heading, lines in fields['addresses']:
+        c.setFont('Helvetica-Bold', 10)
+        c.drawString(left + 10, y, heading)
+        c.setFont('Helvetica', 9)
+        for line in lines:
+            y -= 13
+            c.drawString(left + 10, y, line)
+        y -= 20
+
+    # Content outside the receipt region, like an invoice beside the label
+    c.setFont('Helvetica', 8)
+    for number, line in enumerate(fields['items']):
+        c.drawString(width * 0.55, height - 40 - number * 12, line)
+
+    if dense:
+        # Packing list in small print under the label and the invoice
+        c.setFont('Helvetica', 5)
+        for row in range(int(height * 0.28 / 6)):
+            c.drawString(24, 24 + row * 6, ' '.join(fields['items'][(row + k) % 30] for k in range(6)))
+
+def _draw_scanned_page(c, fields, rng):
+    import numpy as np
+    from PIL import Image, ImageDraw, ImageFilter
+    from reportlab.lib.pagesizes import A4
+    from reportlab.lib.utils import ImageReader
+
+    width, height = A4
+    size = (round(width / 72 * SCAN_DPI), round(height / 72 * SCAN_DPI))
+    scale = SCAN_DPI / 72
+    image = Image.new('L', size, 246)
+    draw = ImageDraw.Draw(image)
+
+    left, top = int(24 * scale), int(24 * scale)
+    right, bottom = int((width * 0.5 - 12) * scale), int(height * 0.7 * scale)
+    draw.rectangle((left, top, right, bottom), outline=20, width=4)
+    draw.text((left + 30, top + 30), fields['courier'], fill=10)
+    draw.text((right - 120, top + 30), fields['page'], fill=10)
+
+    # Code 128 look-alike: random bar widths across the barcode area
+    x = left + 30
+    while x < right - 60:
+        bar = rng.choice((3, 3, 6, 9))
+        if rng.random() < 0.55:
+            draw.rectangle((x, top + 90, x + bar - 1, top + 230), fill=15)
+        x += bar
+    draw.text((left + 50, top + 245), fields['tracking'], fill=10)
+
+    y = top + 300
+    for heading, lines in fields['addresses']:
+        draw.text((left + 30, y), heading, fill=10)
+        for line in lines:
+            y += 36
+            draw.text((left + 30, y), line, fill=30)
+        y += 60
+    for number, line in enumerate(fields['items']):
+        draw.text((int(width * 0.55 * scale), int((40 + number * 12) * scale)), line, fill=40)
+
+    # Scanner look: slight skew, blur and speckle noise
+    image = image.rotate(rng.uniform(-1.5, 1.5), fillcolor=246).filter(ImageFilter.GaussianBlur(0.8))
+    noise = np.random.default_rng(rng.randrange(2 ** 32)).normal(0, 4, (size[1], size[0]))
+    image = Image.fromarray(np.clip(np.asarray(image, dtype=np.float32) + noise, 0, 255).astype(np.uint8), 'L')
+
+    jpeg = BytesIO()
+    image.save(jpeg, 'JPEG', quality=75)
+    jpeg.seek(0)
+    c.drawImage(ImageReader(jpeg), 0, 0, width=width, height=height)
@@ -0,0 +1,261 @@
+"""
+Concurrent load generator for the HTTP shim (benchmarks/http_shim.py) or
+the self-hosted server (src/server.py).
+
+    python -m benchmarks.loadtest --spawn-shim --workers 4 --concurrency 8 --duration 30
+    python -m benchmarks.loadtest --url http://127.0.0.1:8080/ --requests 500 \\
+        --mix small=60,large=10,binary=20,invalid=10
+
+``--concurrency`` client threads each keep one HTTP/1.1 connection open
+and send requests drawn from the payload mix until ``--requests`` are sent
+or ``--duration`` seconds pass. Payload kinds:
+
+    small    JSON body, 3 base64 labels
+    large    JSON body, 30 base64 labels (5 pages each for half of them)
+    scanned  JSON body, 3 scanned labels
+    binary   raw application/pdf upload of one 4-page label sheet
+    invalid  JSON body with bad base64, answered with 400
+
+Prints one JSON report: throughput, p50/p95/p99 latency overall and per
+kind, errors (5xx, connection failures and unexpected statuses) and
+current and peak RSS of every worker before and after the run, from the
+status endpoint both servers answer. The result and render caches are
+bypassed unless ``--cache`` is given, so every request merges.
+"""
+import argparse
+import base64
+import http.client
+import json
+import os
+import random
+import subprocess
+import sys
+import threading
+import time
+from urllib.parse import urlsplit
+
+from benchmarks.labels import make_corpus, make_label_pdf
+from src.context import STATUS_PATH
+
+DEFAULT_MIX = 'small=70,large=10,binary=10,invalid=10'
+# Status a well-behaved server answers each kind with
+EXPECTED_STATUS = {'small': 200, 'large': 200, 'scanned': 200, 'binary': 200, 'invalid': 400}
+
+def parse_mix(text):
+    """
+    ``kind=weight,...`` -> dict, kinds from EXPECTED_STATUS
+    """
+    mix = {}
+    for part in text.split(','):
+        if not part.strip():
+            continue
+        kind, _, weight = part.partition('=')
+        kind = kind.strip()
+        if kind not in EXPECTED_STATUS:
+            raise ValueError(f"Unknown payload kind: {kind}")
+        mix[kind] = float(weight or 1)
+    if not mix or sum(mix.values()) <= 0:
+        raise ValueError('Payload mix is empty')
+    return mix
+
+def build_payloads(cache=False):
+    """
+    Kind -> ``(path, headers, body)`` of one prepared request each
+    """
+    def merge_request(files):
+        body = {'files': [{'content': base64.b64encode(data).decode()} for data in files]}
+        if not cache:
+            body.update(cache=False, result_cache=False)
+        return '/', {'Content-Type': 'application/json'}, json.dumps(body).encode()
+
+    large = make_corpus(15, distinct=5) + make_corpus(15, pages=5, seed=100, distinct=5)
+    invalid = {'files': [{'content': 'not base64!'}]}
+    return {
+        'small': merge_request(make_corpus(3)),
+        'large': merge_request(large),
+        'scanned': merge_request(make_corpus(3, variant='scanned')),
+        'binary': (
+            '/?cache=0&result_cache=0' if not cache else '/',
+            {'Content-Type': 'application/pdf', 'Accept': 'application/pdf'},
+            make_label_pdf(7, pages=4),
+        ),
+        'invalid': ('/', {'Content-Type': 'application/json'}, json.dumps(invalid).encode()),
+    }
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return None
+    return sorted_values[min(len(sorted_values) - 1, int(fraction * len(sorted_values)))]
+
+def summarize(latencies):
+    values = sorted(latencies)
+    return {
+        'count': len(values),
+        'p50_ms': _ms(percentile(values, 0.50)),
+        'p95_ms': _ms(percentile(values, 0.95)),
+        'p99_ms': _ms(percentile(values, 0.99)),
+        'max_ms': _ms(values[-1] if values else None),
+    }
+
+def _ms(seconds):
+    return None if seconds is None else round(seconds * 1000, 1)
+
+def fetch_worker_stats(url):
+    parts = urlsplit(url)
+    connection = http.client.HTTPConnection(parts.hostname, parts.port or 80, timeout=10)
+    try:
+        connection.request('GET', STATUS_PATH)
+        response = connection.getresponse()
+        body = response.read()
+        return json.loads(body)['workers'] if response.status == 200 else None
+    except (OSError, ValueError):
+        return None
+    finally:
+        connection.close()
+
+def run_load(url, payloads, mix, concurrency=4, requests=None, duration=None, timeout=120, seed=0):
+    """
+    Drive the server at ``url`` and return ``(results, wall_seconds)``,
+    results being ``(kind, status, seconds)`` with status None for
+    connection errors
+    """
+    parts = urlsplit(url)
+    prefix = parts.path.rstrip('/')
+    kinds, weights = list(mix), list(mix.values())
+    results = []
+    lock = threading.Lock()
+    sent = [0]
+    deadline = time.monotonic() + duration if duration else None
+
+    def next_request(rng):
+        with lock:
+            if requests is not None and sent[0] >= requests:
+                return None
+            sent[0] += 1
+        if deadline is not None and time.monotonic() >= deadline:
+            return None
+        return rng.choices(kinds, weights)[0]
+
+    def client(number):
+        rng = random.Random(f'{seed}-{number}')
+        connection = None
+        while True:
+            kind = next_request(rng)
+            if kind is None:
+                break
+            path, headers, body = payloads[kind]
+            started = time.perf_counter()
+            try:
+                if connection is None:
+                    connection = http.client.HTTPConnection(parts.hostname, parts.port or 80, timeout=timeout)
+                connection.request('POST', prefix + path, body=body, headers=headers)
+                response = connection.getresponse()
+                response.read()
+                status = response.status
+                if response.will_close:
+                    connection.close()
+                    connection = None
+            except (OSError, http.client.HTTPException):
+                status = None
+                if connection is not None:
+                    connection.close()
+                connection = None
+            with lock:
+                results.append((kind, status, time.perf_counter() - started))
+        if connection is not None:
+            connection.close()
+
+    threads = [threading.Thread(target=client, args=(number,)) for number in range(concurrency)]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results, time.perf_counter() - started
+
+def report(results, wall_seconds, workers_before=None, workers_after=None):
+    errors = {}
+    by_kind = {}
+    for kind, status, seconds in results:
+        by_kind.setdefault(kind, []).append(seconds)
+        if status is None or status >= 500 or status != EXPECTED_STATUS[kind]:
+            key = f'{kind}:{status or "connection"}'
+            errors[key] = errors.get(key, 0) + 1
+    return {
+        'requests': len(results),
+        'seconds': round(wall_seconds, 2),
+        'requests_per_second': round(len(results) / wall_seconds, 2) if wall_seconds else None,
+        'errors': sum(errors.values()),
+        'error_rate': round(sum(errors.values()) / len(results), 4) if results else None,
+        'errors_by_kind': errors,
+        'latency': summarize([seconds for _, _, seconds in results]),
+        'latency_by_kind': {kind: summarize(values) for kind, values in sorted(by_kind.items())},
+        'workers_before': workers_before,
+        'workers_after': workers_after,
+    }
+
+def spawn_shim(port, workers, threads):
+    """
+    Start the shim in a child process and wait until it listens
+    """
+    shim = subprocess.Popen(
+        [sys.executable, '-m', 'benchmarks.http_shim', '--port', str(port),
+         '--workers', str(workers), '--threads', str(threads)],
+        cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+        stdout=subprocess.PIPE, text=True,
+    )
+    line = shim.stdout.readline()
+    if not line:
+        raise RuntimeError('HTTP shim exited before listening')
+    return shim, json.loads(line)['listening'] + '/'
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Load test the merge function through the HTTP shim')
+    parser.add_argument('--url', default='http://127.0.0.1:8080/')
+    parser.add_argument('--concurrency', type=int, default=4, help='client threads, one connection each')
+    parser.add_argument('--requests', type=int, default=None, help='total requests (default 200 without --duration)')
+    parser.add_argument('--duration', type=float, default=None, help='seconds to keep sending')
+    parser.add_argument('--mix', default=DEFAULT_MIX, help=f'payload kind weights (default {DEFAULT_MIX})')
+    parser.add_argument('--warmup', type=int, default=None, help='unmeasured requests first (default: one per client)')
+    parser.add_argument('--cache', action='store_true', help='let the render and result caches answer')
+    parser.add_argument('--timeout', type=float, default=120)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--spawn-shim', action='store_true', help='start benchmarks.http_shim for the run')
+    parser.add_argument('--port', type=int, default=8080, help='port of the spawned shim (0 picks one)')
+    parser.add_argument('--workers', type=int, default=2, help='workers of the spawned shim')
+    parser.add_argument('--threads', type=int, default=8, help='threads per worker of the spawned shim')
+    args = parser.parse_args(argv)
+
+    try:
+        mix = parse_mix(args.mix)
+    except ValueError as e:
+        parser.error(str(e))
+    if args.requests is None and args.duration is None:
+        args.requests = 200
+
+    payloads = build_payloads(cache=args.cache)
+    shim = None
+    url = args.url
+    if args.spawn_shim:
+        shim, url = spawn_shim(args.port, args.workers, args.threads)
+    try:
+        warmup = args.concurrency if args.warmup is None else args.warmup
+        if warmup:
+            run_load(url, payloads, {'small': 1}, args.concurrency, requests=warmup, timeout=args.timeout)
+        workers_before = fetch_worker_stats(url)
+        results, wall_seconds = run_load(
+            url, payloads, mix, args.concurrency, args.requests, args.duration, args.timeout, args.seed
+        )
+        workers_after = fetch_worker_stats(url)
+    finally:
+        if shim is not None:
+            shim.terminate()
+            shim.wait()
+
+    summary = report(results, wall_seconds, workers_before, workers_after)
+    summary.update({'url': url, 'concurrency': args.concurrency, 'mix': mix})
+    print(json.dumps(summary, indent=2))
+    return 1 if summary['errors'] else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,95 @@
+"""
+Benchmark of the sharded merge against a single process run.
+
+    python -m benchmarks.sharded [--receipts 300] [--workers 1,2,4,8] [--min-efficiency 0.7]
+
+Merges the same synthetic labels once in a single process and then
+sharded over each worker count, checks that every sharded run produces
+the same pages as the single process run, and prints throughput,
+speedup and parallel efficiency (speedup / workers) as JSON. The render
+cache is off so every run renders everything. Exits with status 1 when
+outputs differ or, with ``--min-efficiency``, when a run scales worse.
+"""
+import argparse
+import json
+import os
+import sys
+import time
+from io import BytesIO
+
+from benchmarks.labels import make_label_pdf
+from src.utils import merge_pdf_bytes
+
+def page_signature(pdf_bytes):
+    """
+    Per page image count of a merged PDF: equal signatures mean the same
+    page breaks and the same number of receipts on every page
+    """
+    from PyPDF2 import PdfReader
+
+    signature = []
+    for page in PdfReader(BytesIO(pdf_bytes)).pages:
+        resources = page.get('/Resources') or {}
+        xobjects = resources.get('/XObject') or {}
+        signature.append(len(xobjects))
+    return signature
+
+def run(files, **options):
+    started = time.perf_counter()
+    stats = {}
+    merged = merge_pdf_bytes(files, stats=stats, use_cache=False, **options)
+    return time.perf_counter() - started, merged, stats
+
+def benchmark(receipts=300, worker_counts=None):
+    files = [make_label_pdf(seed) for seed in range(receipts)]
+    worker_counts = worker_counts or sorted({1, 2, 4, os.cpu_count() or 1})
+
+    baseline_seconds, baseline, _ = run(files)
+    expected = page_signature(baseline)
+    report = {
+        'receipts': receipts,
+        'cpu_count': os.cpu_count(),
+        'single_process': {
+            'seconds': round(baseline_seconds, 3),
+            'receipts_per_second': round(receipts / baseline_seconds, 2),
+            'pages': len(expected),
+        },
+        'sharded': [],
+    }
+    for workers in worker_counts:
+        seconds, merged, stats = run(files, sharded=True, workers=workers)
+        speedup = baseline_seconds / seconds
+        report['sharded'].append({
+            'workers': workers,
+            'seconds': round(seconds, 3),
+            'receipts_per_second': round(receipts / seconds, 2),
+            'speedup': round(speedup, 2),
+            'efficiency': round(speedup / workers, 2),
+            'shards': stats['sharded']['shards'],
+            'same_pages': page_signature(merged) == expected,
+        })
+    return report
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark the sharded merge')
+    parser.add_argument('--receipts', type=int, default=300)
+    parser.add_argument('--workers', default='', help='comma separated worker counts, e.g. 1,2,4,8')
+    parser.add_argument('--min-efficiency', type=float, default=None)
+    args = parser.parse_args(argv)
+
+    worker_counts = [int(count) for count in args.workers.split(',') if count.strip()]
+    report = benchmark(args.receipts, worker_counts)
+    print(json.dumps(report, indent=2))
+
+    failed = False
+    for run_report in report['sharded']:
+        if not run_report['same_pages']:
+            print(f"FAIL: {run_report['workers']} workers produced different pages", file=sys.stderr)
+            failed = True
+        if args.min_efficiency is not None and run_report['efficiency'] < args.min_efficiency:
+            print(f"FAIL: {run_report['workers']} workers at {run_report['efficiency']} efficiency", file=sys.stderr)
+            failed = True
+    return 1 if failed else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
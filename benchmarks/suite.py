@@ -0,0 +1,216 @@
+"""
+Offline benchmark suite on synthetic shipping labels.
+
+    python -m benchmarks.suite                    # run, compare with the baseline
+    python -m benchmarks.suite --save-baseline    # run and record a new baseline
+    python -m benchmarks.suite --quick --only simple
+
+Every scenario merges a batch of labels (see benchmarks/labels.py) with
+merge_pdfs, merge_pdfs_with_images or merge_pdfs_simple in a fresh
+process, so peak RSS belongs to that scenario alone. It records
+throughput, per receipt latency, peak RSS (own and poppler's) and output
+bytes. Against a baseline JSON the run fails (exit status 1) when a
+scenario regresses by more than ``--threshold``. Baselines are machine
+specific: record one per machine or CI runner and keep it beside the code.
+The render cache is off so every run renders everything.
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+FUNCTIONS = ('merge_pdfs', 'merge_pdfs_with_images', 'merge_pdfs_simple')
+BATCH_SIZES = (1, 10, 50, 100, 500)
+
+DEFAULT_BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'baseline.json')
+# Allowed relative change before a metric counts as a regression
+DEFAULT_THRESHOLD = 0.15
+# Different documents per corpus; larger batches repeat them
+CORPUS_DISTINCT = 25
+
+# Metric -> direction that counts as worse
+COMPARED_METRICS = {
+    'receipts_per_second': 'lower',
+    'latency_ms_p95': 'higher',
+    'peak_rss_mb': 'higher',
+    'output_bytes': 'higher',
+}
+
+def default_scenarios():
+    """
+    Scenario dicts: ``name``, ``function``, ``variant``, ``batch`` (input
+    files) and ``pages`` (pages per file, each one receipt)
+    """
+    scenarios = []
+    for function in FUNCTIONS:
+        for batch in BATCH_SIZES:
+            scenarios.append({'function': function, 'variant': 'vector', 'batch': batch, 'pages': 1})
+    for variant in ('dense', 'scanned'):
+        for batch in (10, 100):
+            scenarios.append({'function': 'merge_pdfs', 'variant': variant, 'batch': batch, 'pages': 1})
+    # Marketplace exports: one file with many labels, a few multi-page files
+    scenarios.append({'function': 'merge_pdfs', 'variant': 'vector', 'batch': 1, 'pages': 50})
+    scenarios.append({'function': 'merge_pdfs', 'variant': 'vector', 'batch': 10, 'pages': 5})
+    scenarios.append({'function': 'merge_pdfs', 'variant': 'scanned', 'batch': 1, 'pages': 20})
+    for scenario in scenarios:
+        scenario['name'] = '{function}-{variant}-b{batch}-p{pages}'.format(**scenario)
+    return scenarios
+
+def build_corpus(scenario, directory):
+    """
+    Write the scenario's distinct label PDFs to ``directory`` (once per
+    variant and page count) and return the paths of its batch in order
+    """
+    from benchmarks.labels import make_label_pdf
+
+    distinct = min(scenario['batch'], CORPUS_DISTINCT)
+    paths = []
+    for number in range(distinct):
+        path = os.path.join(directory, f"{scenario['variant']}-p{scenario['pages']}-{number}.pdf")
+        if not os.path.exists(path):
+            with open(path, 'wb') as f:
+                f.write(make_label_pdf(number, scenario['pages'], scenario['variant']))
+        paths.append(path)
+    return [paths[number % distinct] for number in range(scenario['batch'])]
+
+def run_scenario(scenario, paths, repeat=1):
+    """
+    Merge the batch in this process ``repeat`` times; the fastest run is
+    reported. Meant to run in a fresh process, see measure_scenario.
+    """
+    from io import BytesIO
+
+    from src import utils
+    from src.metrics import Metrics, peak_rss_mb
+
+    files = []
+    for path in paths:
+        with open(path, 'rb') as f:
+            files.append(f.read())
+
+    function = getattr(utils, scenario['function'])
+    best = None
+    for _ in range(repeat):
+        output = BytesIO()
+        metrics = Metrics()
+        started = time.perf_counter()
+        if scenario['function'] == 'merge_pdfs_simple':
+            function(files, output)
+        else:
+            function(files, output, use_cache=False, metrics=metrics)
+        seconds = time.perf_counter() - started
+        if best is None or seconds < best[0]:
+            best = (seconds, output.getbuffer().nbytes, metrics)
+
+    seconds, output_bytes, metrics = best
+    receipts = scenario['batch'] * scenario['pages']
+    latencies = sorted(
+        (entry.get('render_seconds', 0) + entry.get('encode_seconds', 0)) * 1000 for entry in metrics.receipts
+    )
+    own_rss, children_rss = peak_rss_mb()
+    return {
+        'receipts': receipts,
+        'seconds': round(seconds, 4),
+        'receipts_per_second': round(receipts / seconds, 2) if seconds else None,
+        'latency_ms_mean': round(seconds * 1000 / receipts, 2),
+        # Per receipt render + encode time, only the raster paths measure it
+        'latency_ms_p50': round(statistics.median(latencies), 2) if latencies else None,
+        'latency_ms_p95': round(latencies[int(0.95 * (len(latencies) - 1))], 2) if latencies else None,
+        'peak_rss_mb': own_rss,
+        'children_peak_rss_mb': children_rss,
+        'output_bytes': output_bytes,
+    }
+
+def measure_scenario(scenario, corpus_dir, repeat=1):
+    """
+    Run one scenario in a fresh interpreter and return its results
+    """
+    paths = build_corpus(scenario, corpus_dir)
+    request = json.dumps({'scenario': scenario, 'paths': paths, 'repeat': repeat})
+    result = subprocess.run(
+        [sys.executable, '-m', 'benchmarks.suite', '--child'],
+        input=request, capture_output=True, text=True,
+        cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+        env=dict(os.environ, LOG_LEVEL='error'),
+    )
+    if result.returncode != 0:
+        raise RuntimeError(f"{scenario['name']} failed:\n{result.stderr}")
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+def compare(results, baseline, threshold=DEFAULT_THRESHOLD):
+    """
+    Regressions of ``results`` against ``baseline`` (both name -> metrics)
+    as readable messages
+    """
+    regressions = []
+    for name, current in results.items():
+        previous = baseline.get(name)
+        if previous is None:
+            continue
+        for metric, worse in COMPARED_METRICS.items():
+            before, after = previous.get(metric), current.get(metric)
+            if not before or after is None:
+                continue
+            change = (after - before) / before
+            if (worse == 'lower' and change < -threshold) or (worse == 'higher' and change > threshold):
+                regressions.append(f"{name}: {metric} {before} -> {after} ({change:+.0%})")
+    return regressions
+
+def _child():
+    request = json.loads(sys.stdin.read())
+    print(json.dumps(run_scenario(request['scenario'], request['paths'], request['repeat'])))
+    return 0
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Offline merge benchmarks on synthetic labels')
+    parser.add_argument('--baseline', default=DEFAULT_BASELINE)
+    parser.add_argument('--save-baseline', action='store_true', help='record this run as the baseline')
+    parser.add_argument('--threshold', type=float, default=DEFAULT_THRESHOLD)
+    parser.add_argument('--only', default='', help='run scenarios whose name contains this text')
+    parser.add_argument('--quick', action='store_true', help='skip batches above 50 receipts')
+    parser.add_argument('--repeat', type=int, default=1, help='runs per scenario, the fastest counts')
+    parser.add_argument('--corpus-dir', default=None, help='keep generated labels here between runs')
+    parser.add_argument('--child', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.child:
+        return _child()
+
+    scenarios = [
+        scenario for scenario in default_scenarios()
+        if args.only in scenario['name'] and not (args.quick and scenario['batch'] * scenario['pages'] > 50)
+    ]
+    results = {}
+    with tempfile.TemporaryDirectory(prefix='resi-merger-corpus-') as scratch:
+        corpus_dir = args.corpus_dir or scratch
+        os.makedirs(corpus_dir, exist_ok=True)
+        for scenario in scenarios:
+            results[scenario['name']] = measure_scenario(scenario, corpus_dir, args.repeat)
+            print(json.dumps({scenario['name']: results[scenario['name']]}), file=sys.stderr)
+
+    report = {'python': sys.version.split()[0], 'cpu_count': os.cpu_count(), 'scenarios': results}
+    print(json.dumps(report, indent=2))
+
+    if args.save_baseline:
+        with open(args.baseline, 'w') as f:
+            json.dump(report, f, indent=2)
+        print(f'Baseline saved to {args.baseline}', file=sys.stderr)
+        return 0
+
+    if not os.path.exists(args.baseline):
+        print(f'No baseline at {args.baseline}, run with --save-baseline first', file=sys.stderr)
+        return 0
+
+    with open(args.baseline) as f:
+        baseline = json.load(f)['scenarios']
+    regressions = compare(results, baseline, args.threshold)
+    for regression in regressions:
+        print(f'REGRESSION: {regression}', file=sys.stderr)
+    return 1 if regressions else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
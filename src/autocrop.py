@@ -0,0 +1,59 @@
+import numpy as np
+
+# A pixel darker than this (0-255 gray) counts as label content
+DARK_THRESHOLD = 200
+# A row/column needs at least this share of dark pixels to count, which
+# ignores specks and scanner noise
+MIN_CONTENT_RATIO = 0.002
+# Blank bands at least this wide (share of the page) separate the label
+# from whatever else is printed on the sheet
+MIN_GAP_RATIO = 0.03
+# Margin kept around the detected content (share of the page)
+MARGIN_RATIO = 0.01
+
+def content_box(gray, dark_threshold=DARK_THRESHOLD, min_gap_ratio=MIN_GAP_RATIO,
+                margin_ratio=MARGIN_RATIO):
+    """
+    Locate the label on a low resolution grayscale preview of a page.
+
+    ``gray`` is a 2-D uint8 array. Column and row projections of the dark
+    pixel mask find the first content block from the top-left, where blocks
+    are separated by blank gutters of at least ``min_gap_ratio`` of the
+    page. Returns ``(left, top, right, bottom)`` as fractions of the page,
+    or None for a blank page.
+    """
+    height, width = gray.shape
+    dark = gray < dark_threshold
+
+    columns = _first_block(dark.mean(axis=0), max(1, int(width * min_gap_ratio)))
+    if columns is None:
+        return None
+    left, right = columns
+
+    # Rows are measured only across the label's columns so content beside
+    # the label doesn't bridge the gutter below it
+    rows = _first_block(dark[:, left:right + 1].mean(axis=1), max(1, int(height * min_gap_ratio)))
+    if rows is None:
+        return None
+    top, bottom = rows
+
+    margin_x = width * margin_ratio
+    margin_y = height * margin_ratio
+    return (
+        max(0.0, (left - margin_x) / width),
+        max(0.0, (top - margin_y) / height),
+        min(1.0, (right + 1 + margin_x) / width),
+        min(1.0, (bottom + 1 + margin_y) / height),
+    )
+
+def _first_block(profile, min_gap):
+    """
+    ``(start, end)`` indices of the first run of content in a projection,
+    ending at the first gap of ``min_gap`` or more blank entries
+    """
+    content = np.flatnonzero(profile >= MIN_CONTENT_RATIO)
+    if content.size == 0:
+        return None
+    gaps = np.flatnonzero(np.diff(content) > min_gap)
+    end = content[gaps[0]] if gaps.size else content[-1]
+    return int(content[0]), int(end)
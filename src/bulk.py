@@ -0,0 +1,294 @@
+"""
+Bulk offline merge of label PDFs on disk, for end-of-day warehouse runs.
+
+    python -m src.bulk labels/ 'incoming/*.pdf' -o merged/ --pages-per-output 20 --workers 4
+
+Inputs are directories (their ``*.pdf`` files, ``--recursive`` for
+subdirectories), glob patterns or files, taken in sorted order. They are
+packed into groups of at most ``--pages-per-output`` output pages
+(``rows * cols`` receipts a page) without splitting a file; a file with
+more receipts than that is a group of its own. Each group is merged with
+merge_pdfs straight from its paths into ``<prefix>-0001.pdf``,
+``<prefix>-0002.pdf``... and groups run in parallel, one per worker
+process.
+
+Progress is streamed to stderr as one JSON line per finished group, the
+summary is printed to stdout. The manifest (``manifest.json`` in the
+output directory) records every group with a fingerprint of its inputs
+(paths, sizes, modification times) and the merge settings, and is
+rewritten as groups finish. Running the same command again resumes: a
+group that is done, has an unchanged fingerprint and whose output exists
+is not rendered again. Failed groups are retried.
+"""
+import argparse
+import glob
+import hashlib
+import json
+import os
+import sys
+import time
+
+from .log import end_request, start_request
+from .utils import CROP_MODES, ENCODING_PROFILES, ENGINES, _page_numbers, merge_pdfs, parse_page_selection
+
+MANIFEST_NAME = 'manifest.json'
+MANIFEST_VERSION = 1
+
+# Output pages per group unless --pages-per-output says otherwise
+DEFAULT_PAGES_PER_OUTPUT = 20
+
+def collect_inputs(sources, recursive=False):
+    """
+    PDF paths named by ``sources`` (directories, glob patterns or files),
+    sorted within each source, first occurrence kept
+    """
+    paths = []
+    for source in sources:
+        if os.path.isdir(source):
+            pattern = os.path.join(source, '**', '*.pdf') if recursive else os.path.join(source, '*.pdf')
+            matches = glob.glob(pattern, recursive=recursive)
+            matches += glob.glob(pattern[:-3] + 'PDF', recursive=recursive)
+        elif os.path.isfile(source):
+            matches = [source]
+        else:
+            matches = [path for path in glob.glob(source, recursive=True) if os.path.isfile(path)]
+        paths.extend(sorted(matches))
+    seen = set()
+    return [path for path in paths if not (path in seen or seen.add(path))]
+
+def count_receipts(path, pages='all'):
+    """
+    Receipts one input contributes: its pages picked by ``pages``.
+    Unreadable files count as one, merge_pdfs reports them.
+    """
+    from PyPDF2 import PdfReader
+
+    if pages == 'first':
+        return 1
+    try:
+        page_count = len(PdfReader(path).pages)
+    except Exception:
+        return 1
+    return len(_page_numbers(pages, page_count))
+
+def plan_groups(paths, receipts_per_group, pages='all'):
+    """
+    Pack ``paths`` in order into lists whose receipt counts add up to at
+    most ``receipts_per_group``; a larger file gets a list of its own
+    """
+    groups = []
+    current, current_receipts = [], 0
+    for path in paths:
+        receipts = count_receipts(path, pages)
+        if current and current_receipts + receipts > receipts_per_group:
+            groups.append((current, current_receipts))
+            current, current_receipts = [], 0
+        current.append(path)
+        current_receipts += receipts
+    if current:
+        groups.append((current, current_receipts))
+    return groups
+
+def group_fingerprint(paths, settings):
+    """
+    Hash of the settings and every input's path, size and modification time
+    """
+    digest = hashlib.sha256(json.dumps(settings, sort_keys=True).encode())
+    for path in paths:
+        stat = os.stat(path)
+        digest.update(f'{os.path.abspath(path)}\0{stat.st_size}\0{stat.st_mtime_ns}\n'.encode())
+    return digest.hexdigest()
+
+def load_manifest(path):
+    """
+    Group records of a previous run by output name, empty if there is none
+    """
+    try:
+        with open(path) as f:
+            manifest = json.load(f)
+    except FileNotFoundError:
+        return {}
+    except ValueError:
+        print(json.dumps({'event': 'manifest_unreadable', 'manifest': path}), file=sys.stderr)
+        return {}
+    if manifest.get('version') != MANIFEST_VERSION:
+        return {}
+    return {group['output']: group for group in manifest.get('groups', [])}
+
+def save_manifest(path, settings, groups):
+    # Write and rename so an interrupted run never leaves half a manifest
+    partial = path + '.part'
+    with open(partial, 'w') as f:
+        json.dump({'version': MANIFEST_VERSION, 'settings': settings, 'groups': groups}, f, indent=1)
+    os.replace(partial, path)
+
+def merge_group(group_id, inputs, output, options):
+    """
+    Merge one group into ``output``. Module level so it can run in a pool
+    worker; log records carry the group ID and go to stderr. The PDF is
+    written beside the output and renamed, so an interrupted merge leaves
+    no output behind.
+
+    Returns the merge statistics with the output ``bytes``.
+    """
+    token = start_request(sink=lambda line: print(line, file=sys.stderr, flush=True), request_id=group_id)
+    try:
+        partial = output + '.part'
+        with open(partial, 'wb') as f:
+            result = merge_pdfs(inputs, f, **options) or {}
+        os.replace(partial, output)
+    finally:
+        end_request(token)
+    return dict(result, bytes=os.path.getsize(output))
+
+def run_bulk(sources, output_dir, pages_per_output=DEFAULT_PAGES_PER_OUTPUT, workers=None, rows=3, cols=2,
+             engine='raster', profile='rgb', crop='default', pages='all', use_cache=False, recursive=False,
+             prefix='merged', manifest_path=None, progress=None):
+    """
+    Plan, resume and run a bulk merge, see the module docstring.
+    ``progress`` is called with one event dict per finished or failed
+    group. Returns the run summary.
+    """
+    from concurrent.futures import ProcessPoolExecutor, as_completed
+
+    started = time.perf_counter()
+    workers = workers or os.cpu_count() or 1
+    # Part of every group's fingerprint: changing one re-renders all groups
+    settings = {'rows': rows, 'cols': cols, 'engine': engine, 'profile': profile, 'crop': crop, 'pages': pages}
+    options = dict(settings, workers=1, use_cache=use_cache)
+    os.makedirs(output_dir, exist_ok=True)
+    manifest_path = manifest_path or os.path.join(output_dir, MANIFEST_NAME)
+
+    paths = collect_inputs(sources, recursive)
+    planned = plan_groups(paths, max(1, pages_per_output) * rows * cols, pages)
+    previous = load_manifest(manifest_path)
+
+    groups = []
+    pending = []
+    for number, (inputs, receipts) in enumerate(planned, 1):
+        output = f'{prefix}-{number:04d}.pdf'
+        record = {
+            'id': f'group-{number:04d}',
+            'output': output,
+            'inputs': inputs,
+            'receipts': receipts,
+            'fingerprint': group_fingerprint(inputs, settings),
+            'status': 'pending',
+        }
+        done = previous.get(output)
+        if (done and done.get('status') == 'done' and done.get('fingerprint') == record['fingerprint']
+                and os.path.exists(os.path.join(output_dir, output))):
+            record = done
+        else:
+            pending.append(record)
+        groups.append(record)
+    save_manifest(manifest_path, settings, groups)
+
+    total_receipts = sum(group['receipts'] for group in pending)
+    finished = {'groups': 0, 'receipts': 0}
+
+    def finish(record, result=None, error=None):
+        if error is None:
+            record.update(status='done', processed=result.get('processed'), bytes=result['bytes'],
+                          seconds=result.get('elapsed_seconds'))
+            record.pop('error', None)
+        else:
+            record.update(status='failed', error=error)
+        save_manifest(manifest_path, settings, groups)
+        finished['groups'] += 1
+        finished['receipts'] += record['receipts']
+        elapsed = time.perf_counter() - started
+        rate = finished['receipts'] / elapsed if elapsed else 0
+        event = {
+            'event': 'group_done' if error is None else 'group_failed',
+            'group': record['id'],
+            'output': record['output'],
+            'groups_done': finished['groups'],
+            'groups_total': len(pending),
+            'receipts_done': finished['receipts'],
+            'receipts_total': total_receipts,
+            'receipts_per_second': round(rate, 2),
+            'eta_seconds': round((total_receipts - finished['receipts']) / rate, 1) if rate else None,
+        }
+        if error is not None:
+            event['error'] = error
+        if progress is not None:
+            progress(event)
+
+    def submit_args(record):
+        return record['id'], record['inputs'], os.path.join(output_dir, record['output']), options
+
+    if workers == 1 or len(pending) <= 1:
+        for record in pending:
+            try:
+                finish(record, merge_group(*submit_args(record)))
+            except Exception as e:
+                finish(record, error=str(e))
+    else:
+        pool = ProcessPoolExecutor(max_workers=min(workers, len(pending)))
+        try:
+            futures = {pool.submit(merge_group, *submit_args(record)): record for record in pending}
+            for future in as_completed(futures):
+                try:
+                    finish(futures[future], future.result())
+                except Exception as e:
+                    finish(futures[future], error=str(e))
+        finally:
+            pool.shutdown(cancel_futures=True)
+
+    failed = [group['id'] for group in groups if group['status'] == 'failed']
+    return {
+        'inputs': len(paths),
+        'groups': len(groups),
+        'rendered': len(pending),
+        'skipped': len(groups) - len(pending),
+        'failed': failed,
+        'receipts': sum(group['receipts'] for group in groups),
+        'output_dir': output_dir,
+        'manifest': manifest_path,
+        'workers': workers,
+        'elapsed_seconds': round(time.perf_counter() - started, 3),
+    }
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Merge directories of label PDFs into grid documents')
+    parser.add_argument('sources', nargs='+', help='directories, glob patterns or PDF files')
+    parser.add_argument('-o', '--output-dir', required=True)
+    parser.add_argument('--pages-per-output', type=int, default=DEFAULT_PAGES_PER_OUTPUT,
+                        help='output pages per merged document')
+    parser.add_argument('--workers', type=int, default=None, help='groups merged in parallel (default: CPU count)')
+    parser.add_argument('--rows', type=int, default=3)
+    parser.add_argument('--cols', type=int, default=2)
+    parser.add_argument('--engine', choices=ENGINES, default=os.environ.get('MERGE_ENGINE', 'raster'))
+    parser.add_argument('--profile', choices=list(ENCODING_PROFILES), default=os.environ.get('MERGE_PROFILE', 'rgb'))
+    parser.add_argument('--crop', choices=CROP_MODES, default=os.environ.get('MERGE_CROP', 'default'))
+    parser.add_argument('--pages', default=os.environ.get('MERGE_PAGES', 'all'), help='pages of each input, e.g. all, first, 1-3')
+    parser.add_argument('--cache', action='store_true', help='use the render cache')
+    parser.add_argument('--recursive', action='store_true', help='include PDFs in subdirectories')
+    parser.add_argument('--prefix', default='merged', help='output file name prefix')
+    parser.add_argument('--manifest', default=None, help=f'manifest path (default: OUTPUT_DIR/{MANIFEST_NAME})')
+    parser.add_argument('--quiet', action='store_true', help='no progress lines')
+    # Sources may come before and after the options
+    args = parser.parse_intermixed_args(argv)
+
+    try:
+        pages = parse_page_selection(args.pages)
+    except ValueError as e:
+        parser.error(str(e))
+    if args.pages_per_output < 1 or args.rows < 1 or args.cols < 1:
+        parser.error('--pages-per-output, --rows and --cols must be at least 1')
+
+    def progress(event):
+        print(json.dumps(event), file=sys.stderr, flush=True)
+
+    summary = run_bulk(
+        args.sources, args.output_dir, args.pages_per_output, args.workers, args.rows, args.cols,
+        engine=args.engine, profile=args.profile, crop=args.crop, pages=pages, use_cache=args.cache,
+        recursive=args.recursive, prefix=args.prefix, manifest_path=args.manifest,
+        progress=None if args.quiet else progress,
+    )
+    print(json.dumps(summary, indent=2))
+    return 1 if summary['failed'] else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,303 @@
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+
+from .log import env_number, get_logger
+
+# Cache sizing, tune with the hit/miss counters from RenderCache.stats()
+RENDER_CACHE_ENABLED = os.environ.get('RENDER_CACHE', '1') not in ('0', 'false', 'off')
+RENDER_CACHE_MEMORY_MB = env_number('RENDER_CACHE_MEMORY_MB', 128, cast=int)
+RENDER_CACHE_DISK_MB = env_number('RENDER_CACHE_DISK_MB', 512, cast=int)
+RENDER_CACHE_DIR = os.environ.get('RENDER_CACHE_DIR', '/tmp/resi-merger-cache')
+# Disk eviction trims the tier to this fraction of its limit, so the next
+# puts don't each trigger a directory scan
+RENDER_CACHE_DISK_LOW_WATER = 0.9
+# Puts between re-reads of the disk tier's size, which other processes
+# sharing the directory change too
+RENDER_CACHE_DISK_RESCAN_PUTS = 256
+
+# Whole-request results (merged PDFs) kept for repeated requests, opt-in
+RESULT_CACHE_ENABLED = os.environ.get('RESULT_CACHE', '0') not in ('0', 'false', 'off')
+RESULT_CACHE_MB = env_number('RESULT_CACHE_MB', 64, cast=int)
+
+logger = get_logger(__name__)
+
+_default_cache = None
+_default_result_cache = None
+_default_cache_lock = threading.Lock()
+
+def render_cache_key(pdf_bytes, **params):
+    """
+    Content address of a render: SHA-256 of the input PDF plus every
+    parameter that changes the resulting pixels
+    """
+    digest = hashlib.sha256(pdf_bytes)
+    for name in sorted(params):
+        digest.update(f"|{name}={params[name]!r}".encode('utf-8'))
+    return digest.hexdigest()
+
+def request_cache_key(files, **params):
+    """
+    Normalized hash of a merge request: the SHA-256 of every input PDF
+    (bytes, decoded from any transfer encoding) in order plus the options
+    that change the output
+    """
+    digest = hashlib.sha256()
+    for content in files:
+        digest.update(hashlib.sha256(content).digest())
+    for name in sorted(params):
+        digest.update(f"|{name}={params[name]!r}".encode('utf-8'))
+    return digest.hexdigest()
+
+def get_render_cache():
+    """
+    Process wide RenderCache configured from the environment,
+    or None when RENDER_CACHE is switched off
+    """
+    global _default_cache
+    if not RENDER_CACHE_ENABLED:
+        return None
+    with _default_cache_lock:
+        if _default_cache is None:
+            _default_cache = RenderCache(
+                memory_bytes=RENDER_CACHE_MEMORY_MB * 1024 * 1024,
+                disk_dir=RENDER_CACHE_DIR,
+                disk_bytes=RENDER_CACHE_DISK_MB * 1024 * 1024,
+            )
+        return _default_cache
+
+def get_result_cache():
+    """
+    Process wide ResultCache configured from the environment,
+    or None when RESULT_CACHE is switched off
+    """
+    global _default_result_cache
+    if not RESULT_CACHE_ENABLED:
+        return None
+    with _default_cache_lock:
+        if _default_result_cache is None:
+            _default_result_cache = ResultCache(max_bytes=RESULT_CACHE_MB * 1024 * 1024)
+        return _default_result_cache
+
+class ResultCache:
+    """
+    In-memory LRU of merge results, bounded by the total size of the
+    merged PDFs. An entry is a dict with the PDF in ``content`` plus
+    whatever the caller needs to answer a repeat (stats, stored file).
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._used = 0
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry
+
+    def put(self, key, entry):
+        size = len(entry['content'])
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            previous = self._entries.pop(key, None)
+            if previous is not None:
+                self._used -= len(previous['content'])
+            self._entries[key] = entry
+            self._used += size
+            while self._used > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self._used -= len(evicted['content'])
+                self.evictions += 1
+
+    def stats(self):
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'entries': len(self._entries),
+                'bytes': self._used,
+            }
+
+class RenderCache:
+    """
+    Two tier LRU cache of cropped receipt images.
+
+    The memory tier keeps PIL images, bounded by their decoded size. The
+    disk tier keeps PNG files named by key under ``disk_dir``, bounded by
+    total file size; file mtimes record recency so the tier survives
+    restarts and can be shared by several processes. A ``disk_bytes`` of 0
+    disables the disk tier. The tier's size is tracked as files are
+    written and only scanned when it passes ``disk_bytes`` or every
+    RENDER_CACHE_DISK_RESCAN_PUTS puts.
+    """
+
+    def __init__(self, memory_bytes, disk_dir=None, disk_bytes=0):
+        self.memory_bytes = memory_bytes
+        self.disk_dir = disk_dir if disk_bytes > 0 else None
+        self.disk_bytes = disk_bytes
+        self.hits_memory = 0
+        self.hits_disk = 0
+        self.misses = 0
+        self.evictions = 0
+        self._memory = OrderedDict()
+        self._memory_used = 0
+        # Tracked size of the disk tier, None until the first scan
+        self._disk_used = None
+        self._disk_puts = 0
+        self._lock = threading.Lock()
+        if self.disk_dir:
+            os.makedirs(self.disk_dir, exist_ok=True)
+
+    def get(self, key):
+        """
+        Return a copy of the cached image for ``key`` or None
+        """
+        with self._lock:
+            image = self._memory.get(key)
+            if image is not None:
+                self._memory.move_to_end(key)
+                self.hits_memory += 1
+                return image.copy()
+
+        image = self._disk_get(key)
+        with self._lock:
+            if image is None:
+                self.misses += 1
+                return None
+            self.hits_disk += 1
+            self._memory_put(key, image)
+        return image.copy()
+
+    def put(self, key, image):
+        """
+        Store ``image`` in both tiers, evicting least recently used entries
+        """
+        with self._lock:
+            self._memory_put(key, image.copy())
+        self._disk_put(key, image)
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits_memory + self.hits_disk + self.misses
+            return {
+                'hits_memory': self.hits_memory,
+                'hits_disk': self.hits_disk,
+                'misses': self.misses,
+                'hit_rate': round((self.hits_memory + self.hits_disk) / lookups, 3) if lookups else 0.0,
+                'evictions': self.evictions,
+                'memory_entries': len(self._memory),
+                'memory_bytes': self._memory_used,
+                'disk_bytes': (self._disk_used or 0) if self.disk_dir else 0,
+            }
+
+    def _memory_put(self, key, image):
+        # Caller holds the lock
+        size = _image_size(image)
+        if size > self.memory_bytes:
+            return
+        previous = self._memory.pop(key, None)
+        if previous is not None:
+            self._memory_used -= _image_size(previous)
+        self._memory[key] = image
+        self._memory_used += size
+        while self._memory_used > self.memory_bytes:
+            _, evicted = self._memory.popitem(last=False)
+            self._memory_used -= _image_size(evicted)
+            self.evictions += 1
+
+    def _disk_path(self, key):
+        return os.path.join(self.disk_dir, f"{key}.png")
+
+    def _disk_get(self, key):
+        if not self.disk_dir:
+            return None
+        from PIL import Image
+
+        path = self._disk_path(key)
+        try:
+            with Image.open(path) as stored:
+                image = stored.copy()
+            # Touch the file so eviction sees it as recently used
+            os.utime(path)
+            return image
+        except (OSError, ValueError):
+            return None
+
+    def _disk_put(self, key, image):
+        if not self.disk_dir:
+            return
+        path = self._disk_path(key)
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            # Fast PNG settings: the disk tier is a scratch area, not the output
+            image.save(tmp_path, "PNG", compress_level=1)
+            size = os.path.getsize(tmp_path)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            logger.warning('render_cache_write_failed', key=key, error=str(e))
+            try:
+                os.unlink(tmp_path)
+            except OSError:
+                pass
+            return
+        with self._lock:
+            self._disk_puts += 1
+            if self._disk_used is not None and self._disk_puts % RENDER_CACHE_DISK_RESCAN_PUTS:
+                self._disk_used += size
+                if self._disk_used <= self.disk_bytes:
+                    return
+        self._disk_evict()
+
+    def _disk_usage(self):
+        entries = []
+        total = 0
+        try:
+            with os.scandir(self.disk_dir) as it:
+                for entry in it:
+                    if not entry.name.endswith('.png'):
+                        continue
+                    try:
+                        info = entry.stat()
+                    except OSError:
+                        continue
+                    entries.append((info.st_mtime, info.st_size, entry.path))
+                    total += info.st_size
+        except OSError:
+            pass
+        return entries, total
+
+    def _disk_evict(self):
+        # Scan the tier, trim it when it is over its limit and reset the
+        # tracked size
+        entries, total = self._disk_usage()
+        if total > self.disk_bytes:
+            target = self.disk_bytes * RENDER_CACHE_DISK_LOW_WATER
+            entries.sort()
+            for _, size, path in entries:
+                if total <= target:
+                    break
+                try:
+                    os.unlink(path)
+                    total -= size
+                    with self._lock:
+                        self.evictions += 1
+                except OSError:
+                    pass
+        with self._lock:
+            self._disk_used = total
+
+def _image_size(image):
+    return image.width * image.height * len(image.getbands())
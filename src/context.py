@@ -0,0 +1,132 @@
+import json
+import sys
+from http.server import BaseHTTPRequestHandler
+from urllib.parse import parse_qsl, urlsplit
+
+# Answered by LocalHandler.status instead of main
+STATUS_PATH = '/__server/status'
+
+class LocalRequest:
+    """
+    Stand-in for the Appwrite runtime's ``context.req``, built from a raw
+    HTTP request. Header names are lowercased like Appwrite does.
+    """
+
+    def __init__(self, method, url, headers=None, body=b''):
+        parts = urlsplit(url)
+        self.method = method.upper()
+        self.path = parts.path or '/'
+        self.query_string = parts.query
+        self.query = dict(parse_qsl(parts.query))
+        self.headers = {key.lower(): value for key, value in dict(headers or {}).items()}
+        self.body_binary = bytes(body or b'')
+
+    @property
+    def body_raw(self):
+        return self.body_binary.decode('utf-8', errors='replace')
+
+    @property
+    def body_text(self):
+        return self.body_raw
+
+    @property
+    def body(self):
+        return self.body_raw
+
+    @property
+    def body_json(self):
+        """
+        Parsed JSON body, None when the body isn't JSON (main then reports
+        the parse error itself)
+        """
+        try:
+            return json.loads(self.body_binary) if self.body_binary else None
+        except ValueError:
+            return None
+
+class LocalResponse:
+    """
+    Stand-in for ``context.res``. Every method returns the response as a
+    ``(status, headers, body bytes)`` tuple, which is what ``main`` returns.
+    """
+
+    def json(self, data, status=200, headers=None):
+        headers = dict(headers or {})
+        headers['Content-Type'] = 'application/json'
+        return status, headers, json.dumps(data).encode('utf-8')
+
+    def empty(self, status=204, headers=None):
+        return status, dict(headers or {}), b''
+
+    def send(self, body, status=200, headers=None):
+        if isinstance(body, str):
+            body = body.encode('utf-8')
+        return status, dict(headers or {}), bytes(body or b'')
+
+    def binary(self, body, status=200, headers=None):
+        return status, dict(headers or {}), bytes(body)
+
+    def text(self, body, status=200, headers=None):
+        return self.send(body, status, headers)
+
+class LocalContext:
+    """
+    Stand-in for the Appwrite function ``context``, for running ``main``
+    outside Appwrite (self-hosting, load tests). ``log`` and ``error``
+    write to ``log_stream`` (stderr by default), or nowhere with None.
+    """
+
+    def __init__(self, req, log_stream=sys.stderr):
+        self.req = req
+        self.res = LocalResponse()
+        self._log_stream = log_stream
+
+    def log(self, message):
+        if self._log_stream is not None:
+            print(message, file=self._log_stream)
+
+    def error(self, message):
+        self.log(message)
+
+class LocalHandler(BaseHTTPRequestHandler):
+    """
+    HTTP/1.1 (keep-alive) front end shared by src/server.py and the load
+    test shim. ``GET STATUS_PATH`` is answered with the JSON of
+    ``status()``, every other request with ``call(method, url, headers,
+    body)``, which returns ``(status, headers, body bytes)`` like main.
+    Subclasses provide both.
+    """
+
+    protocol_version = 'HTTP/1.1'
+    server_version = 'resi-merger'
+
+    def status(self):
+        raise NotImplementedError
+
+    def call(self, method, url, headers, body):
+        raise NotImplementedError
+
+    def _handle(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        body = self.rfile.read(length) if length else b''
+        if self.command == 'GET' and self.path == STATUS_PATH:
+            response = (200, {'Content-Type': 'application/json'}, json.dumps(self.status()).encode())
+        else:
+            response = self.call(self.command, self.path, dict(self.headers.items()), body)
+        self._respond(*response)
+
+    def _respond(self, status, headers, body):
+        self.send_response(status)
+        for name, value in headers.items():
+            if name.lower() not in ('content-length', 'connection'):
+                self.send_header(name, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if self.command != 'HEAD':
+            self.wfile.write(body)
+
+    do_GET = do_POST = do_OPTIONS = do_PUT = do_DELETE = do_HEAD = _handle
+
+    def log_message(self, format, *args):
+        # Requests are logged by main itself, as JSON lines
+        pass
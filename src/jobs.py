@@ -0,0 +1,248 @@
+import contextvars
+import json
+import os
+import sqlite3
+import threading
+import time
+import traceback
+import uuid
+
+from .log import env_number, get_logger
+from .storage import get_output_storage
+from .utils import merge_pdf_bytes
+
+JOB_STORE_PATH = os.environ.get('JOB_STORE_PATH', '/tmp/resi-merger-jobs.sqlite3')
+# Finished jobs and their stored outputs are dropped this long after they
+# finish, 0 = kept
+JOB_TTL_SECONDS = env_number('JOB_TTL_SECONDS', 86400, cast=int)
+
+logger = get_logger(__name__)
+
+# Job lifecycle: queued -> running -> done | failed
+JOB_STATUSES = ('queued', 'running', 'done', 'failed')
+
+class JobStore:
+    """
+    Persistence for asynchronous merge jobs: the job record, its uploaded
+    inputs until a worker picks them up, and progress / result fields.
+    """
+
+    def create(self, input_files, options):
+        """
+        Record a queued job with its inputs and return the job ID
+        """
+        raise NotImplementedError
+
+    def get(self, job_id):
+        """
+        Job record as a dict, or None for unknown IDs
+        """
+        raise NotImplementedError
+
+    def update(self, job_id, **fields):
+        """
+        Set record fields (status, processed, file_id, size, error...)
+        """
+        raise NotImplementedError
+
+    def load_inputs(self, job_id):
+        """
+        The job's input PDFs as a list of bytes, in upload order
+        """
+        raise NotImplementedError
+
+    def drop_inputs(self, job_id):
+        """
+        Forget the job's inputs once they are no longer needed
+        """
+        raise NotImplementedError
+
+    def purge(self, before):
+        """
+        Delete the records of jobs that finished (done or failed) before
+        the ``before`` timestamp and return them
+        """
+        raise NotImplementedError
+
+class SQLiteJobStore(JobStore):
+    """
+    Job store in a single SQLite file, shared by every process on the host
+    """
+
+    _FIELDS = ('status', 'processed', 'total', 'options', 'file_id', 'size', 'error', 'created_at', 'updated_at')
+
+    def __init__(self, path=None):
+        self.path = path or JOB_STORE_PATH
+        with self._connect() as db:
+            db.execute(
+                "CREATE TABLE IF NOT EXISTS jobs ("
+                " id TEXT PRIMARY KEY, status TEXT NOT NULL, processed INTEGER NOT NULL DEFAULT 0,"
+                " total INTEGER NOT NULL, options TEXT, file_id TEXT, size INTEGER, error TEXT,"
+                " created_at REAL NOT NULL, updated_at REAL NOT NULL)"
+            )
+            db.execute(
+                "CREATE TABLE IF NOT EXISTS job_inputs ("
+                " job_id TEXT NOT NULL, position INTEGER NOT NULL, content BLOB NOT NULL,"
+                " PRIMARY KEY (job_id, position))"
+            )
+
+    def _connect(self):
+        # One connection per call keeps the store safe to use from worker threads
+        return sqlite3.connect(self.path, timeout=30)
+
+    def create(self, input_files, options):
+        job_id = uuid.uuid4().hex
+        now = time.time()
+        with self._connect() as db:
+            db.execute(
+                "INSERT INTO jobs (id, status, processed, total, options, created_at, updated_at)"
+                " VALUES (?, 'queued', 0, ?, ?, ?, ?)",
+                (job_id, len(input_files), json.dumps(options), now, now)
+            )
+            db.executemany(
+                "INSERT INTO job_inputs (job_id, position, content) VALUES (?, ?, ?)",
+                [(job_id, position, content) for position, content in enumerate(input_files)]
+            )
+        return job_id
+
+    def get(self, job_id):
+        with self._connect() as db:
+            row = db.execute(
+                f"SELECT {', '.join(self._FIELDS)} FROM jobs WHERE id = ?", (job_id,)
+            ).fetchone()
+        if row is None:
+            return None
+        job = dict(zip(self._FIELDS, row))
+        job['id'] = job_id
+        job['options'] = json.loads(job['options'] or '{}')
+        return job
+
+    def update(self, job_id, **fields):
+        unknown = set(fields) - set(self._FIELDS)
+        if unknown:
+            raise ValueError(f"Unknown job fields: {', '.join(sorted(unknown))}")
+        fields['updated_at'] = time.time()
+        assignments = ', '.join(f"{name} = ?" for name in fields)
+        with self._connect() as db:
+            db.execute(f"UPDATE jobs SET {assignments} WHERE id = ?", (*fields.values(), job_id))
+
+    def load_inputs(self, job_id):
+        with self._connect() as db:
+            rows = db.execute(
+                "SELECT content FROM job_inputs WHERE job_id = ? ORDER BY position", (job_id,)
+            ).fetchall()
+        return [bytes(row[0]) for row in rows]
+
+    def drop_inputs(self, job_id):
+        with self._connect() as db:
+            db.execute("DELETE FROM job_inputs WHERE job_id = ?", (job_id,))
+
+    def purge(self, before):
+        with self._connect() as db:
+            rows = db.execute(
+                f"SELECT id, {', '.join(self._FIELDS)} FROM jobs"
+                " WHERE status IN ('done', 'failed') AND updated_at < ?", (before,)
+            ).fetchall()
+            expired = [dict(zip(('id',) + self._FIELDS, row)) for row in rows]
+            db.executemany("DELETE FROM job_inputs WHERE job_id = ?", [(job['id'],) for job in expired])
+            db.executemany("DELETE FROM jobs WHERE id = ?", [(job['id'],) for job in expired])
+        return expired
+
+def get_job_store():
+    """
+    Job store configured from the environment
+    """
+    return SQLiteJobStore()
+
+def run_job(store, job_id, storage=None):
+    """
+    Worker body: merge the job's inputs, report progress as receipts are
+    placed, and keep the result in output storage
+    """
+    job = store.get(job_id)
+    if job is None:
+        return
+
+    try:
+        store.update(job_id, status='running')
+        input_files = store.load_inputs(job_id)
+
+        # Multi-page inputs expand into more receipts than uploaded files,
+        # so the total follows the merge's own count
+        def progress(done, total):
+            store.update(job_id, processed=done, total=total)
+
+        stats = {}
+        merged_content = merge_pdf_bytes(input_files, stats=stats, progress=progress, **job['options'])
+        if not merged_content:
+            raise Exception("Output file is empty")
+
+        storage = storage or get_output_storage()
+        file_id = storage.save(merged_content, 'merged_receipts.pdf')
+        total = stats.get('receipts', job['total'])
+        store.update(job_id, status='done', processed=total, total=total, file_id=file_id, size=len(merged_content))
+        logger.info('job_finished', job_id=job_id, processed=stats.get('processed', 0), bytes=len(merged_content))
+    except Exception as e:
+        logger.error('job_failed', job_id=job_id, error=str(e), traceback=traceback.format_exc())
+        store.update(job_id, status='failed', error=str(e))
+    finally:
+        store.drop_inputs(job_id)
+    purge_jobs(store, storage)
+
+def purge_jobs(store, storage=None, ttl=None):
+    """
+    Drop jobs that finished more than ``ttl`` seconds ago (JOB_TTL_SECONDS
+    by default) together with their stored outputs. Run after every job,
+    on the job's thread.
+    """
+    ttl = JOB_TTL_SECONDS if ttl is None else ttl
+    if not ttl:
+        return
+    try:
+        expired = store.purge(time.time() - ttl)
+    except Exception as e:
+        # The next finished job tries again
+        logger.warning('job_purge_failed', error=str(e))
+        return
+    for job in expired:
+        if not job['file_id']:
+            continue
+        try:
+            storage = storage or get_output_storage()
+            storage.delete(job['file_id'])
+        except Exception as e:
+            logger.warning('job_output_delete_failed', job_id=job['id'], file_id=job['file_id'], error=str(e))
+    if expired:
+        logger.info('jobs_purged', jobs=len(expired))
+
+def start_job(store, job_id, storage=None):
+    """
+    Run the job on a background thread and return the thread. The thread
+    runs in a copy of the caller's context, so the job's log records keep
+    the request they belong to.
+    """
+    worker = threading.Thread(
+        target=contextvars.copy_context().run, args=(run_job, store, job_id, storage),
+        name=f"merge-job-{job_id}"
+    )
+    worker.start()
+    return worker
+
+def job_status(job):
+    """
+    Public view of a job record for status responses
+    """
+    status = {
+        'id': job['id'],
+        'status': job['status'],
+        'processed': job['processed'],
+        'total': job['total'],
+        'progress': round(job['processed'] / job['total'], 3) if job['total'] else 1.0,
+        'created_at': job['created_at'],
+        'updated_at': job['updated_at'],
+    }
+    if job['status'] == 'done':
+        status['file'] = {'id': job['file_id'], 'filename': 'merged_receipts.pdf', 'size': job['size']}
+    if job['status'] == 'failed':
+        status['error'] = job['error']
+    return status
@@ -0,0 +1,120 @@
+import contextvars
+import json
+import math
+import os
+import random
+import sys
+import time
+import uuid
+
+# Log settings. LOG_LEVEL is one of LEVELS; with LOG_DEBUG_SAMPLE_RATE
+# (read below, once env_number exists) above 0 that share of requests
+# also logs at debug level, whatever LOG_LEVEL says.
+LEVELS = {'debug': 10, 'info': 20, 'warning': 30, 'error': 40}
+LOG_LEVEL = os.environ.get('LOG_LEVEL', 'info').lower()
+
+# Request headers whose values never reach the log
+REDACTED_HEADERS = ('x-appwrite-key', 'authorization')
+
+_threshold = LEVELS.get(LOG_LEVEL, LEVELS['info'])
+
+# Per request state: id, sampled debug flag and the sink (context.log)
+_request = contextvars.ContextVar('log_request', default=None)
+
+class Logger:
+    """
+    Structured logger: every record is one JSON line with a level, an
+    event name and keyword fields. Fields are only serialized when the
+    level is enabled, so disabled debug calls cost a level check.
+    """
+
+    def __init__(self, name):
+        self.name = name
+
+    def debug_enabled(self):
+        """
+        True when debug records are emitted for the current request
+        """
+        if _threshold <= LEVELS['debug']:
+            return True
+        request = _request.get()
+        return request is not None and request['debug']
+
+    def debug(self, event, **fields):
+        if self.debug_enabled():
+            self._emit('debug', event, fields)
+
+    def info(self, event, **fields):
+        if _threshold <= LEVELS['info']:
+            self._emit('info', event, fields)
+
+    def warning(self, event, **fields):
+        if _threshold <= LEVELS['warning']:
+            self._emit('warning', event, fields)
+
+    def error(self, event, **fields):
+        self._emit('error', event, fields)
+
+    def _emit(self, level, event, fields):
+        request = _request.get()
+        record = {'ts': round(time.time(), 3), 'level': level, 'logger': self.name, 'event': event}
+        if request is not None:
+            record['request_id'] = request['id']
+        record.update(fields)
+        line = json.dumps(record, default=str, ensure_ascii=False, separators=(',', ':'))
+        sink = request['sink'] if request is not None else None
+        if sink is not None:
+            sink(line)
+        else:
+            print(line, file=sys.stdout)
+
+def get_logger(name):
+    return Logger(name)
+
+def env_number(name, default, minimum=0, maximum=None, cast=float):
+    """
+    Setting from the environment variable ``name``, ``default`` when it is
+    unset. A value that doesn't parse with ``cast``, isn't finite or lies
+    outside [``minimum``, ``maximum``] is logged as a warning and
+    ``default`` is used instead, so a typo never stops the function.
+    """
+    value = os.environ.get(name)
+    if value is None or not value.strip():
+        return default
+    try:
+        number = cast(value)
+        if not math.isfinite(number):
+            raise ValueError('not a finite number')
+        if (minimum is not None and number < minimum) or (maximum is not None and number > maximum):
+            raise ValueError(f'outside [{minimum}, {"inf" if maximum is None else maximum}]')
+    except ValueError as e:
+        get_logger(__name__).warning('setting_invalid', setting=name, value=value, default=default, error=str(e))
+        return default
+    return number
+
+LOG_DEBUG_SAMPLE_RATE = env_number('LOG_DEBUG_SAMPLE_RATE', 0.0, maximum=1.0)
+
+def start_request(sink=None, request_id=None):
+    """
+    Bind log records of the current context to one request: they carry
+    its ID and go to ``sink`` (e.g. the Appwrite ``context.log``). Decides
+    whether the request is sampled for debug logging.
+    Returns a token for end_request.
+    """
+    return _request.set({
+        'id': request_id or uuid.uuid4().hex[:16],
+        'debug': LOG_DEBUG_SAMPLE_RATE > 0 and random.random() < LOG_DEBUG_SAMPLE_RATE,
+        'sink': sink,
+    })
+
+def end_request(token):
+    _request.reset(token)
+
+def redact_headers(headers):
+    """
+    Copy of ``headers`` with credential headers masked
+    """
+    return {
+        key: '[redacted]' if key.lower() in REDACTED_HEADERS else value
+        for key, value in dict(headers or {}).items()
+    }
@@ -1,194 +1,736 @@
 import json
 import os
-import tempfile
+import re
 import base64
 import traceback
-from appwrite.client import Client
-from appwrite.services.storage import Storage
-from .utils import merge_pdfs
+from io import BytesIO
+from .cache import get_result_cache, request_cache_key
+from .jobs import get_job_store, job_status, start_job
+from .log import end_request, env_number, get_logger, redact_headers, start_request
+from .metrics import Metrics, measure
+from .pipeline import CONFIGURABLE_STAGES, InputError
+from .prepared import PreparedError, compose_prepared, get_prepared_store, prepare_pdf
+from .storage import StorageError, get_output_storage
+from .transport import (
+    is_binary_upload, query_params, raw_body, read_binary_upload, request_header, send_pdf,
+    wants_pdf_response,
+)
+from .utils import CROP_MODES, ENCODING_PROFILES, ENGINES, merge_pdf_bytes, parse_page_selection
+
+# Upper bound for the "workers" request field
+MAX_WORKERS = 16
+
+# "inline" returns the PDF in the response, "storage" uploads it and
+# returns only its file ID
+OUTPUT_MODES = ('inline', 'storage')
+
+# "sync" merges inside the request, "async" records a job and returns its ID
+MODES = ('sync', 'async')
+
+# Options forwarded to merge_pdf_bytes, the rest only shape the response
+MERGE_OPTIONS = ('workers', 'engine', 'use_cache', 'batch_render', 'stream', 'profile', 'crop', 'pages',
+                 'pipeline', 'concurrency', 'queue_size', 'sharded', 'render_timeout', 'timeout')
+
+# Upper bound for the "queue_size" request field
+MAX_QUEUE_SIZE = 256
+
+# Upper bound for the "timeout" and "render_timeout" request fields
+MAX_TIMEOUT_SECONDS = 900
+
+# Default time budget of a merge's renders in seconds, under the 900 s
+# function timeout so the partial result can still be saved and sent
+MERGE_TIMEOUT_SECONDS = env_number('MERGE_TIMEOUT_SECONDS', 840.0, maximum=MAX_TIMEOUT_SECONDS)
+
+# Options that change the merged output, part of the result cache key
+RESULT_OPTIONS = ('engine', 'profile', 'crop', 'pages', 'output')
+
+logger = get_logger(__name__)
+
+# GET /jobs/<id> returns job status, GET /jobs/<id>/result the merged PDF
+JOB_PATH = re.compile(r'^/jobs/([0-9a-f]{32})(/result)?/?$')
+
+# POST /prepare stores one PDF's receipts and returns a token, POST /compose
+# lays out the receipts of a list of tokens (also ?operation=prepare|compose)
+OPERATIONS = ('prepare', 'compose')
+OPERATION_PATH = re.compile(r'^/(prepare|compose)/?$')
+PREPARED_TOKEN = re.compile(r'^[0-9a-f]{32}$')
 
 def main(context):
     """
     Appwrite Function entry point
     """
+    # Log records of this request go to the execution log, tagged with its ID
+    token = start_request(sink=context.log)
+    try:
+        return _handle_request(context)
+    finally:
+        end_request(token)
+
+def _handle_request(context):
     # Enhanced CORS headers
     headers = {
         'Access-Control-Allow-Origin': '*',
         'Access-Control-Allow-Methods': 'POST, OPTIONS, GET',
-        'Access-Control-Allow-Headers': 'Content-Type, X-Appwrite-Project, X-Appwrite-Response-Format, X-Appwrite-Key, Authorization',
+        'Access-Control-Allow-Headers': 'Content-Type, Accept, X-Appwrite-Project, X-Appwrite-Response-Format, X-Appwrite-Key, Authorization, Idempotency-Key, If-None-Match',
         'Access-Control-Max-Age': '86400',
         'Content-Type': 'application/json'
     }
     
-    # Log request details for debugging
-    context.log(f"Method: {context.req.method}")
-    context.log(f"Headers: {dict(context.req.headers)}")
-    context.log(f"Body length: {len(context.req.body) if context.req.body else 0}")
+    # Request details only for debug level or sampled requests
+    if logger.debug_enabled():
+        logger.debug(
+            'request_received', method=context.req.method,
+            headers=redact_headers(context.req.headers), body_bytes=len(raw_body(context.req))
+        )
     
     # Handle preflight OPTIONS request
     if context.req.method == 'OPTIONS':
-        context.log("Handling OPTIONS preflight request")
         return context.res.empty(200, headers)
     
     try:
+        if context.req.method == 'GET':
+            job_response = _handle_job_request(context, headers)
+            if job_response is not None:
+                return job_response
+
         # Only allow POST method
         if context.req.method != 'POST':
-            context.log(f"Method not allowed: {context.req.method}")
+            logger.info('method_not_allowed', method=context.req.method)
             return context.res.json({
                 'error': f'Method not allowed. Use POST. Current method: {context.req.method}'
             }, 405, headers)
 
-        # Get and parse request body
-        try:
-            # Try different ways to get the request body
-            if hasattr(context.req, 'body_json') and context.req.body_json:
-                data = context.req.body_json
-                context.log("Using body_json")
-            elif hasattr(context.req, 'body') and context.req.body:
-                data = json.loads(context.req.body)
-                context.log("Parsing body as JSON")
-            else:
-                context.log("No body found in request")
+        operation = _request_operation(context.req)
+        if operation == 'compose':
+            return _handle_compose(context, headers)
+
+        content_type = request_header(context.req, 'content-type')
+        if is_binary_upload(content_type):
+            # Raw application/pdf or multipart/form-data upload, no base64
+            try:
+                input_files, data = read_binary_upload(context.req, content_type)
+            except ValueError as e:
+                logger.warning('invalid_upload', error=str(e))
                 return context.res.json({
-                    'error': 'No request body found'
+                    'error': f'Invalid upload: {str(e)}'
                 }, 400, headers)
-                
-        except json.JSONDecodeError as e:
-            context.log(f"JSON decode error: {str(e)}")
-            return context.res.json({
-                'error': f'Invalid JSON in request body: {str(e)}'
-            }, 400, headers)
 
-        context.log(f"Request data keys: {list(data.keys()) if isinstance(data, dict) else 'Not a dict'}")
+            for i, file_content in enumerate(input_files):
+                logger.debug('file_received', index=i, bytes=len(file_content))
+                if not file_content.startswith(b'%PDF'):
+                    return context.res.json({
+                        'error': f'File at index {i} is not a valid PDF'
+                    }, 400, headers)
+            encoded_files = None
+        else:
+            data, encoded_files, error_response = _read_json_request(context, headers)
+            if error_response is not None:
+                return error_response
 
-        # Validate required fields
-        if not isinstance(data, dict):
-            return context.res.json({
-                'error': 'Request body must be a JSON object'
-            }, 400, headers)
-            
-        if 'files' not in data:
-            return context.res.json({
-                'error': 'Field "files" is required. Provide array of base64 encoded PDF files.',
-                'received_keys': list(data.keys())
-            }, 400, headers)
+        options, error = _parse_merge_options(data)
+        if error:
+            return context.res.json({'error': error}, 400, headers)
 
-        files_data = data['files']
-        if not isinstance(files_data, list):
-            return context.res.json({
-                'error': 'Files must be an array'
-            }, 400, headers)
-            
-        if len(files_data) == 0:
-            return context.res.json({
-                'error': 'Files array cannot be empty'
-            }, 400, headers)
+        if operation == 'prepare':
+            if encoded_files is not None:
+                input_files, error_response = _decode_files(context, headers, encoded_files)
+                if error_response is not None:
+                    return error_response
+            return _handle_prepare(context, headers, input_files, options)
 
-        context.log(f"Processing {len(files_data)} files")
+        # Opt-in instrumentation of the synchronous merge
+        metrics = Metrics() if options['metrics'] and options['mode'] == 'sync' else None
 
-        # Create temporary directory for processing
-        with tempfile.TemporaryDirectory() as temp_dir:
-            context.log(f"Created temp directory: {temp_dir}")
-            input_files = []
-            
-            # Process each file
-            for i, file_data in enumerate(files_data):
-                context.log(f"Processing file {i+1}/{len(files_data)}")
-                
-                if not isinstance(file_data, dict):
-                    return context.res.json({
-                        'error': f'Invalid file data at index {i}. Expected object, got {type(file_data)}'
-                    }, 400, headers)
-                
-                if 'content' not in file_data:
-                    return context.res.json({
-                        'error': f'Missing "content" field in file at index {i}',
-                        'available_keys': list(file_data.keys())
-                    }, 400, headers)
+        decode = None
+        if encoded_files is not None:
+            if options['pipeline'] and options['engine'] == 'raster' and options['mode'] == 'sync':
+                # The pipeline's decode stage overlaps base64 decoding with rendering
+                input_files, decode = encoded_files, _decode_file
+            else:
+                input_files, error_response = _decode_files(context, headers, encoded_files, metrics)
+                if error_response is not None:
+                    return error_response
 
-                filename = file_data.get('filename', f'file_{i}.pdf')
-                if not filename.lower().endswith('.pdf'):
-                    filename += '.pdf'
+        # Repeats of a recent sync request are answered from the result cache
+        result_cache = get_result_cache() if options['mode'] == 'sync' and options['result_cache'] else None
+        cache_key = request_key = cached = None
+        if result_cache is not None:
+            if decode is not None:
+                # The key hashes the PDFs, not their base64 text, so decode
+                # up front instead of in the pipeline
+                input_files, error_response = _decode_files(context, headers, input_files, metrics)
+                if error_response is not None:
+                    return error_response
+                decode = None
+            request_key = request_cache_key(input_files, **{name: options[name] for name in RESULT_OPTIONS})
+            # The same request always gives the same receipts, so the ETag is
+            # known before merging and a match needs no merge at all
+            etag = f'"{request_key[:32]}"'
+            if _etag_matches(request_header(context.req, 'if-none-match'), etag):
+                logger.info('not_modified', etag=etag)
+                return context.res.send('', 304, dict(headers, ETag=etag))
 
-                try:
-                    # Decode base64 content
-                    file_content = base64.b64decode(file_data['content'])
-                    context.log(f"Decoded file {i}, size: {len(file_content)} bytes")
-                    
-                    # Validate it's a PDF by checking header
-                    if not file_content.startswith(b'%PDF'):
-                        return context.res.json({
-                            'error': f'File at index {i} is not a valid PDF'
-                        }, 400, headers)
-                    
-                    # Save to temporary file
-                    file_path = os.path.join(temp_dir, f"input_{i}_{filename}")
-                    with open(file_path, 'wb') as f:
-                        f.write(file_content)
-                    
-                    input_files.append(file_path)
-                    context.log(f"Saved file {i} to {file_path}")
-                    
-                except Exception as e:
-                    context.log(f"Error processing file {i}: {str(e)}")
-                    return context.res.json({
-                        'error': f'Failed to decode file at index {i}: {str(e)}'
-                    }, 400, headers)
+            idempotency_key = request_header(context.req, 'idempotency-key')
+            cache_key = f'idempotency:{idempotency_key}' if idempotency_key else request_key
+            cached = result_cache.get(cache_key)
+            if cached is not None and cached['request'] != request_key:
+                logger.warning('idempotency_key_reused', idempotency_key=idempotency_key)
+                return context.res.json({
+                    'error': 'Idempotency-Key was already used for a different request'
+                }, 422, headers)
 
-            # Create output file path
-            output_path = os.path.join(temp_dir, 'merged_receipts.pdf')
-            context.log(f"Output path: {output_path}")
-            
+        if options['mode'] == 'async':
+            # Validated above; record the job and let a worker thread merge it
+            store = get_job_store()
+            job_id = store.create(input_files, _merge_kwargs(options))
+            start_job(store, job_id, get_output_storage(request_header(context.req, 'x-appwrite-key') or None))
+            logger.info('job_queued', job_id=job_id, files=len(input_files))
+            return context.res.json({
+                'success': True,
+                'message': f'Queued merge of {len(input_files)} PDFs',
+                'job': job_status(store.get(job_id)),
+                'status_url': f'/jobs/{job_id}',
+                'result_url': f'/jobs/{job_id}/result'
+            }, 202, headers)
+
+        if cached is not None:
+            merged_content, stats = cached['content'], dict(cached['stats'], result_cache='hit')
+            logger.info('result_cache_hit', files=len(input_files), bytes=len(merged_content))
+        else:
             # Merge PDFs
             try:
-                context.log("Starting PDF merge process")
-                merge_pdfs(input_files, output_path)
-                context.log("PDF merge completed successfully")
-                
-                # Verify output file exists and has content
-                if not os.path.exists(output_path):
-                    raise Exception("Output file was not created")
-                    
-                output_size = os.path.getsize(output_path)
-                if output_size == 0:
+                stats = {}
+                merged_content = merge_pdf_bytes(
+                    input_files, stats=stats, decode=decode, metrics=metrics, **_merge_kwargs(options)
+                )
+
+                if not merged_content:
                     raise Exception("Output file is empty")
-                    
-                context.log(f"Output file size: {output_size} bytes")
-                
+
+                logger.info('merge_succeeded', files=len(input_files), bytes=len(merged_content))
+
+            except InputError as e:
+                logger.warning('invalid_input', index=e.index, error=str(e))
+                return context.res.json({'error': str(e)}, 400, headers)
             except Exception as e:
-                context.log(f"PDF merge error: {str(e)}")
-                context.log(f"Traceback: {traceback.format_exc()}")
+                logger.error('merge_error', error=str(e), traceback=traceback.format_exc())
                 return context.res.json({
                     'error': f'Failed to merge PDFs: {str(e)}'
                 }, 500, headers)
 
-            # Read merged PDF and encode to base64
-            try:
-                with open(output_path, 'rb') as f:
-                    merged_content = f.read()
-                
-                context.log(f"Read merged file, size: {len(merged_content)} bytes")
+        if result_cache is not None and not stats.get('timeouts'):
+            # A result cut short by a time limit is not the request's result
+            headers['ETag'] = etag
+            headers['X-Result-Cache'] = 'miss' if cached is None else 'hit'
+            headers['Access-Control-Expose-Headers'] = 'ETag, X-Result-Cache'
+
+        if options['output'] == 'storage':
+            if cached is not None:
+                # Same stored file as the first request, no duplicate upload
+                stored_file = cached['file']
+            else:
+                try:
+                    storage = get_output_storage(request_header(context.req, 'x-appwrite-key') or None)
+                    with measure(metrics, 'store', len(merged_content)):
+                        file_id = storage.save(merged_content, 'merged_receipts.pdf')
+                    logger.info('output_stored', file_id=file_id, storage=storage.name)
+                except StorageError as e:
+                    logger.error('storage_error', error=str(e))
+                    return context.res.json({
+                        'error': f'Failed to store merged PDF: {str(e)}'
+                    }, 500, headers)
+
+                stored_file = {
+                    'id': file_id,
+                    'filename': 'merged_receipts.pdf',
+                    'size': len(merged_content),
+                    **storage.describe()
+                }
+                _remember_result(result_cache, cache_key, request_key, merged_content, stats, stored_file)
+
+            response = {
+                'success': True,
+                'message': f'Successfully merged {len(input_files)} PDFs',
+                'file': stored_file
+            }
+            if 'profile' in stats:
+                response['profile'] = stats['profile']
+            if _receipt_summary(stats) is not None:
+                response['receipts'] = _receipt_summary(stats)
+            if options['include_stats']:
+                response['stats'] = stats
+            _attach_metrics(context, response, metrics)
+            return context.res.json(response, 200, headers)
+
+        if cached is None:
+            _remember_result(result_cache, cache_key, request_key, merged_content, stats)
+
+        if wants_pdf_response(context.req):
+            # Client sent Accept: application/pdf, skip base64 and JSON
+            return send_pdf(
+                context.res, merged_content, headers,
+                stats=stats if options['include_stats'] else None,
+                profile=stats.get('profile'),
+                metrics=_attach_metrics(context, None, metrics),
+                receipts=_receipt_summary(stats, with_errors=False)
+            )
+
+        # Encode merged PDF to base64
+        try:
+            with measure(metrics, 'response', len(merged_content)) as encoded:
                 merged_base64 = base64.b64encode(merged_content).decode('utf-8')
-                
-                return context.res.json({
-                    'success': True,
-                    'message': f'Successfully merged {len(input_files)} PDFs',
-                    'file': {
-                        'filename': 'merged_receipts.pdf',
-                        'content': merged_base64,
-                        'size': len(merged_content)
-                    }
-                }, 200, headers)
-                
-            except Exception as e:
-                context.log(f"File read error: {str(e)}")
-                return context.res.json({
-                    'error': f'Failed to read merged PDF: {str(e)}'
-                }, 500, headers)
+                encoded['bytes_out'] = len(merged_base64)
+            
+            response = {
+                'success': True,
+                'message': f'Successfully merged {len(input_files)} PDFs',
+                'file': {
+                    'filename': 'merged_receipts.pdf',
+                    'content': merged_base64,
+                    'size': len(merged_content)
+                }
+            }
+            if 'profile' in stats:
+                response['profile'] = stats['profile']
+            if _receipt_summary(stats) is not None:
+                response['receipts'] = _receipt_summary(stats)
+            if options['include_stats']:
+                response['stats'] = stats
+            _attach_metrics(context, response, metrics)
+            return context.res.json(response, 200, headers)
+            
+        except Exception as e:
+            logger.error('encode_error', error=str(e))
+            return context.res.json({
+                'error': f'Failed to encode merged PDF: {str(e)}'
+            }, 500, headers)
 
     except Exception as e:
-        context.log(f"Unexpected error: {str(e)}")
-        context.log(f"Traceback: {traceback.format_exc()}")
+        logger.error('unexpected_error', error=str(e), traceback=traceback.format_exc())
         return context.res.json({
             'error': f'Internal server error: {str(e)}'
-        }, 500, headers)
\ No newline at end of file
+        }, 500, headers)
+
+def _read_json_request(context, headers):
+    """
+    Parse the JSON request body and check its file entries.
+    Returns ``(data, encoded_files, error_response)`` where encoded_files
+    are the base64 contents, see _decode_files; when error_response is set
+    it should be returned to the client as is.
+    """
+    # Get and parse request body
+    try:
+        # Try different ways to get the request body
+        if hasattr(context.req, 'body_json') and context.req.body_json:
+            data = context.req.body_json
+        elif hasattr(context.req, 'body') and context.req.body:
+            data = json.loads(context.req.body)
+        else:
+            logger.warning('missing_body')
+            return None, None, context.res.json({
+                'error': 'No request body found'
+            }, 400, headers)
+            
+    except json.JSONDecodeError as e:
+        logger.warning('invalid_json', error=str(e))
+        return None, None, context.res.json({
+            'error': f'Invalid JSON in request body: {str(e)}'
+        }, 400, headers)
+
+    # Validate required fields
+    if not isinstance(data, dict):
+        return None, None, context.res.json({
+            'error': 'Request body must be a JSON object'
+        }, 400, headers)
+        
+    if 'files' not in data:
+        return None, None, context.res.json({
+            'error': 'Field "files" is required. Provide array of base64 encoded PDF files.',
+            'received_keys': list(data.keys())
+        }, 400, headers)
+
+    files_data = data['files']
+    if not isinstance(files_data, list):
+        return None, None, context.res.json({
+            'error': 'Files must be an array'
+        }, 400, headers)
+        
+    if len(files_data) == 0:
+        return None, None, context.res.json({
+            'error': 'Files array cannot be empty'
+        }, 400, headers)
+
+    logger.debug('files_listed', files=len(files_data), keys=list(data.keys()))
+
+    encoded_files = []
+    for i, file_data in enumerate(files_data):
+        if not isinstance(file_data, dict):
+            return None, None, context.res.json({
+                'error': f'Invalid file data at index {i}. Expected object, got {type(file_data)}'
+            }, 400, headers)
+        
+        if 'content' not in file_data:
+            return None, None, context.res.json({
+                'error': f'Missing "content" field in file at index {i}',
+                'available_keys': list(file_data.keys())
+            }, 400, headers)
+
+        encoded_files.append(file_data['content'])
+
+    return data, encoded_files, None
+
+def _decode_files(context, headers, encoded_files, metrics=None):
+    """
+    Decode every base64 file in memory, nothing is written to disk.
+    Returns ``(input_files, error_response)``.
+    """
+    input_files = []
+    for i, content in enumerate(encoded_files):
+        try:
+            with measure(metrics, 'decode', len(content)) as decoded:
+                file_content = _decode_file(i, content)
+                decoded['bytes_out'] = len(file_content)
+            logger.debug('file_decoded', index=i, bytes=len(file_content))
+            
+            # Validate it's a PDF by checking header
+            if not file_content.startswith(b'%PDF'):
+                return None, context.res.json({
+                    'error': f'File at index {i} is not a valid PDF'
+                }, 400, headers)
+            
+            input_files.append(file_content)
+            
+        except InputError as e:
+            logger.warning('invalid_input', index=i, error=str(e))
+            return None, context.res.json({'error': str(e)}, 400, headers)
+
+    return input_files, None
+
+def _decode_file(index, content):
+    """
+    Bytes of one base64 file, InputError if it doesn't decode.
+    Also the decode stage of the merge pipeline.
+    """
+    try:
+        return base64.b64decode(content)
+    except Exception as e:
+        raise InputError(index, f'Failed to decode file at index {index}: {str(e)}') from e
+
+def _parse_merge_options(data):
+    """
+    Read the optional merge settings from the request body.
+    Returns ``(options, error_message)``.
+    """
+    # Unset: one process, or the CPU count for sharded merges
+    workers = data.get('workers', os.environ.get('MERGE_WORKERS'))
+    if workers is not None:
+        try:
+            workers = int(workers)
+        except (TypeError, ValueError):
+            return None, 'Field "workers" must be an integer'
+        if not 1 <= workers <= MAX_WORKERS:
+            return None, f'Field "workers" must be between 1 and {MAX_WORKERS}'
+
+    engine = data.get('engine', os.environ.get('MERGE_ENGINE', 'raster'))
+    if engine not in ENGINES:
+        return None, f'Field "engine" must be one of: {", ".join(ENGINES)}'
+
+    output = data.get('output', 'inline')
+    if output not in OUTPUT_MODES:
+        return None, f'Field "output" must be one of: {", ".join(OUTPUT_MODES)}'
+
+    profile = data.get('profile', os.environ.get('MERGE_PROFILE', 'rgb'))
+    if profile not in ENCODING_PROFILES:
+        return None, f'Field "profile" must be one of: {", ".join(ENCODING_PROFILES)}'
+
+    crop = data.get('crop', os.environ.get('MERGE_CROP', 'default'))
+    if crop not in CROP_MODES:
+        return None, f'Field "crop" must be one of: {", ".join(CROP_MODES)}'
+
+    try:
+        pages = parse_page_selection(data.get('pages', os.environ.get('MERGE_PAGES', 'all')))
+    except ValueError:
+        return None, 'Field "pages" must be "all", "first", "last", page numbers or ranges like "1-3,5"'
+
+    mode = data.get('mode', 'sync')
+    if mode not in MODES:
+        return None, f'Field "mode" must be one of: {", ".join(MODES)}'
+
+    concurrency = data.get('concurrency', _parse_concurrency(os.environ.get('MERGE_PIPELINE_CONCURRENCY', '')))
+    if not isinstance(concurrency, dict) or not all(
+        stage in CONFIGURABLE_STAGES and isinstance(threads, int) and not isinstance(threads, bool)
+        and 1 <= threads <= MAX_WORKERS
+        for stage, threads in concurrency.items()
+    ):
+        return None, (
+            f'Field "concurrency" must map stages ({", ".join(CONFIGURABLE_STAGES)}) '
+            f'to thread counts between 1 and {MAX_WORKERS}'
+        )
+
+    queue_size = data.get('queue_size', os.environ.get('MERGE_PIPELINE_QUEUE_SIZE') or None)
+    if queue_size is not None:
+        try:
+            queue_size = int(queue_size)
+        except (TypeError, ValueError):
+            return None, 'Field "queue_size" must be an integer'
+        if not 1 <= queue_size <= MAX_QUEUE_SIZE:
+            return None, f'Field "queue_size" must be between 1 and {MAX_QUEUE_SIZE}'
+
+    # Unset: RENDER_TIMEOUT_SECONDS, validated when src.utils loads
+    render_timeout, error = _parse_seconds(data.get('render_timeout'), 'render_timeout')
+    if error:
+        return None, error
+    timeout, error = _parse_seconds(data.get('timeout', MERGE_TIMEOUT_SECONDS), 'timeout')
+    if error:
+        return None, error
+
+    return {
+        'mode': mode,
+        'workers': workers,
+        'engine': engine,
+        'use_cache': bool(data.get('cache', True)),
+        'result_cache': bool(data.get('result_cache', True)),
+        'batch_render': bool(data.get('batch_render', os.environ.get('MERGE_BATCH_RENDER', '0') == '1')),
+        'stream': bool(data.get('stream', os.environ.get('MERGE_STREAM', '0') == '1')),
+        'profile': profile,
+        'crop': crop,
+        'pages': pages,
+        'pipeline': bool(data.get('pipeline', os.environ.get('MERGE_PIPELINE', '0') == '1')),
+        'concurrency': concurrency,
+        'queue_size': queue_size,
+        'sharded': bool(data.get('sharded', os.environ.get('MERGE_SHARDED', '0') == '1')),
+        'render_timeout': render_timeout,
+        'timeout': timeout,
+        'metrics': bool(data.get('metrics', os.environ.get('MERGE_METRICS', '0') == '1')),
+        'output': output,
+        'include_stats': bool(data.get('include_stats', False)),
+    }, None
+
+def _parse_concurrency(value):
+    """
+    Stage thread counts from a "rasterize=4,encode=2" string, as set in
+    MERGE_PIPELINE_CONCURRENCY. Malformed entries are left for validation.
+    """
+    concurrency = {}
+    for entry in filter(None, (part.strip() for part in value.split(','))):
+        stage, _, threads = entry.partition('=')
+        try:
+            concurrency[stage.strip()] = int(threads)
+        except ValueError:
+            concurrency[stage.strip()] = threads
+    return concurrency
+
+def _parse_seconds(value, field):
+    """
+    A time limit field as ``(seconds, error_message)``; None stays None
+    (the default applies) and 0 turns the limit off
+    """
+    if value is None:
+        return None, None
+    try:
+        seconds = float(value)
+    except (TypeError, ValueError):
+        return None, f'Field "{field}" must be a number of seconds'
+    if isinstance(value, bool) or not 0 <= seconds <= MAX_TIMEOUT_SECONDS:
+        return None, f'Field "{field}" must be between 0 and {MAX_TIMEOUT_SECONDS} seconds'
+    return seconds, None
+
+def _receipt_summary(stats, with_errors=True):
+    """
+    Receipt counts of a raster merge for the response: total, placed,
+    skipped (the list with reasons) and timeouts. Without ``with_errors``
+    the skipped entries leave out the error messages, for the compact
+    X-Merge-Receipts header. None for engines that don't report skipped
+    receipts.
+    """
+    if 'skipped' not in stats:
+        return None
+    skipped = stats['skipped']
+    if not with_errors:
+        skipped = [{name: value for name, value in entry.items() if name != 'error'} for entry in skipped]
+    return {
+        'total': stats.get('receipts'),
+        'placed': stats.get('processed'),
+        'skipped': skipped,
+        'timeouts': stats.get('timeouts', 0),
+    }
+
+def _attach_metrics(context, response, metrics):
+    """
+    Emit the run's metrics as one structured log line and add the full
+    ``metrics`` block to ``response`` when given. Returns the summary
+    (the log line's fields) or None when metrics are off.
+    """
+    if metrics is None:
+        return None
+    logger.info('merge_metrics', **metrics.summary())
+    if response is not None:
+        response['metrics'] = metrics.as_dict()
+    return metrics.summary()
+
+def _etag_matches(if_none_match, etag):
+    """
+    True when an If-None-Match header lists ``etag`` (weak or strong) or is "*"
+    """
+    for candidate in if_none_match.split(','):
+        candidate = candidate.strip()
+        if candidate == '*' or candidate.removeprefix('W/') == etag:
+            return True
+    return False
+
+def _remember_result(result_cache, cache_key, request_key, merged_content, stats, stored_file=None):
+    """
+    Keep a merge result so a repeat of the request is answered without merging
+    """
+    if result_cache is None or stats.get('timeouts'):
+        # A merge cut short by a time limit may go through next time
+        return
+    entry = {'request': request_key, 'content': merged_content, 'stats': stats}
+    if stored_file is not None:
+        entry['file'] = stored_file
+    result_cache.put(cache_key, entry)
+
+def _merge_kwargs(options):
+    return {name: options[name] for name in MERGE_OPTIONS}
+
+def _request_operation(req):
+    """
+    "prepare", "compose" or None for a plain merge
+    """
+    match = OPERATION_PATH.match(getattr(req, 'path', '') or '')
+    if match:
+        return match.group(1)
+    operation = query_params(req).get('operation')
+    return operation if operation in OPERATIONS else None
+
+def _handle_prepare(context, headers, input_files, options):
+    """
+    Render, crop and encode one PDF now and return a token for compose
+    """
+    if len(input_files) != 1:
+        return context.res.json({
+            'error': f'prepare takes exactly one PDF, got {len(input_files)}'
+        }, 400, headers)
+
+    try:
+        prepared = prepare_pdf(
+            input_files[0], get_prepared_store(), use_cache=options['use_cache'],
+            profile=options['profile'], crop=options['crop'], pages=options['pages'],
+            render_timeout=options['render_timeout'], timeout=options['timeout']
+        )
+    except PreparedError as e:
+        logger.warning('prepare_failed', error=str(e))
+        return context.res.json({'error': str(e)}, 400, headers)
+    except Exception as e:
+        logger.error('prepare_error', error=str(e), traceback=traceback.format_exc())
+        return context.res.json({
+            'error': f'Failed to prepare PDF: {str(e)}'
+        }, 500, headers)
+
+    return context.res.json({'success': True, **prepared}, 200, headers)
+
+def _handle_compose(context, headers):
+    """
+    Lay out the receipts of the request's ``tokens`` on the grid.
+    Only drawing and writing the PDF happen here, the rendering was done
+    by prepare.
+    """
+    try:
+        if getattr(context.req, 'body_json', None):
+            data = context.req.body_json
+        else:
+            data = json.loads(getattr(context.req, 'body', None) or '{}')
+    except json.JSONDecodeError as e:
+        return context.res.json({'error': f'Invalid JSON in request body: {str(e)}'}, 400, headers)
+
+    tokens = data.get('tokens') if isinstance(data, dict) else None
+    if not isinstance(tokens, list) or not tokens or not all(
+        isinstance(token, str) and PREPARED_TOKEN.match(token) for token in tokens
+    ):
+        return context.res.json({
+            'error': 'Field "tokens" must be a non-empty array of tokens returned by prepare'
+        }, 400, headers)
+
+    try:
+        output = BytesIO()
+        stats = compose_prepared(tokens, output, get_prepared_store())
+        merged_content = output.getvalue()
+    except KeyError as e:
+        missing = e.args[0]
+        logger.warning('compose_missing_tokens', tokens=missing)
+        return context.res.json({
+            'error': 'Unknown or expired tokens, prepare these PDFs again',
+            'tokens': missing
+        }, 404, headers)
+    except Exception as e:
+        logger.error('compose_error', error=str(e), traceback=traceback.format_exc())
+        return context.res.json({
+            'error': f'Failed to compose PDF: {str(e)}'
+        }, 500, headers)
+
+    include_stats = bool(data.get('include_stats', False))
+    if wants_pdf_response(context.req):
+        return send_pdf(context.res, merged_content, headers, stats=stats if include_stats else None)
+
+    response = {
+        'success': True,
+        'message': f'Successfully composed {stats["receipts"]} receipts',
+        'file': {
+            'filename': 'merged_receipts.pdf',
+            'content': base64.b64encode(merged_content).decode('utf-8'),
+            'size': len(merged_content)
+        }
+    }
+    if include_stats:
+        response['stats'] = stats
+    return context.res.json(response, 200, headers)
+
+def _handle_job_request(context, headers):
+    """
+    Serve ``GET /jobs/<id>`` and ``GET /jobs/<id>/result``, also reachable
+    as ``?job=<id>`` and ``?job=<id>&result=true``. Returns None when the
+    request isn't about a job.
+    """
+    match = JOB_PATH.match(getattr(context.req, 'path', '') or '')
+    query = query_params(context.req)
+    if match:
+        job_id, want_result = match.group(1), bool(match.group(2))
+    elif query.get('job'):
+        job_id, want_result = query['job'], str(query.get('result', '')).lower() in ('1', 'true')
+    else:
+        return None
+
+    job = get_job_store().get(job_id)
+    if job is None:
+        return context.res.json({'error': f'Job {job_id} not found'}, 404, headers)
+
+    status = job_status(job)
+    if not want_result:
+        return context.res.json({'job': status}, 200, headers)
+
+    if job['status'] != 'done':
+        return context.res.json({
+            'error': f'Job {job_id} is {job["status"]}, no result yet',
+            'job': status
+        }, 409, headers)
+
+    try:
+        storage = get_output_storage(request_header(context.req, 'x-appwrite-key') or None)
+        merged_content = storage.load(job['file_id'])
+    except StorageError as e:
+        logger.error('storage_error', error=str(e))
+        return context.res.json({
+            'error': f'Failed to load merged PDF: {str(e)}'
+        }, 500, headers)
+
+    if wants_pdf_response(context.req):
+        return send_pdf(context.res, merged_content, headers)
+    return context.res.json({
+        'success': True,
+        'job': status,
+        'file': {
+            'filename': 'merged_receipts.pdf',
+            'content': base64.b64encode(merged_content).decode('utf-8'),
+            'size': len(merged_content)
+        }
+    }, 200, headers)
@@ -0,0 +1,144 @@
+import os
+import threading
+import time
+from contextlib import contextmanager, nullcontext
+
+try:
+    import resource
+except ImportError:  # Not available on Windows
+    resource = None
+
+def cpu_time():
+    """
+    CPU seconds of the calling thread plus those of finished child
+    processes (poppler). Children are process wide, so with several
+    threads rendering at once their time can land in a neighbour's sample.
+    """
+    times = os.times()
+    return time.thread_time() + times.children_user + times.children_system
+
+def peak_rss_mb():
+    """
+    High-water mark of resident memory, in MB, of this process and of its
+    largest finished child
+    """
+    if resource is None:
+        return None, None
+    # ru_maxrss is in kilobytes on Linux
+    own = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024
+    return round(own, 1), round(children, 1)
+
+def process_memory_mb(pid):
+    """
+    Current and peak resident memory, in MB, of a running process as
+    ``{'rss_mb', 'peak_rss_mb'}`` read from /proc, None when unavailable
+    """
+    fields = {}
+    try:
+        with open(f'/proc/{pid}/status') as f:
+            for line in f:
+                name, _, value = line.partition(':')
+                if name in ('VmRSS', 'VmHWM'):
+                    fields[name] = round(int(value.split()[0]) / 1024, 1)
+    except OSError:
+        return None
+    return {'rss_mb': fields.get('VmRSS'), 'peak_rss_mb': fields.get('VmHWM')}
+
+class Metrics:
+    """
+    Opt-in measurements of one merge: wall and CPU seconds plus bytes in
+    and out per stage (summed over every time the stage runs) and per
+    receipt, with the peak RSS seen when each was recorded.
+    Safe to record from several threads.
+    """
+
+    def __init__(self):
+        self.stages = {}
+        self.receipts = []
+        self.started = time.perf_counter()
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def stage(self, name, bytes_in=0):
+        """
+        Measure the ``with`` block as one run of stage ``name``. The block
+        may set ``bytes_out`` on the yielded dict, which also receives the
+        block's ``wall_seconds`` and ``cpu_seconds`` when it ends.
+        """
+        sample = {'bytes_out': 0}
+        wall_started = time.perf_counter()
+        cpu_started = cpu_time()
+        try:
+            yield sample
+        finally:
+            sample['wall_seconds'] = time.perf_counter() - wall_started
+            sample['cpu_seconds'] = cpu_time() - cpu_started
+            self.record(name, sample['wall_seconds'], sample['cpu_seconds'], bytes_in, sample['bytes_out'])
+
+    def record(self, name, wall_seconds, cpu_seconds, bytes_in=0, bytes_out=0):
+        """
+        Add one run of stage ``name`` measured elsewhere (e.g. in a pool worker)
+        """
+        own_rss, children_rss = peak_rss_mb()
+        with self._lock:
+            stage = self.stages.setdefault(name, {
+                'count': 0, 'wall_seconds': 0.0, 'cpu_seconds': 0.0, 'bytes_in': 0, 'bytes_out': 0,
+            })
+            stage['count'] += 1
+            stage['wall_seconds'] += wall_seconds
+            stage['cpu_seconds'] += cpu_seconds
+            stage['bytes_in'] += bytes_in
+            stage['bytes_out'] += bytes_out
+            stage['peak_rss_mb'] = own_rss
+            stage['children_peak_rss_mb'] = children_rss
+
+    def receipt(self, index, page, **fields):
+        """
+        Record one receipt; ``fields`` hold its per stage timings and sizes
+        """
+        own_rss, _ = peak_rss_mb()
+        entry = {'input': index, 'page': page, **fields, 'peak_rss_mb': own_rss}
+        with self._lock:
+            self.receipts.append(entry)
+
+    def as_dict(self):
+        """
+        The ``metrics`` block of a response
+        """
+        own_rss, children_rss = peak_rss_mb()
+        with self._lock:
+            stages = {
+                name: {
+                    key: round(value, 4) if isinstance(value, float) else value
+                    for key, value in stage.items()
+                }
+                for name, stage in self.stages.items()
+            }
+            receipts = [
+                {key: round(value, 4) if isinstance(value, float) else value for key, value in entry.items()}
+                for entry in self.receipts
+            ]
+        return {
+            'wall_seconds': round(time.perf_counter() - self.started, 4),
+            'peak_rss_mb': own_rss,
+            'children_peak_rss_mb': children_rss,
+            'stages': stages,
+            'receipts': receipts,
+        }
+
+    def summary(self):
+        """
+        Totals and stages without the per receipt list, for the log line
+        """
+        summary = self.as_dict()
+        summary['receipts'] = len(summary['receipts'])
+        return summary
+
+def measure(metrics, name, bytes_in=0):
+    """
+    ``metrics.stage(name, bytes_in)``, or a no-op context when metrics are off
+    """
+    if metrics is None:
+        return nullcontext({'bytes_out': 0})
+    return metrics.stage(name, bytes_in)
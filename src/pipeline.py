@@ -0,0 +1,431 @@
+import contextvars
+import queue
+import threading
+import time
+from io import BytesIO
+
+from .cache import get_render_cache
+from .log import get_logger
+from .metrics import measure
+from .utils import (
+    ENCODING_PROFILES, TIMEOUT_REASONS, RenderBudget, _draw_encoded_page, _encode_receipt, _image_bytes,
+    _output_label, _output_size, _page_numbers, _render_cache_key, _render_receipt, _report_progress,
+    _scale_to_cell, _skipped_receipt,
+)
+
+logger = get_logger(__name__)
+
+# Pipeline stages in order. "dispatch" (expanding inputs into receipts in
+# input order) and "place" (drawing on the canvas) are single threaded; the
+# others run on as many threads as configured.
+PIPELINE_STAGES = ('decode', 'validate', 'dispatch', 'rasterize', 'encode', 'place')
+CONFIGURABLE_STAGES = ('decode', 'validate', 'rasterize', 'encode')
+DEFAULT_CONCURRENCY = {'decode': 1, 'validate': 1, 'rasterize': 2, 'encode': 1}
+
+# Capacity of each queue between two stages
+DEFAULT_QUEUE_SIZE = 8
+
+# Seconds a blocked put/get waits before checking whether the run was aborted
+_POLL_SECONDS = 0.05
+
+_DONE = object()
+
+class InputError(ValueError):
+    """
+    Raised when an input can't be decoded or isn't a PDF. Aborts the run,
+    like the up front validation of the non pipelined request path.
+    """
+
+    def __init__(self, index, message):
+        super().__init__(message)
+        self.index = index
+
+class _Aborted(Exception):
+    pass
+
+class _Control:
+    """
+    Shared stop flag of one run. Every blocking operation polls it so a
+    failing stage can't leave the others waiting on a full or empty queue.
+    """
+
+    def __init__(self):
+        self.stop = threading.Event()
+        self.error = None
+
+    def fail(self, error):
+        if self.error is None:
+            self.error = error
+        self.stop.set()
+
+    def put(self, q, item):
+        while not self.stop.is_set():
+            try:
+                q.put(item, timeout=_POLL_SECONDS)
+                return
+            except queue.Full:
+                pass
+        raise _Aborted()
+
+    def get(self, q):
+        while not self.stop.is_set():
+            try:
+                return q.get(timeout=_POLL_SECONDS)
+            except queue.Empty:
+                pass
+        raise _Aborted()
+
+    def acquire(self, slots):
+        while not self.stop.is_set():
+            if slots.acquire(timeout=_POLL_SECONDS):
+                return
+        raise _Aborted()
+
+class _Stage:
+    """
+    ``concurrency`` threads taking items from ``inbox`` and putting every
+    result ``func`` returns (an iterable, so a stage may fan out) on
+    ``outbox``. The end-of-input marker is forwarded once all threads are
+    done, so downstream stages see it after the last item.
+    """
+
+    def __init__(self, name, func, concurrency, inbox, outbox, control):
+        self.name = name
+        self.func = func
+        self.concurrency = concurrency
+        self.inbox = inbox
+        self.outbox = outbox
+        self.control = control
+        self.items = 0
+        self.busy_seconds = 0.0
+        self.samples = 0
+        self.depth_total = 0
+        self.depth_max = 0
+        self._running = concurrency
+        self._lock = threading.Lock()
+        self._threads = []
+
+    def start(self):
+        for number in range(self.concurrency):
+            # Each thread runs in a copy of the caller's context, so log
+            # records keep the request they belong to
+            thread = threading.Thread(
+                target=contextvars.copy_context().run, args=(self._run,),
+                name=f"pipeline-{self.name}-{number}", daemon=True
+            )
+            thread.start()
+            self._threads.append(thread)
+
+    def join(self):
+        for thread in self._threads:
+            thread.join()
+
+    def sample(self):
+        # Queue depth seen by a consumer right before it takes an item. Also
+        # taken before end-of-input markers and re-put items, so it's counted
+        # on its own rather than averaged over processed items
+        depth = self.inbox.qsize()
+        with self._lock:
+            self.samples += 1
+            self.depth_total += depth
+            self.depth_max = max(self.depth_max, depth)
+
+    def record(self, seconds):
+        with self._lock:
+            self.items += 1
+            self.busy_seconds += seconds
+
+    def stats(self, elapsed):
+        return {
+            'concurrency': self.concurrency,
+            'items': self.items,
+            'busy_seconds': round(self.busy_seconds, 4),
+            'throughput': round(self.items / elapsed, 2) if elapsed > 0 else 0.0,
+            'queue_depth_avg': round(self.depth_total / self.samples, 2) if self.samples else 0.0,
+            'queue_depth_max': self.depth_max,
+        }
+
+    def _run(self):
+        try:
+            while True:
+                self.sample()
+                item = self.control.get(self.inbox)
+                if item is _DONE:
+                    # Let the sibling threads see the marker too
+                    self.control.put(self.inbox, _DONE)
+                    break
+                started = time.perf_counter()
+                for result in self.func(item):
+                    self.control.put(self.outbox, result)
+                self.record(time.perf_counter() - started)
+        except _Aborted:
+            return
+        except BaseException as e:
+            self.control.fail(e)
+            return
+
+        with self._lock:
+            self._running -= 1
+            last = self._running == 0
+        if last:
+            try:
+                self.control.put(self.outbox, _DONE)
+            except _Aborted:
+                pass
+
+def run_pipeline(sources, output_file, rows=3, cols=2, h_padding=20, v_padding=20, workers=1,
+                 use_cache=True, progress=None, profile='rgb', crop='default', pages='all',
+                 concurrency=None, queue_size=None, decode=None, metrics=None, render_timeout=None, timeout=None):
+    """
+    Raster merge as a pipeline of stages connected by bounded queues:
+
+        decode -> validate -> dispatch -> rasterize -> encode -> place
+
+    so reading inputs, waiting on poppler and encoding images overlap
+    instead of running one receipt at a time. ``concurrency`` maps stage
+    names (CONFIGURABLE_STAGES) to thread counts; rasterize defaults to
+    ``workers`` threads when that is above 1. Every queue holds at most
+    ``queue_size`` items and at most twice that many inputs and receipts
+    are in flight ahead of placement, so memory stays bounded whatever the
+    batch size.
+
+    ``sources`` are paths or PDF bytes, or anything ``decode(index, source)``
+    turns into PDF bytes (e.g. base64 strings). Inputs that fail to decode
+    or aren't PDFs raise InputError. Receipts are placed in input order,
+    with the page layout of merge_pdfs_with_images.
+
+    ``metrics`` receives the same per stage and per receipt measurements
+    as merge_pdfs_with_images. ``render_timeout`` and ``timeout`` bound
+    the renders as they do there.
+
+    Returns the run statistics of merge_pdfs_with_images plus a
+    ``pipeline`` block with per stage counters and queue depths.
+    """
+    settings = dict(DEFAULT_CONCURRENCY)
+    if workers > 1:
+        settings['rasterize'] = workers
+    settings.update(concurrency or {})
+    queue_size = queue_size or DEFAULT_QUEUE_SIZE
+    if profile not in ENCODING_PROFILES:
+        raise ValueError(f"Unknown encoding profile: {profile}")
+
+    from reportlab.lib.pagesizes import A4
+    from reportlab.pdfgen import canvas
+
+    c = canvas.Canvas(output_file, pagesize=A4)
+    page_width, page_height = A4
+    cell_width = (page_width - (cols + 1) * h_padding) / cols
+    cell_height = (page_height - (rows + 1) * v_padding) / rows
+    per_page = rows * cols
+
+    cache = get_render_cache() if use_cache else None
+    cache_stats = {'hits': 0, 'misses': 0}
+    cache_lock = threading.Lock()
+    render_seconds = [0.0]
+    budget = RenderBudget(render_timeout, timeout)
+
+    control = _Control()
+    window = 2 * max(queue_size, per_page)
+    input_slots = threading.Semaphore(2 * queue_size)
+    receipt_slots = threading.Semaphore(window)
+    queues = {name: queue.Queue(maxsize=queue_size) for name in PIPELINE_STAGES}
+    dispatched = [0]
+
+    def decode_stage(item):
+        index, source = item
+        encoded_size = len(source) if decode is not None or isinstance(source, (bytes, bytearray)) else 0
+        with measure(metrics, 'decode', encoded_size) as decoded:
+            if decode is not None:
+                data = decode(index, source)
+            elif isinstance(source, (bytes, bytearray)):
+                data = bytes(source)
+            else:
+                with open(source, 'rb') as f:
+                    data = f.read()
+            decoded['bytes_out'] = len(data)
+        yield index, data
+
+    def validate_stage(item):
+        from PyPDF2 import PdfReader
+
+        index, data = item
+        if not data.startswith(b'%PDF'):
+            raise InputError(index, f'File at index {index} is not a valid PDF')
+        if pages == 'first':
+            page_numbers = [1]
+        else:
+            try:
+                page_numbers = _page_numbers(pages, len(PdfReader(BytesIO(data)).pages))
+            except Exception as e:
+                # Let the renderer report it like any other unreadable input
+                logger.warning('page_count_failed', input=index, error=str(e))
+                page_numbers = [1]
+        yield index, data, page_numbers
+
+    validated = {}
+    next_input = [0]
+
+    def dispatch_stage(item):
+        # Single threaded: inputs leave in input order, one item per page
+        validated[item[0]] = item
+        while next_input[0] in validated:
+            index, data, page_numbers = validated.pop(next_input[0])
+            next_input[0] += 1
+            input_slots.release()
+            for page_number in page_numbers:
+                control.acquire(receipt_slots)
+                sequence = dispatched[0]
+                dispatched[0] += 1
+                yield sequence, index, data, page_number
+
+    def rasterize_stage(item):
+        sequence, index, data, page_number = item
+        outcome = None
+        key = _render_cache_key(data, crop, page_number) if cache is not None else None
+        if key:
+            cached = cache.get(key)
+            with cache_lock:
+                cache_stats['hits' if cached is not None else 'misses'] += 1
+            if cached is not None:
+                outcome = (cached, 0.0, 0.0)
+        if outcome is None:
+            try:
+                outcome = _render_receipt(data, crop, page_number, budget)
+            except Exception as e:
+                outcome = e
+            else:
+                with cache_lock:
+                    render_seconds[0] += outcome[1]
+                if key and outcome[0] is not None:
+                    cache.put(key, outcome[0])
+        yield sequence, index, data, page_number, outcome
+
+    def encode_stage(item):
+        sequence, index, data, page_number, outcome = item
+        if not isinstance(outcome, Exception) and outcome[0] is not None:
+            image, seconds, cpu_seconds = outcome
+            scaled_w, scaled_h = _scale_to_cell(*image.size, cell_width, cell_height)
+            bitmap_bytes = _image_bytes(image)
+            with measure(metrics, 'encode', bitmap_bytes) as encoded:
+                outcome = (_encode_receipt(image, scaled_w, scaled_h, profile), scaled_w, scaled_h)
+            if metrics is not None:
+                metrics.record('render', seconds, cpu_seconds, len(data), bitmap_bytes)
+                metrics.receipt(
+                    index, page_number, bytes_in=len(data), bitmap_bytes=bitmap_bytes,
+                    render_seconds=seconds, render_cpu_seconds=cpu_seconds,
+                    encode_seconds=encoded['wall_seconds'], encode_cpu_seconds=encoded['cpu_seconds'],
+                )
+        yield sequence, index, data, page_number, outcome
+
+    def feed():
+        try:
+            for index, source in enumerate(sources):
+                control.acquire(input_slots)
+                control.put(queues['decode'], (index, source))
+            control.put(queues['decode'], _DONE)
+        except _Aborted:
+            pass
+
+    stages = [
+        _Stage('decode', decode_stage, settings['decode'], queues['decode'], queues['validate'], control),
+        _Stage('validate', validate_stage, settings['validate'], queues['validate'], queues['dispatch'], control),
+        _Stage('dispatch', dispatch_stage, 1, queues['dispatch'], queues['rasterize'], control),
+        _Stage('rasterize', rasterize_stage, settings['rasterize'], queues['rasterize'], queues['encode'], control),
+        _Stage('encode', encode_stage, settings['encode'], queues['encode'], queues['place'], control),
+    ]
+    # Placement runs on the calling thread; it is measured like the others
+    place = _Stage('place', None, 1, queues['place'], None, control)
+
+    started = time.perf_counter()
+    feeder = threading.Thread(target=feed, name='pipeline-feed', daemon=True)
+    feeder.start()
+    for stage in stages:
+        stage.start()
+
+    page_receipts = []
+    skipped = []
+    placed = {}
+    next_sequence = 0
+    processed_count = 0
+    try:
+        finished = False
+        while not finished:
+            place.sample()
+            item = control.get(queues['place'])
+            if item is _DONE:
+                finished = True
+            else:
+                placed[item[0]] = item
+
+            while next_sequence in placed:
+                step_started = time.perf_counter()
+                _, index, data, page_number, outcome = placed.pop(next_sequence)
+                next_sequence += 1
+                receipt_slots.release()
+                _report_progress(progress, next_sequence - 1, max(dispatched[0], next_sequence))
+
+                if isinstance(outcome, Exception):
+                    skipped.append(_skipped_receipt(index, page_number, outcome))
+                elif outcome[0] is None:
+                    skipped.append(_skipped_receipt(index, page_number, None))
+                else:
+                    page_receipts.append(outcome)
+                    processed_count += 1
+                    if len(page_receipts) == per_page:
+                        with measure(metrics, 'draw'):
+                            _draw_encoded_page(
+                                c, page_receipts, cols, cell_width, cell_height,
+                                h_padding, v_padding, page_width, page_height
+                            )
+                            c.showPage()
+                        page_receipts = []
+                place.record(time.perf_counter() - step_started)
+    except _Aborted:
+        pass
+    finally:
+        control.stop.set()
+        feeder.join()
+        for stage in stages:
+            stage.join()
+
+    if control.error is not None:
+        raise control.error
+
+    if page_receipts:
+        with measure(metrics, 'draw'):
+            _draw_encoded_page(
+                c, page_receipts, cols, cell_width, cell_height,
+                h_padding, v_padding, page_width, page_height
+            )
+    with measure(metrics, 'save') as saved:
+        c.save()
+        saved['bytes_out'] = _output_size(output_file)
+    _report_progress(progress, next_sequence, next_sequence)
+    elapsed = time.perf_counter() - started
+    logger.info('merge_completed', engine='pipeline', processed=processed_count, receipts=next_sequence,
+                skipped=len(skipped), output=_output_label(output_file), elapsed_seconds=round(elapsed, 4))
+
+    if cache is not None:
+        cache_stats['totals'] = cache.stats()
+
+    return {
+        'engine': 'raster',
+        'processed': processed_count,
+        'workers': settings['rasterize'],
+        'batch_render': False,
+        'stream': False,
+        'profile': profile,
+        'crop': crop,
+        'pages': pages,
+        'receipts': next_sequence,
+        'elapsed_seconds': round(elapsed, 4),
+        'render_seconds': round(render_seconds[0], 4),
+        'speedup': round(render_seconds[0] / elapsed, 2) if elapsed > 0 else 1.0,
+        'cache': cache_stats if cache is not None else None,
+        'skipped': skipped,
+        'timeouts': sum(1 for entry in skipped if entry['reason'] in TIMEOUT_REASONS),
+        'pipeline': {
+            'queue_size': queue_size,
+            'stages': {stage.name: stage.stats(elapsed) for stage in [*stages, place]},
+        },
+    }
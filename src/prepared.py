@@ -0,0 +1,270 @@
+import hashlib
+import json
+import os
+import sqlite3
+import time
+from io import BytesIO
+
+from .cache import get_render_cache
+from .log import env_number, get_logger
+from .utils import (
+    AUTO_CROP_PREVIEW_DPI, RENDER_DPI, TIMEOUT_REASONS, RenderBudget, RenderTimeout, _draw_encoded_page,
+    _iter_receipt_pages, _iter_rendered_receipts, _jpeg_bytes, _output_label, _resample_receipt, _scale_to_cell,
+)
+
+PREPARED_STORE_PATH = os.environ.get('PREPARED_STORE_PATH', '/tmp/resi-merger-prepared.sqlite3')
+# Prepared receipts are dropped this long after their last prepare
+PREPARED_TTL_SECONDS = env_number('PREPARED_TTL_SECONDS', 86400, cast=int)
+
+logger = get_logger(__name__)
+
+class PreparedError(ValueError):
+    """
+    Raised when a PDF yields no receipt to prepare
+    """
+
+class PreparedStore:
+    """
+    Receipts rendered, cropped and encoded ahead of time by ``prepare``,
+    stored under a token until ``compose`` lays them out
+    """
+
+    def save(self, token, receipts, options):
+        """
+        Store ``receipts`` (dicts with width, height, format, content)
+        under ``token``, replacing any previous entry
+        """
+        raise NotImplementedError
+
+    def get(self, token):
+        """
+        Token record (options, receipts count, expiry) or None when it is
+        unknown or expired
+        """
+        raise NotImplementedError
+
+    def load_receipts(self, token):
+        """
+        The token's receipts as a list of dicts, in page order
+        """
+        raise NotImplementedError
+
+    def touch(self, token):
+        """
+        Restart the token's expiry
+        """
+        raise NotImplementedError
+
+class SQLitePreparedStore(PreparedStore):
+    """
+    Prepared receipts in a single SQLite file, shared by every process on the host
+    """
+
+    def __init__(self, path=None, ttl=None):
+        self.path = path or PREPARED_STORE_PATH
+        self.ttl = PREPARED_TTL_SECONDS if ttl is None else ttl
+        with self._connect() as db:
+            db.execute(
+                "CREATE TABLE IF NOT EXISTS prepared ("
+                " token TEXT PRIMARY KEY, options TEXT, receipts INTEGER NOT NULL,"
+                " created_at REAL NOT NULL, expires_at REAL NOT NULL)"
+            )
+            db.execute(
+                "CREATE TABLE IF NOT EXISTS prepared_receipts ("
+                " token TEXT NOT NULL, position INTEGER NOT NULL, width INTEGER NOT NULL,"
+                " height INTEGER NOT NULL, format TEXT NOT NULL, content BLOB NOT NULL,"
+                " PRIMARY KEY (token, position))"
+            )
+
+    def _connect(self):
+        # One connection per call keeps the store safe to use from worker threads
+        return sqlite3.connect(self.path, timeout=30)
+
+    def save(self, token, receipts, options):
+        now = time.time()
+        with self._connect() as db:
+            self._purge(db, now)
+            db.execute("DELETE FROM prepared_receipts WHERE token = ?", (token,))
+            db.execute(
+                "INSERT OR REPLACE INTO prepared (token, options, receipts, created_at, expires_at)"
+                " VALUES (?, ?, ?, ?, ?)",
+                (token, json.dumps(options), len(receipts), now, now + self.ttl)
+            )
+            db.executemany(
+                "INSERT INTO prepared_receipts (token, position, width, height, format, content)"
+                " VALUES (?, ?, ?, ?, ?, ?)",
+                [
+                    (token, position, receipt['width'], receipt['height'], receipt['format'], receipt['content'])
+                    for position, receipt in enumerate(receipts)
+                ]
+            )
+
+    def get(self, token):
+        with self._connect() as db:
+            row = db.execute(
+                "SELECT options, receipts, created_at, expires_at FROM prepared"
+                " WHERE token = ? AND expires_at > ?", (token, time.time())
+            ).fetchone()
+        if row is None:
+            return None
+        return {
+            'token': token,
+            'options': json.loads(row[0] or '{}'),
+            'receipts': row[1],
+            'created_at': row[2],
+            'expires_at': row[3],
+        }
+
+    def load_receipts(self, token):
+        with self._connect() as db:
+            rows = db.execute(
+                "SELECT width, height, format, content FROM prepared_receipts"
+                " WHERE token = ? ORDER BY position", (token,)
+            ).fetchall()
+        return [
+            {'width': width, 'height': height, 'format': fmt, 'content': bytes(content)}
+            for width, height, fmt, content in rows
+        ]
+
+    def touch(self, token):
+        with self._connect() as db:
+            db.execute("UPDATE prepared SET expires_at = ? WHERE token = ?", (time.time() + self.ttl, token))
+
+    def _purge(self, db, now):
+        expired = [row[0] for row in db.execute("SELECT token FROM prepared WHERE expires_at <= ?", (now,))]
+        if expired:
+            db.executemany("DELETE FROM prepared_receipts WHERE token = ?", [(token,) for token in expired])
+            db.executemany("DELETE FROM prepared WHERE token = ?", [(token,) for token in expired])
+
+def get_prepared_store():
+    """
+    Prepared receipt store configured from the environment
+    """
+    return SQLitePreparedStore()
+
+def prepared_token(pdf_bytes, profile='rgb', crop='default', pages='all'):
+    """
+    Token of a prepared PDF: a hash of its bytes and the options that shape
+    its receipts, so preparing the same PDF twice gives the same token
+    """
+    digest = hashlib.sha256(pdf_bytes)
+    digest.update(f"|dpi={RENDER_DPI}|preview={AUTO_CROP_PREVIEW_DPI}|profile={profile}"
+                  f"|crop={crop}|pages={pages}".encode('utf-8'))
+    return digest.hexdigest()[:32]
+
+def prepare_pdf(pdf_bytes, store, rows=3, cols=2, h_padding=20, v_padding=20, use_cache=True,
+                profile='rgb', crop='default', pages='all', render_timeout=None, timeout=None):
+    """
+    Render, crop and encode the receipts of one PDF, exactly as
+    merge_pdfs_with_images would for the same layout, and keep them in
+    ``store``. A PDF prepared before is only refreshed, unless receipts
+    were skipped for time then: renders are bounded by ``render_timeout``
+    and ``timeout`` as in a merge (see RenderBudget).
+
+    Returns a dict with the ``token``, ``receipts`` count, ``skipped``
+    pages and ``expires_at``. Raises PreparedError when no page renders.
+    """
+    from reportlab.lib.pagesizes import A4
+
+    token = prepared_token(pdf_bytes, profile, crop, pages)
+    existing = store.get(token)
+    if existing is not None and not existing['options'].get('timeouts'):
+        store.touch(token)
+        logger.info('prepare_reused', token=token, receipts=existing['receipts'])
+        return {'token': token, 'receipts': existing['receipts'], 'skipped': [], 'reused': True,
+                'expires_at': store.get(token)['expires_at']}
+
+    page_width, page_height = A4
+    cell_width = (page_width - (cols + 1) * h_padding) / cols
+    cell_height = (page_height - (rows + 1) * v_padding) / rows
+
+    cache = get_render_cache() if use_cache else None
+    receipts = list(_iter_receipt_pages([pdf_bytes], pages))
+    prepared = []
+    skipped = []
+    budget = RenderBudget(render_timeout, timeout)
+    for _, (_, _, page_number), outcome in _iter_rendered_receipts(
+        receipts, cache=cache, cache_stats={'hits': 0, 'misses': 0}, crop=crop, budget=budget
+    ):
+        if isinstance(outcome, Exception):
+            reason = outcome.reason if isinstance(outcome, RenderTimeout) else 'error'
+            skipped.append({'page': page_number, 'reason': reason, 'error': str(outcome)})
+            continue
+        cropped_image = outcome[0]
+        if cropped_image is None:
+            skipped.append({'page': page_number, 'reason': 'empty', 'error': 'page rendered empty'})
+            continue
+
+        scaled_w, scaled_h = _scale_to_cell(*cropped_image.size, cell_width, cell_height)
+        image = _resample_receipt(cropped_image, scaled_w, scaled_h, profile)
+        if profile == 'photo':
+            fmt, content = 'jpeg', _jpeg_bytes(image)
+        else:
+            buffer = BytesIO()
+            image.save(buffer, 'PNG')
+            fmt, content = 'png', buffer.getvalue()
+        prepared.append({
+            'width': cropped_image.width, 'height': cropped_image.height, 'format': fmt, 'content': content,
+        })
+
+    if not prepared:
+        raise PreparedError(f"No receipt could be prepared: {skipped[0]['error'] if skipped else 'no pages selected'}")
+
+    timeouts = sum(1 for entry in skipped if entry['reason'] in TIMEOUT_REASONS)
+    store.save(token, prepared, {'profile': profile, 'crop': crop, 'pages': pages, 'timeouts': timeouts})
+    logger.info('prepared', token=token, receipts=len(prepared), skipped=len(skipped))
+    return {'token': token, 'receipts': len(prepared), 'skipped': skipped, 'reused': False,
+            'expires_at': store.get(token)['expires_at']}
+
+def compose_prepared(tokens, output_file, store, rows=3, cols=2, h_padding=20, v_padding=20):
+    """
+    Lay out the prepared receipts of ``tokens``, in order, on the same grid
+    as merge_pdfs_with_images. Nothing is rendered: stored images are only
+    placed, so this costs about as much as writing the PDF.
+
+    Raises KeyError listing the tokens that are unknown or expired.
+    Returns a dict with run statistics.
+    """
+    from reportlab.lib.pagesizes import A4
+    from reportlab.lib.utils import ImageReader
+    from reportlab.pdfgen import canvas
+
+    missing = [token for token in tokens if store.get(token) is None]
+    if missing:
+        raise KeyError(missing)
+
+    started = time.perf_counter()
+    c = canvas.Canvas(output_file, pagesize=A4)
+    page_width, page_height = A4
+    cell_width = (page_width - (cols + 1) * h_padding) / cols
+    cell_height = (page_height - (rows + 1) * v_padding) / rows
+    per_page = rows * cols
+
+    page = []
+    placed = 0
+    for token in tokens:
+        for receipt in store.load_receipts(token):
+            scaled_w, scaled_h = _scale_to_cell(receipt['width'], receipt['height'], cell_width, cell_height)
+            page.append((ImageReader(BytesIO(receipt['content'])), scaled_w, scaled_h))
+            placed += 1
+            if len(page) == per_page:
+                _draw_encoded_page(c, page, cols, cell_width, cell_height, h_padding, v_padding,
+                                   page_width, page_height)
+                c.showPage()
+                page = []
+    if page:
+        _draw_encoded_page(c, page, cols, cell_width, cell_height, h_padding, v_padding,
+                           page_width, page_height)
+    c.save()
+
+    elapsed = time.perf_counter() - started
+    logger.info('compose_completed', tokens=len(tokens), receipts=placed,
+                output=_output_label(output_file), elapsed_seconds=round(elapsed, 4))
+    return {
+        'engine': 'prepared',
+        'tokens': len(tokens),
+        'processed': placed,
+        'receipts': placed,
+        'output_pages': (placed + per_page - 1) // per_page,
+        'elapsed_seconds': round(elapsed, 4),
+    }
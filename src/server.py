@@ -0,0 +1,275 @@
+"""
+Standalone HTTP server serving the same contract as the Appwrite
+function (src/main.py), for traffic that runs outside Appwrite.
+
+    python -m src.server --port 8080 --workers 4 --max-jobs 8 --recycle-after 200
+
+Requests are read by a threaded HTTP/1.1 front end (keep-alive) and
+handed to a pool of worker processes that call ``main`` with a stand-in
+context (src/context.py). Workers are forked from a forkserver that has
+the render stack imported already and run warm_up before they take
+requests, so no request pays the interpreter start, the imports or the
+poppler probe. A worker retires after ``--recycle-after`` requests (PIL
+and poppler buffers fragment the heap over time) and a fresh one takes
+its place. At most ``--max-jobs`` requests are admitted at once, running
+or waiting for a worker; the rest are answered 503 with Retry-After.
+
+Caches live in each worker: the render cache shares its disk tier, the
+result cache and the in-memory render tier are per worker.
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import queue
+import signal
+import sys
+import threading
+from http.server import ThreadingHTTPServer
+
+from .context import LocalHandler
+from .log import get_logger
+from .metrics import process_memory_mb
+
+SERVER_HOST = os.environ.get('SERVER_HOST', '127.0.0.1')
+SERVER_PORT = int(os.environ.get('SERVER_PORT', 8080))
+# Worker processes, i.e. merges running at once
+SERVER_WORKERS = int(os.environ.get('SERVER_WORKERS', 0)) or os.cpu_count() or 1
+# Requests admitted at once (running or waiting for a worker), 0 = 2 per worker
+SERVER_MAX_JOBS = int(os.environ.get('SERVER_MAX_JOBS', 0))
+# Requests a worker serves before it is replaced, 0 = never
+SERVER_RECYCLE_AFTER = int(os.environ.get('SERVER_RECYCLE_AFTER', 500))
+# Seconds an idle keep-alive connection stays open
+SERVER_KEEPALIVE_SECONDS = float(os.environ.get('SERVER_KEEPALIVE_SECONDS', 15))
+
+# Imported once in the forkserver, so every worker forked from it starts
+# with them loaded (see src.utils.warm_up, which workers still run).
+# Missing optional modules are skipped.
+PRELOAD_MODULES = [
+    'src.main', 'PyPDF2', 'reportlab.lib.utils', 'reportlab.pdfgen.canvas', 'PIL.Image', 'pdf2image', 'numpy',
+]
+
+logger = get_logger(__name__)
+
+def _worker_main(conn, recycle_after):
+    """
+    Worker process: warm up, then answer ``(method, url, headers, body)``
+    messages with ``((status, headers, body), retiring)`` until told to
+    stop or ``recycle_after`` requests are served
+    """
+    from .context import LocalContext, LocalRequest
+    from .main import main
+    from .utils import warm_up
+
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    warm_up()
+    conn.send('ready')
+    served = 0
+    while True:
+        try:
+            message = conn.recv()
+        except EOFError:
+            break
+        if message is None:
+            break
+        method, url, headers, body = message
+        try:
+            response = main(LocalContext(LocalRequest(method, url, headers, body), log_stream=sys.stdout))
+        except Exception as e:
+            logger.error('worker_request_failed', error=str(e))
+            response = (500, {'Content-Type': 'application/json'}, json.dumps({'error': str(e)}).encode())
+        served += 1
+        retiring = bool(recycle_after) and served >= recycle_after
+        conn.send((response, retiring))
+        if retiring:
+            break
+    # Async jobs started by main finish on their threads before the
+    # process exits
+    conn.close()
+
+class _Worker:
+    def __init__(self, context, recycle_after):
+        self.conn, child_conn = context.Pipe()
+        self.process = context.Process(target=_worker_main, args=(child_conn, recycle_after), daemon=False)
+        self.process.start()
+        child_conn.close()
+        self.served = 0
+
+    def wait_ready(self, timeout=60):
+        if not self.conn.poll(timeout) or self.conn.recv() != 'ready':
+            raise RuntimeError(f'Worker {self.process.pid} did not start')
+
+    def stop(self):
+        try:
+            self.conn.send(None)
+        except OSError:
+            pass
+        self.conn.close()
+
+class WorkerPool:
+    """
+    Pre-warmed worker processes. ``call`` runs one request on an idle
+    worker, blocking until one is free, and replaces workers that retire
+    or die.
+    """
+
+    def __init__(self, workers=SERVER_WORKERS, recycle_after=SERVER_RECYCLE_AFTER):
+        self.size = workers
+        self.recycle_after = recycle_after
+        self._context = multiprocessing.get_context('forkserver')
+        self._context.set_forkserver_preload(PRELOAD_MODULES)
+        self._idle = queue.Queue()
+        self._lock = threading.Lock()
+        self._workers = set()
+        self.recycled = 0
+        self._closed = False
+
+    def start(self):
+        started = [self._spawn() for _ in range(self.size)]
+        for worker in started:
+            worker.wait_ready()
+            self._idle.put(worker)
+        logger.info('workers_ready', workers=[worker.process.pid for worker in started])
+
+    def _spawn(self):
+        worker = _Worker(self._context, self.recycle_after)
+        with self._lock:
+            self._workers.add(worker)
+        return worker
+
+    def _replace(self, worker):
+        # Runs on its own thread so the request that retired the worker
+        # isn't held up by the replacement's start
+        with self._lock:
+            self._workers.discard(worker)
+        worker.conn.close()
+        if not self._closed:
+            replacement = self._spawn()
+            try:
+                replacement.wait_ready()
+            except (RuntimeError, EOFError, OSError) as e:
+                logger.error('worker_start_failed', error=str(e))
+                with self._lock:
+                    self._workers.discard(replacement)
+                threading.Thread(target=self._replace, args=(replacement,), daemon=True).start()
+                return
+            self._idle.put(replacement)
+        worker.process.join()
+
+    def call(self, method, url, headers, body):
+        """
+        ``(status, headers, body)`` of ``main`` for the request
+        """
+        worker = self._idle.get()
+        try:
+            worker.conn.send((method, url, headers, body))
+            response, retiring = worker.conn.recv()
+        except (EOFError, OSError):
+            logger.error('worker_died', pid=worker.process.pid, exitcode=worker.process.exitcode)
+            threading.Thread(target=self._replace, args=(worker,), daemon=True).start()
+            return 502, {'Content-Type': 'application/json'}, json.dumps({
+                'error': 'Worker exited while handling the request'
+            }).encode()
+        worker.served += 1
+        if retiring:
+            self.recycled += 1
+            logger.info('worker_recycled', pid=worker.process.pid, served=worker.served)
+            threading.Thread(target=self._replace, args=(worker,), daemon=True).start()
+        else:
+            self._idle.put(worker)
+        return response
+
+    def status(self):
+        with self._lock:
+            workers = sorted(self._workers, key=lambda worker: worker.process.pid)
+        return {
+            'workers': [
+                dict({'pid': worker.process.pid, 'served': worker.served},
+                     **(process_memory_mb(worker.process.pid) or {'rss_mb': None, 'peak_rss_mb': None}))
+                for worker in workers
+            ],
+            'idle': self._idle.qsize(),
+            'recycled': self.recycled,
+        }
+
+    def close(self):
+        self._closed = True
+        with self._lock:
+            workers = list(self._workers)
+        for worker in workers:
+            worker.stop()
+        for worker in workers:
+            worker.process.join()
+
+class _Handler(LocalHandler):
+    timeout = SERVER_KEEPALIVE_SECONDS
+
+    def status(self):
+        server = self.server
+        return dict(server.pool.status(), in_flight=server.in_flight, max_jobs=server.max_jobs)
+
+    def call(self, method, url, headers, body):
+        server = self.server
+        if not server.slots.acquire(blocking=False):
+            return 503, {'Content-Type': 'application/json', 'Retry-After': '1'}, json.dumps({
+                'error': f'Server busy: {server.max_jobs} requests in progress'
+            }).encode()
+        server.in_flight += 1
+        try:
+            return server.pool.call(method, url, headers, body)
+        finally:
+            server.in_flight -= 1
+            server.slots.release()
+
+class Server(ThreadingHTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address, pool, max_jobs):
+        super().__init__(address, _Handler)
+        self.pool = pool
+        self.max_jobs = max_jobs
+        self.slots = threading.BoundedSemaphore(max_jobs)
+        # Approximate (unlocked), only reported by the status endpoint
+        self.in_flight = 0
+
+def serve(host=SERVER_HOST, port=SERVER_PORT, workers=SERVER_WORKERS, max_jobs=SERVER_MAX_JOBS,
+          recycle_after=SERVER_RECYCLE_AFTER):
+    """
+    Start the worker pool and serve until SIGINT or SIGTERM
+    """
+    pool = WorkerPool(workers, recycle_after)
+    pool.start()
+    server = Server((host, port), pool, max_jobs or 2 * workers)
+
+    def stop(*_):
+        threading.Thread(target=server.shutdown, daemon=True).start()
+
+    signal.signal(signal.SIGTERM, stop)
+    logger.info('server_listening', url=f'http://{host}:{server.server_address[1]}', workers=workers,
+                max_jobs=server.max_jobs, recycle_after=recycle_after)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        pool.close()
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Serve the merge function over HTTP with a pre-warmed worker pool')
+    parser.add_argument('--host', default=SERVER_HOST)
+    parser.add_argument('--port', type=int, default=SERVER_PORT)
+    parser.add_argument('--workers', type=int, default=SERVER_WORKERS, help='worker processes')
+    parser.add_argument('--max-jobs', type=int, default=SERVER_MAX_JOBS,
+                        help='requests admitted at once, the rest get 503 (default 2 per worker)')
+    parser.add_argument('--recycle-after', type=int, default=SERVER_RECYCLE_AFTER,
+                        help='requests per worker before it is replaced, 0 = never')
+    args = parser.parse_args(argv)
+    if args.workers < 1 or args.max_jobs < 0 or args.recycle_after < 0:
+        parser.error('--workers must be at least 1, --max-jobs and --recycle-after not negative')
+    serve(args.host, args.port, args.workers, args.max_jobs, args.recycle_after)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
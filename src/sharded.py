@@ -0,0 +1,249 @@
+import os
+import time
+from io import BytesIO
+
+from .cache import get_render_cache
+from .log import get_logger
+from .metrics import cpu_time, measure
+from .utils import (
+    ENCODING_PROFILES, TIMEOUT_REASONS, RenderBudget, RenderTimeout, _image_bytes, _input_size, _iter_receipt_pages,
+    _iter_rendered_receipts, _jpeg_bytes, _output_label, _output_size, _receipt_position, _report_progress,
+    _resample_receipt, _scale_to_cell,
+)
+
+logger = get_logger(__name__)
+
+# Output pages worth of receipts per shard: each shard is one task for a
+# worker process
+DEFAULT_SHARD_PAGES = 1
+
+def run_sharded(input_files, output_file, rows=3, cols=2, h_padding=20, v_padding=20, workers=None,
+                use_cache=True, progress=None, profile='rgb', crop='default', pages='all',
+                shard_pages=DEFAULT_SHARD_PAGES, metrics=None, render_timeout=None, timeout=None):
+    """
+    Raster merge split across worker processes. The receipt list is cut
+    into shards of ``shard_pages * rows * cols`` receipts; every shard is
+    rendered, cropped, encoded and compressed by a worker, which hands back
+    finished PDF image objects. The parent places each shard as soon as it
+    and the ones before it are done, then lets go of it, on the same grid
+    as merge_pdfs_with_images, so pages match a single process run
+    exactly: a receipt that fails to render leaves no gap, the next
+    receipt takes its cell. Every receipt is rendered once, whatever fails.
+
+    ``workers`` defaults to the CPU count. ``metrics`` records the render
+    and encode stages of every receipt, measured in the workers, and the
+    draw and save stages. ``render_timeout`` and ``timeout`` bound the
+    renders in every worker, see RenderBudget.
+
+    Returns the run statistics of merge_pdfs_with_images plus a
+    ``sharded`` block with the shard count.
+    """
+    from concurrent.futures import ProcessPoolExecutor, as_completed
+
+    from reportlab.lib.pagesizes import A4
+    from reportlab.pdfgen import canvas
+
+    if profile not in ENCODING_PROFILES:
+        raise ValueError(f"Unknown encoding profile: {profile}")
+
+    workers = workers or os.cpu_count() or 1
+    started = time.perf_counter()
+    receipts = list(_iter_receipt_pages(input_files, pages))
+    shard_size = max(1, shard_pages) * rows * cols
+    shards = [range(start, min(start + shard_size, len(receipts))) for start in range(0, len(receipts), shard_size)]
+    page_width, page_height = A4
+    cell_width = (page_width - (cols + 1) * h_padding) / cols
+    cell_height = (page_height - (rows + 1) * v_padding) / rows
+    budget = RenderBudget(render_timeout, timeout)
+
+    c = canvas.Canvas(output_file, pagesize=A4)
+    page = []
+    skipped = []
+    placed = 0
+    done = 0
+    render_seconds = 0.0
+
+    def place(shard, result):
+        nonlocal page, placed
+        with measure(metrics, 'draw'):
+            for position, outcome in enumerate(result['receipts']):
+                input_index, _, page_number = receipts[shard[position]]
+                if len(outcome) == 2:
+                    reason, error = outcome
+                    logger.warning('receipt_failed', input=input_index, page=page_number, reason=reason, error=error)
+                    skipped.append({'input': input_index, 'page': page_number, 'reason': reason, 'error': error})
+                    continue
+                xobject, scaled_w, scaled_h, measured = outcome
+                if metrics is not None:
+                    metrics.record('render', measured['render_seconds'], measured['render_cpu_seconds'],
+                                   measured['bytes_in'], measured['bitmap_bytes'])
+                    metrics.record('encode', measured['encode_seconds'], measured['encode_cpu_seconds'],
+                                   measured['bitmap_bytes'], measured['encoded_bytes'])
+                    metrics.receipt(input_index, page_number, **measured)
+                page.append((xobject, scaled_w, scaled_h))
+                placed += 1
+                if len(page) == rows * cols:
+                    _draw_xobject_page(c, page, cols, cell_width, cell_height, h_padding, v_padding,
+                                       page_width, page_height)
+                    c.showPage()
+                    page = []
+
+    pool = ProcessPoolExecutor(max_workers=min(workers, len(shards))) if workers > 1 and len(shards) > 1 else None
+    try:
+        if pool is None:
+            outcomes = (
+                (number, _render_shard([receipts[i] for i in shard], (cell_width, cell_height),
+                                       use_cache, profile, crop, budget))
+                for number, shard in enumerate(shards)
+            )
+        else:
+            futures = {
+                pool.submit(
+                    _render_shard, [receipts[i] for i in shard], (cell_width, cell_height),
+                    use_cache, profile, crop, budget
+                ): number
+                for number, shard in enumerate(shards)
+            }
+            outcomes = ((futures.pop(future), future.result()) for future in as_completed(futures))
+
+        # Shards finish in any order but are placed in shard order: one that
+        # is done early waits here until the shards before it are placed
+        waiting = {}
+        next_shard = 0
+        for number, result in outcomes:
+            render_seconds += result['render_seconds']
+            done += len(shards[number])
+            waiting[number] = result
+            while next_shard in waiting:
+                place(shards[next_shard], waiting.pop(next_shard))
+                next_shard += 1
+            _report_progress(progress, done, len(receipts))
+    finally:
+        if pool is not None:
+            pool.shutdown(cancel_futures=True)
+
+    if page:
+        with measure(metrics, 'draw'):
+            _draw_xobject_page(c, page, cols, cell_width, cell_height, h_padding, v_padding,
+                               page_width, page_height)
+    with measure(metrics, 'save') as saved:
+        c.save()
+        saved['bytes_out'] = _output_size(output_file)
+    _report_progress(progress, len(receipts), len(receipts))
+
+    elapsed = time.perf_counter() - started
+    logger.info('merge_completed', engine='sharded', processed=placed, receipts=len(receipts),
+                shards=len(shards), skipped=len(skipped), output=_output_label(output_file),
+                elapsed_seconds=round(elapsed, 4))
+
+    return {
+        'engine': 'raster',
+        'processed': placed,
+        'workers': workers,
+        'batch_render': False,
+        'stream': False,
+        'profile': profile,
+        'crop': crop,
+        'pages': pages,
+        'receipts': len(receipts),
+        'elapsed_seconds': round(elapsed, 4),
+        'render_seconds': round(render_seconds, 4),
+        # Worker seconds over wall time: close to ``workers`` when sharding pays off
+        'speedup': round(render_seconds / elapsed, 2) if elapsed > 0 else 1.0,
+        'cache': None,
+        'skipped': skipped,
+        'timeouts': sum(1 for entry in skipped if entry['reason'] in TIMEOUT_REASONS),
+        'sharded': {
+            'shard_pages': max(1, shard_pages),
+            'shards': len(shards),
+            'failed': len(skipped),
+        },
+    }
+
+def _render_shard(receipts, cell_size, use_cache=True, profile='rgb', crop='default', budget=None):
+    """
+    Worker body: render, crop and encode the ``(input_index, input_file,
+    page_number)`` receipts of one shard for cells of ``cell_size``
+    points. Module level so it can run in a pool worker.
+
+    Returns a dict with one entry per receipt in ``receipts``, either
+    ``(xobject, scaled_w, scaled_h, metrics)`` or ``(reason, error)``
+    with reasons as in the ``skipped`` statistic, and the worker's
+    ``render_seconds``. ``xobject`` is the receipt as a compressed PDF
+    image, see _image_xobject, and ``metrics`` its per receipt timings
+    and sizes.
+    """
+    started = time.perf_counter()
+    cell_width, cell_height = cell_size
+    cache = get_render_cache() if use_cache else None
+    outcomes = [None] * len(receipts)
+    rendered = _iter_rendered_receipts(
+        receipts, cache=cache, cache_stats={'hits': 0, 'misses': 0}, crop=crop, budget=budget
+    )
+    for position, (_, input_file, _), outcome in rendered:
+        if isinstance(outcome, Exception):
+            outcomes[position] = (outcome.reason if isinstance(outcome, RenderTimeout) else 'error', str(outcome))
+            continue
+        cropped_image, seconds, cpu_seconds = outcome
+        if cropped_image is None:
+            outcomes[position] = ('empty', 'page rendered empty')
+            continue
+
+        scaled_w, scaled_h = _scale_to_cell(*cropped_image.size, cell_width, cell_height)
+        encode_started = time.perf_counter()
+        encode_cpu_started = cpu_time()
+        xobject = _image_xobject(_resample_receipt(cropped_image, scaled_w, scaled_h, profile), profile)
+        outcomes[position] = (xobject, scaled_w, scaled_h, {
+            'bytes_in': _input_size(input_file),
+            'bitmap_bytes': _image_bytes(cropped_image),
+            'encoded_bytes': len(xobject.streamContent),
+            'render_seconds': seconds,
+            'render_cpu_seconds': cpu_seconds,
+            'encode_seconds': time.perf_counter() - encode_started,
+            'encode_cpu_seconds': cpu_time() - encode_cpu_started,
+        })
+
+    return {'receipts': outcomes, 'render_seconds': time.perf_counter() - started}
+
+def _image_xobject(image, profile='rgb'):
+    """
+    Resampled receipt as the PDF image object drawImage would embed for
+    it: the same name (so identical receipts still share one object) and
+    the same Flate and ASCII85 compressed stream, or the JPEG data as is
+    for "photo". Built in the worker, so the parent only writes it out;
+    it pickles as a few attributes plus the compressed bytes.
+    """
+    from reportlab.lib.utils import ImageReader
+    from reportlab.pdfbase.pdfdoc import PDFImageXObject, _digester
+
+    reader = ImageReader(BytesIO(_jpeg_bytes(image)) if profile == 'photo' else image)
+    # drawImage names an image after its pixels and mask (None here)
+    xobject = PDFImageXObject(_digester(reader.getRGBData() + b'None'), reader)
+    # PDFImageXObject keeps no reference to the reader or its pixels
+    return xobject
+
+def _draw_xobject_page(c, receipts, cols, cell_width, cell_height,
+                       h_padding, v_padding, page_width, page_height):
+    """
+    Draw ``(xobject, scaled_w, scaled_h)`` receipts from _image_xobject
+    into their grid cells, as _draw_encoded_page does for images: the
+    object is registered with the document the way drawImage registers a
+    new image, then drawn with the same operators
+    """
+    num_receipts = len(receipts)
+
+    for i, (xobject, scaled_w, scaled_h) in enumerate(receipts):
+        x, y = _receipt_position(
+            i, num_receipts, cols, cell_width, cell_height,
+            h_padding, v_padding, page_width, page_height, scaled_w, scaled_h
+        )
+        if not c.hasForm(xobject.name):
+            c._setXObjects(xobject)
+            c._doc.Reference(xobject, c._doc.getXObjectName(xobject.name))
+            c._doc.addForm(xobject.name, xobject)
+        c._currentPageHasImages = 1
+        c.saveState()
+        c.translate(x, y)
+        c.scale(scaled_w, scaled_h)
+        c.doForm(xobject.name)
+        c.restoreState()
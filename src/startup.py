@@ -0,0 +1,125 @@
+"""
+Cold start profile of the function entrypoint.
+
+    python -m src.startup [--runs 5] [--budget-ms 80]
+
+Imports ``src.main`` in fresh interpreters and reports the cold import
+time (median of ``--runs``), the warm up time (the heavy libraries a merge
+imports on first use, see src.utils.warm_up) and the slowest modules.
+Exits with status 1 when the cold import is over the budget or pulls in
+one of HEAVY_MODULES, so it can run as a regression check in CI.
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+ENTRYPOINT = 'src.main'
+
+# Libraries only a merge needs; importing the entrypoint must not load them
+HEAVY_MODULES = ('reportlab', 'PIL', 'pdf2image', 'PyPDF2', 'numpy', 'appwrite')
+
+# Cold import budget in milliseconds
+COLD_START_BUDGET_MS = float(os.environ.get('COLD_START_BUDGET_MS', 80))
+
+_PROBE = """
+import json, sys, time
+started = time.perf_counter()
+import {entrypoint}
+cold = time.perf_counter() - started
+loaded = sorted(name for name in {heavy!r} if name in sys.modules)
+from src.utils import warm_up
+started = time.perf_counter()
+warm_up()
+warm = time.perf_counter() - started
+print(json.dumps({{'cold_ms': cold * 1000, 'warm_up_ms': warm * 1000, 'heavy_loaded': loaded}}))
+"""
+
+def _project_root():
+    return os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def measure_once(entrypoint=ENTRYPOINT):
+    """
+    Import ``entrypoint`` in a new interpreter. Returns a dict with
+    ``cold_ms``, ``warm_up_ms`` and ``heavy_loaded`` (HEAVY_MODULES the
+    import loaded).
+    """
+    result = subprocess.run(
+        [sys.executable, '-c', _PROBE.format(entrypoint=entrypoint, heavy=HEAVY_MODULES)],
+        cwd=_project_root(), capture_output=True, text=True, check=True
+    )
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+def slowest_imports(entrypoint=ENTRYPOINT, limit=10):
+    """
+    ``(module, cumulative_ms)`` of the slowest imports under ``entrypoint``,
+    from ``python -X importtime``
+    """
+    result = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', f'import {entrypoint}'],
+        cwd=_project_root(), capture_output=True, text=True, check=True
+    )
+    modules = []
+    subtree = []
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or '|' not in line:
+            continue
+        _, cumulative, name = line.split('|')
+        try:
+            entry = (name.strip(), int(cumulative) / 1000)
+        except ValueError:  # header line
+            continue
+        subtree.append(entry)
+        if not name.startswith('  '):
+            # A top level import closes its subtree; keep only the entrypoint's
+            if entry[0] == entrypoint:
+                modules.extend(subtree)
+            subtree = []
+    modules.sort(key=lambda module: module[1], reverse=True)
+    return modules[:limit]
+
+def profile(entrypoint=ENTRYPOINT, runs=5):
+    """
+    Startup report over ``runs`` fresh interpreters (medians)
+    """
+    samples = [measure_once(entrypoint) for _ in range(runs)]
+    return {
+        'entrypoint': entrypoint,
+        'runs': runs,
+        'cold_ms': round(statistics.median(s['cold_ms'] for s in samples), 2),
+        'warm_up_ms': round(statistics.median(s['warm_up_ms'] for s in samples), 2),
+        'heavy_loaded': sorted({name for s in samples for name in s['heavy_loaded']}),
+        'slowest_imports': {name: round(ms, 2) for name, ms in slowest_imports(entrypoint)},
+    }
+
+def check(report, budget_ms=COLD_START_BUDGET_MS):
+    """
+    List of budget violations in a profile report, empty when it passes
+    """
+    problems = []
+    if report['heavy_loaded']:
+        problems.append(f"{report['entrypoint']} imports {', '.join(report['heavy_loaded'])} at startup")
+    if report['cold_ms'] > budget_ms:
+        problems.append(f"cold import took {report['cold_ms']} ms, budget is {budget_ms} ms")
+    return problems
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Profile the cold start of the function entrypoint')
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--budget-ms', type=float, default=COLD_START_BUDGET_MS)
+    parser.add_argument('--entrypoint', default=ENTRYPOINT)
+    args = parser.parse_args(argv)
+
+    report = profile(args.entrypoint, args.runs)
+    report['budget_ms'] = args.budget_ms
+    problems = check(report, args.budget_ms)
+    report['ok'] = not problems
+    print(json.dumps(report, indent=2))
+    for problem in problems:
+        print(f'FAIL: {problem}', file=sys.stderr)
+    return 1 if problems else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,187 @@
+import os
+import re
+import time
+import uuid
+
+from .log import env_number
+
+# Output storage settings. OUTPUT_STORAGE picks the backend; by default
+# Appwrite Storage is used when a bucket is configured, the local
+# filesystem otherwise.
+OUTPUT_STORAGE = os.environ.get('OUTPUT_STORAGE', '')
+OUTPUT_BUCKET_ID = os.environ.get('OUTPUT_BUCKET_ID', '')
+LOCAL_STORAGE_DIR = os.environ.get('LOCAL_STORAGE_DIR', '/tmp/resi-merger-output')
+# Local outputs are deleted this long after they were written, 0 = kept
+OUTPUT_TTL_SECONDS = env_number('OUTPUT_TTL_SECONDS', 86400, cast=int)
+
+class StorageError(Exception):
+    """
+    Raised when a storage backend can't save or fetch a file
+    """
+
+class OutputStorage:
+    """
+    Where merged PDFs go when a request sets ``"output": "storage"``.
+    Backends store bytes under a generated file ID and give them back by ID.
+    """
+
+    name = 'base'
+
+    def save(self, content, filename):
+        """
+        Store ``content`` and return its file ID
+        """
+        raise NotImplementedError
+
+    def load(self, file_id):
+        """
+        Return the bytes stored under ``file_id``
+        """
+        raise NotImplementedError
+
+    def delete(self, file_id):
+        """
+        Remove the file stored under ``file_id``
+        """
+        raise NotImplementedError
+
+    def describe(self):
+        """
+        Extra fields for the response's ``file`` block
+        """
+        return {'storage': self.name}
+
+class LocalStorage(OutputStorage):
+    """
+    Files in a local directory, for tests and self-hosted deployments.
+    Files older than ``ttl`` seconds are purged whenever one is saved.
+    """
+
+    name = 'local'
+
+    def __init__(self, directory=None, ttl=None):
+        self.directory = directory or LOCAL_STORAGE_DIR
+        self.ttl = OUTPUT_TTL_SECONDS if ttl is None else ttl
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+        except OSError as e:
+            raise StorageError(f"Could not create {self.directory}: {e}") from e
+
+    def save(self, content, filename):
+        self._purge(time.time())
+        file_id = uuid.uuid4().hex
+        path = self._path(file_id)
+        tmp_path = f"{path}.tmp"
+        try:
+            with open(tmp_path, 'wb') as f:
+                f.write(content)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            raise StorageError(f"Could not write {path}: {e}") from e
+        return file_id
+
+    def load(self, file_id):
+        try:
+            with open(self._path(file_id), 'rb') as f:
+                return f.read()
+        except OSError as e:
+            raise StorageError(f"File {file_id} not found") from e
+
+    def delete(self, file_id):
+        try:
+            os.unlink(self._path(file_id))
+        except FileNotFoundError:
+            pass
+
+    def _purge(self, now):
+        if not self.ttl:
+            return
+        try:
+            entries = list(os.scandir(self.directory))
+        except OSError:
+            return
+        for entry in entries:
+            try:
+                if entry.name.endswith('.pdf') and entry.stat().st_mtime <= now - self.ttl:
+                    os.unlink(entry.path)
+            except OSError:
+                # Removed by another process in the meantime
+                pass
+
+    def _path(self, file_id):
+        # IDs are generated by save(), reject anything else to stay inside the directory
+        if not re.fullmatch(r'[0-9a-f]{32}', file_id or ''):
+            raise StorageError(f"Invalid file ID: {file_id!r}")
+        return os.path.join(self.directory, f"{file_id}.pdf")
+
+class AppwriteStorage(OutputStorage):
+    """
+    Files in an Appwrite Storage bucket. Only async job outputs are
+    deleted (see src/jobs.py), retention of the rest is up to whoever owns
+    the bucket.
+    """
+
+    name = 'appwrite'
+
+    def __init__(self, bucket_id=None, api_key=None):
+        from appwrite.client import Client
+        from appwrite.services.storage import Storage
+
+        bucket_id = bucket_id or OUTPUT_BUCKET_ID
+        if not bucket_id:
+            raise StorageError("OUTPUT_BUCKET_ID is not configured")
+
+        endpoint = os.environ.get('APPWRITE_FUNCTION_API_ENDPOINT') or os.environ.get('APPWRITE_ENDPOINT', '')
+        project = os.environ.get('APPWRITE_FUNCTION_PROJECT_ID') or os.environ.get('APPWRITE_PROJECT_ID', '')
+        api_key = api_key or os.environ.get('APPWRITE_API_KEY', '')
+        if not (endpoint and project and api_key):
+            raise StorageError("Appwrite endpoint, project or API key is not configured")
+
+        client = Client()
+        client.set_endpoint(endpoint)
+        client.set_project(project)
+        client.set_key(api_key)
+
+        self.bucket_id = bucket_id
+        self.storage = Storage(client)
+
+    def save(self, content, filename):
+        from appwrite.id import ID
+        from appwrite.input_file import InputFile
+
+        try:
+            result = self.storage.create_file(
+                self.bucket_id, ID.unique(),
+                InputFile.from_bytes(content, filename=filename, mime_type='application/pdf')
+            )
+        except Exception as e:
+            raise StorageError(f"Upload to bucket {self.bucket_id} failed: {e}") from e
+        # Older SDKs return a dict, newer ones a model
+        return result['$id'] if isinstance(result, dict) else result.id
+
+    def load(self, file_id):
+        try:
+            return self.storage.get_file_download(self.bucket_id, file_id)
+        except Exception as e:
+            raise StorageError(f"Download of {file_id} failed: {e}") from e
+
+    def delete(self, file_id):
+        try:
+            self.storage.delete_file(self.bucket_id, file_id)
+        except Exception as e:
+            raise StorageError(f"Delete of {file_id} failed: {e}") from e
+
+    def describe(self):
+        return {'storage': self.name, 'bucket': self.bucket_id}
+
+def get_output_storage(api_key=None):
+    """
+    Backend selected by OUTPUT_STORAGE. ``api_key`` (e.g. the function's
+    X-Appwrite-Key header) overrides APPWRITE_API_KEY for Appwrite.
+    """
+    backend = OUTPUT_STORAGE or ('appwrite' if OUTPUT_BUCKET_ID else 'local')
+    if backend == 'appwrite':
+        return AppwriteStorage(api_key=api_key)
+    if backend == 'local':
+        return LocalStorage()
+    raise StorageError(f"Unknown OUTPUT_STORAGE backend: {backend}")
@@ -0,0 +1,136 @@
+import json
+from urllib.parse import parse_qsl
+
+PDF_CONTENT_TYPE = 'application/pdf'
+MULTIPART_CONTENT_TYPE = 'multipart/form-data'
+
+def request_header(req, name, default=''):
+    """
+    Case-insensitive header lookup on an Appwrite request
+    """
+    name = name.lower()
+    for key, value in dict(req.headers or {}).items():
+        if key.lower() == name:
+            return value
+    return default
+
+def is_binary_upload(content_type):
+    """
+    True for request bodies that carry raw PDF bytes instead of base64 JSON
+    """
+    media_type = content_type.split(';', 1)[0].strip().lower()
+    return media_type in (PDF_CONTENT_TYPE, MULTIPART_CONTENT_TYPE)
+
+def wants_pdf_response(req):
+    """
+    True when the client asked for the merged PDF as raw bytes
+    """
+    accept = request_header(req, 'accept').lower()
+    return any(
+        part.split(';', 1)[0].strip() == PDF_CONTENT_TYPE
+        for part in accept.split(',')
+    )
+
+def read_binary_upload(req, content_type):
+    """
+    Read the PDFs of an ``application/pdf`` or ``multipart/form-data`` body.
+
+    Returns ``(files, options)`` where ``files`` is a list of PDF bytes in
+    upload order and ``options`` holds the merge settings taken from the
+    query string and, for multipart, the non-file form fields.
+    Raises ValueError for malformed bodies.
+    """
+    body = raw_body(req)
+    if not body:
+        raise ValueError('No request body found')
+
+    options = {key: _coerce(value) for key, value in query_params(req).items()}
+    media_type = content_type.split(';', 1)[0].strip().lower()
+
+    if media_type == PDF_CONTENT_TYPE:
+        return [body], options
+
+    from email.parser import BytesParser
+    from email.policy import HTTP
+
+    files = []
+    message = BytesParser(policy=HTTP).parsebytes(
+        b'Content-Type: ' + content_type.encode('latin-1') + b'\r\n\r\n' + body
+    )
+    if not message.is_multipart():
+        raise ValueError('Malformed multipart body')
+
+    for part in message.iter_parts():
+        name = part.get_param('name', header='content-disposition')
+        payload = part.get_payload(decode=True) or b''
+        if part.get_filename() is not None or part.get_content_type() == PDF_CONTENT_TYPE:
+            files.append(payload)
+        elif name:
+            options[name] = _coerce(payload.decode('utf-8', errors='replace'))
+
+    if not files:
+        raise ValueError('No PDF files found in multipart body')
+    return files, options
+
+def raw_body(req):
+    """
+    Request body as bytes, whichever attribute the runtime exposes it on
+    """
+    body = getattr(req, 'body_binary', None)
+    if body is None:
+        body = getattr(req, 'body_raw', None) or getattr(req, 'body', None) or b''
+    if isinstance(body, str):
+        body = body.encode('latin-1', errors='replace')
+    return bytes(body)
+
+def query_params(req):
+    """
+    Query string parameters as a dict
+    """
+    query = getattr(req, 'query', None)
+    if isinstance(query, dict):
+        return dict(query)
+    return dict(parse_qsl(getattr(req, 'query_string', '') or ''))
+
+def send_pdf(res, content, headers, filename='merged_receipts.pdf', stats=None, profile=None, metrics=None,
+             receipts=None):
+    """
+    Respond with the merged PDF as raw bytes. Run statistics, the
+    encoding profile, the metrics summary and the receipt counts, if any,
+    travel in the X-Merge-Stats, X-Encoding-Profile, X-Merge-Metrics and
+    X-Merge-Receipts headers since there is no JSON body.
+    """
+    pdf_headers = dict(headers)
+    pdf_headers['Content-Type'] = PDF_CONTENT_TYPE
+    pdf_headers['Content-Disposition'] = f'attachment; filename="{filename}"'
+    pdf_headers['Content-Length'] = str(len(content))
+    pdf_headers['Access-Control-Expose-Headers'] = (
+        'Content-Disposition, X-Merge-Stats, X-Encoding-Profile, X-Merge-Metrics, X-Merge-Receipts, ETag, '
+        'X-Result-Cache'
+    )
+    if stats is not None:
+        pdf_headers['X-Merge-Stats'] = json.dumps(stats, separators=(',', ':'))
+    if profile is not None:
+        pdf_headers['X-Encoding-Profile'] = profile
+    if metrics is not None:
+        pdf_headers['X-Merge-Metrics'] = json.dumps(metrics, separators=(',', ':'))
+    if receipts is not None:
+        pdf_headers['X-Merge-Receipts'] = json.dumps(receipts, separators=(',', ':'))
+    if hasattr(res, 'binary'):
+        return res.binary(content, 200, pdf_headers)
+    return res.send(content, 200, pdf_headers)
+
+def _coerce(value):
+    """
+    Form fields and query parameters are strings: turn booleans and
+    integers back into Python values so they validate like JSON fields
+    """
+    if not isinstance(value, str):
+        return value
+    lowered = value.strip().lower()
+    if lowered in ('true', 'false'):
+        return lowered == 'true'
+    try:
+        return int(lowered)
+    except ValueError:
+        return value
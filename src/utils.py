@@ -1,127 +1,1017 @@
+import copy
+import json
+import math
 import os
-import tempfile
+import re
 import sys
-from reportlab.pdfgen import canvas
-from reportlab.lib.pagesizes import A4
+import time
+from functools import lru_cache
+from io import BytesIO
 
-def merge_pdfs(input_files, output_file, rows=3, cols=2, h_padding=20, v_padding=20):
+from .cache import get_render_cache, render_cache_key
+from .log import env_number, get_logger
+from .metrics import cpu_time, measure
+
+logger = get_logger(__name__)
+
+# Receipt region of a label page: left half, top 72.75% (customize as needed)
+CROP_WIDTH_RATIO = 0.5
+CROP_HEIGHT_RATIO = 0.7275
+ENLARGEMENT_FACTOR = 1.08
+
+def _load_crop_presets():
+    """
+    Courier presets from the environment, e.g.
+    CROP_PRESETS='{"jne": [0, 0, 0.5, 0.7]}'. Malformed JSON and invalid
+    boxes are logged and left out, the built-in presets still apply.
+    """
+    try:
+        extra = json.loads(os.environ.get('CROP_PRESETS') or '{}')
+        if not isinstance(extra, dict):
+            raise ValueError('expected a JSON object of preset name -> box')
+    except ValueError as e:
+        logger.warning('crop_presets_invalid', error=str(e))
+        return {}
+
+    presets = {}
+    for name, box in extra.items():
+        try:
+            if name == 'auto':
+                raise ValueError('"auto" is the automatic crop mode')
+            left, top, right, bottom = (float(v) for v in box)
+            if not (0 <= left < right <= 1 and 0 <= top < bottom <= 1):
+                raise ValueError('box must be [left, top, right, bottom] fractions with left < right, top < bottom')
+        except (TypeError, ValueError) as e:
+            logger.warning('crop_preset_invalid', preset=name, box=box, error=str(e))
+            continue
+        presets[name] = (left, top, right, bottom)
+    return presets
+
+# Crop presets: the receipt region as (left, top, right, bottom) fractions
+# of the page, measured from its top-left corner. "default" is the region
+# above; presets for other courier layouts come from CROP_PRESETS.
+CROP_PRESETS = {
+    'default': (0.0, 0.0, CROP_WIDTH_RATIO, CROP_HEIGHT_RATIO),
+    'full': (0.0, 0.0, 1.0, 1.0),
+    **_load_crop_presets(),
+}
+
+# "auto" locates the label on a low resolution preview (see src/autocrop.py)
+# for layouts without a preset
+AUTO_CROP = 'auto'
+AUTO_CROP_PREVIEW_DPI = 36
+CROP_MODES = (AUTO_CROP, *CROP_PRESETS)
+
+# Page selections besides explicit page numbers and ranges ("1-3,5", "2-"),
+# applied to every input document: each selected page is one receipt
+PAGE_SELECTIONS = ('all', 'first', 'last')
+
+# Rasterization resolution, reduced for better performance on serverless
+RENDER_DPI = 150
+
+# Image encoding profiles for raster receipts. "dpi" is the resolution a
+# receipt is resampled to for the size it occupies in its grid cell (None
+# keeps the 150 DPI render).
+#   rgb     - full color Flate, the original output
+#   bilevel - thresholded black/white, for thermal shipping labels
+#   gray    - 8-bit grayscale Flate
+#   photo   - JPEG, for labels with photos or colored logos
+ENCODING_PROFILES = {
+    'rgb': {'dpi': None},
+    'bilevel': {'dpi': 203, 'threshold': 160},
+    'gray': {'dpi': 150},
+    'photo': {'dpi': 150, 'jpeg_quality': 80},
+}
+
+# Layout engines: "raster" renders receipts to bitmaps, "vector" places the
+# original PDF content with page transforms
+ENGINES = ('raster', 'vector')
+
+# Seconds one poppler run may take per receipt before it is killed, 0 for
+# no limit. A merge's own time budget is the ``timeout`` merge option.
+RENDER_TIMEOUT_SECONDS = env_number('RENDER_TIMEOUT_SECONDS', 60.0)
+
+# Extra seconds a pool render task gets past the merge's time budget
+# before its receipts are given up on
+WATCHDOG_GRACE_SECONDS = 5
+
+# Reasons of receipts skipped because time ran out (see RenderTimeout)
+TIMEOUT_REASONS = ('render_timeout', 'request_timeout')
+
+class RenderTimeout(Exception):
+    """
+    A receipt render stopped by a time budget. ``reason`` is
+    "render_timeout" when the receipt used up its own time and
+    "request_timeout" when the merge ran out of time.
+    """
+
+    def __init__(self, reason, message):
+        super().__init__(message)
+        self.reason = reason
+
+    def __reduce__(self):
+        # Raised in pool workers, so it must survive pickling
+        return type(self), (self.reason, str(self))
+
+class RenderBudget:
+    """
+    Time limits of one merge's renders: ``receipt_seconds`` per receipt
+    (RENDER_TIMEOUT_SECONDS if None, no limit if 0) and ``seconds`` for
+    all of them, from now. A receipt's poppler runs (auto-crop preview
+    and render) share its limit through the budget receipt() returns.
+    Plain attributes, so pool workers get a copy; deadlines are
+    time.monotonic() values, shared by every process on the host.
+    """
+
+    def __init__(self, receipt_seconds=None, seconds=None):
+        self.receipt_seconds = RENDER_TIMEOUT_SECONDS if receipt_seconds is None else receipt_seconds
+        self.deadline = time.monotonic() + seconds if seconds else None
+        self.receipt_deadline = None
+
+    def receipt(self, receipts=1):
+        """
+        Copy of the budget for rendering ``receipts`` receipts, whose
+        poppler runs all count against one limit of ``receipt_seconds``
+        per receipt starting now
+        """
+        budget = copy.copy(self)
+        budget.receipt_deadline = time.monotonic() + self.receipt_seconds * receipts if self.receipt_seconds else None
+        return budget
+
+    def remaining(self):
+        """
+        Seconds left of the merge's budget, None without one
+        """
+        return None if self.deadline is None else self.deadline - time.monotonic()
+
+    def timeout(self):
+        """
+        ``(seconds, reason)`` for the next poppler run: the time left of
+        the tighter of the two limits and the reason a run stopped by it is
+        skipped for; seconds is None without limits. Raises RenderTimeout
+        once either is used up.
+        """
+        remaining = self.remaining()
+        if remaining is not None and remaining <= 0:
+            raise RenderTimeout('request_timeout', 'Merge time budget used up before the receipt was rendered')
+        if self.receipt_deadline is not None:
+            own = self.receipt_deadline - time.monotonic()
+            if own <= 0:
+                raise RenderTimeout('render_timeout', f'Receipt used up its {self.receipt_seconds:g}s render limit')
+        else:
+            own = self.receipt_seconds or None
+        if remaining is not None and (own is None or remaining < own):
+            return remaining, 'request_timeout'
+        return own, 'render_timeout'
+
+def merge_pdf_bytes(pdf_files, rows=3, cols=2, h_padding=20, v_padding=20, stats=None, **options):
+    """
+    Merge PDF documents given as bytes and return the merged PDF as bytes.
+    Inputs are piped to poppler and the output canvas is written to an
+    in-memory buffer; only the render cache's disk tier (see
+    src/cache.py) writes files.
+
+    Pass a dict as ``stats`` to receive the run statistics of the merge.
+    Other keyword ``options`` are passed on to merge_pdfs.
+    """
+    output = BytesIO()
+    result = merge_pdfs(pdf_files, output, rows, cols, h_padding, v_padding, **options)
+    if stats is not None and result:
+        stats.update(result)
+    return output.getvalue()
+
+def merge_pdfs(input_files, output_file, rows=3, cols=2, h_padding=20, v_padding=20, workers=None, engine='raster', use_cache=True, batch_render=False, progress=None, stream=False, profile='rgb', crop='default', pages='all', pipeline=False, concurrency=None, queue_size=None, decode=None, metrics=None, sharded=False, render_timeout=None, timeout=None):
     """
     Merge multiple PDF files into a single PDF with receipts arranged in a grid layout
     Uses PyPDF2 for better serverless compatibility
+
+    ``input_files`` may hold file paths or raw PDF bytes, and ``output_file``
+    may be a path or a writable binary stream. ``workers`` sets how many
+    processes rasterize receipts in parallel: one by default, the CPU
+    count with ``sharded``. ``engine`` picks the layout
+    engine, see ENGINES. ``use_cache`` enables the render cache and
+    ``batch_render`` renders all receipts with a single poppler run.
+    ``progress`` is called as ``progress(done, total)`` while receipts
+    (inputs for the simple fallback) are handled. ``stream`` draws
+    receipts as they are rendered, so at most a page of bitmaps is held;
+    the output PDF itself is still built in memory.
+    ``profile`` picks the raster image encoding, see ENCODING_PROFILES.
+    ``crop`` is a CROP_PRESETS name or "auto", see CROP_MODES.
+    ``pages`` picks the pages of each input that become receipts, see
+    parse_page_selection.
+    ``pipeline`` runs the raster engine as staged pipeline with
+    ``concurrency`` threads per stage and queues of ``queue_size``, see
+    src/pipeline.py. ``decode(index, source)`` turns ``input_files`` entries
+    into PDF bytes, inside the pipeline or up front otherwise.
+    ``metrics`` is an optional src.metrics.Metrics that receives per stage
+    and per receipt measurements.
+    ``sharded`` renders page aligned shards of the raster engine on
+    ``workers`` processes and lays out their receipts, see src/sharded.py.
+    ``render_timeout`` and ``timeout`` bound the raster engine's renders
+    per receipt and in total (see RenderBudget); receipts that run out of
+    time are skipped and listed in the ``skipped`` statistic.
     """
     try:
-        # Import PyPDF2 for fallback
-        from PyPDF2 import PdfReader, PdfWriter
-        from io import BytesIO
-        
-        print(f"Processing {len(input_files)} files for merging")
+        logger.debug('merge_started', files=len(input_files), engine=engine)
+
+        if decode is not None and not (pipeline and not sharded and engine == 'raster'):
+            input_files = [decode(index, source) for index, source in enumerate(input_files)]
+
+        if engine == 'vector':
+            return merge_pdfs_vector(input_files, output_file, rows, cols, h_padding, v_padding, progress=progress, crop=crop, pages=pages, metrics=metrics)
         
         # Try pdf2image first, fall back to PyPDF2 if not available
-        try:
-            from pdf2image import convert_from_path
-            from PIL import Image
-            use_pdf2image = True
-            print("Using pdf2image for processing")
-        except ImportError as e:
-            print(f"pdf2image not available: {e}, falling back to simple merge")
-            use_pdf2image = False
-        
+        use_pdf2image = pdf2image_available()
+        if not (use_pdf2image and sharded):
+            workers = workers or 1
+
+        if use_pdf2image and sharded:
+            from .sharded import run_sharded
+
+            return run_sharded(
+                input_files, output_file, rows, cols, h_padding, v_padding,
+                workers=workers, use_cache=use_cache, progress=progress, profile=profile,
+                crop=crop, pages=pages, metrics=metrics, render_timeout=render_timeout, timeout=timeout
+            )
+        if use_pdf2image and pipeline:
+            from .pipeline import run_pipeline
+
+            return run_pipeline(
+                input_files, output_file, rows, cols, h_padding, v_padding,
+                workers=workers, use_cache=use_cache, progress=progress, profile=profile,
+                crop=crop, pages=pages, concurrency=concurrency, queue_size=queue_size, decode=decode,
+                metrics=metrics, render_timeout=render_timeout, timeout=timeout
+            )
         if use_pdf2image:
-            return merge_pdfs_with_images(input_files, output_file, rows, cols, h_padding, v_padding)
+            return merge_pdfs_with_images(
+                input_files, output_file, rows, cols, h_padding, v_padding,
+                workers=workers, use_cache=use_cache, batch_render=batch_render,
+                progress=progress, stream=stream, profile=profile, crop=crop, pages=pages,
+                metrics=metrics, render_timeout=render_timeout, timeout=timeout
+            )
         else:
-            return merge_pdfs_simple(input_files, output_file)
+            return merge_pdfs_simple(input_files, output_file, progress=progress, pages=pages)
             
     except Exception as e:
-        print(f"Error in merge_pdfs: {e}")
+        logger.error('merge_failed', error=str(e))
         raise
 
-def merge_pdfs_with_images(input_files, output_file, rows=3, cols=2, h_padding=20, v_padding=20):
+@lru_cache(maxsize=None)
+def pdf2image_available():
+    """
+    True when pdf2image and Pillow can be imported. Probed once per process.
+    """
+    try:
+        import pdf2image  # noqa: F401
+        import PIL.Image  # noqa: F401
+    except ImportError as e:
+        logger.warning('pdf2image_unavailable', error=str(e), fallback='simple')
+        return False
+    return True
+
+def warm_up():
+    """
+    Import everything the raster and vector engines use and probe the
+    backends, so the first merge doesn't pay for it. Module import keeps
+    these lazy: status polls and rejected requests never need them.
+    """
+    import PyPDF2  # noqa: F401
+    import reportlab.lib.utils  # noqa: F401
+    import reportlab.pdfgen.canvas  # noqa: F401
+
+    if pdf2image_available():
+        import numpy  # noqa: F401
+
+def merge_pdfs_with_images(input_files, output_file, rows=3, cols=2, h_padding=20, v_padding=20, workers=1, use_cache=True, batch_render=False, progress=None, stream=False, profile='rgb', crop='default', pages='all', metrics=None, render_timeout=None, timeout=None):
     """
     Merge PDFs with image processing and grid layout
+
+    With ``workers`` > 1 the receipts are rasterized and cropped in a process
+    pool, but they are still placed on the grid in input order. Cropped
+    renders are looked up in the render cache first (see src/cache.py)
+    unless ``use_cache`` is False. ``batch_render`` rasterizes all cache
+    misses with one poppler run (one per worker) instead of one per file.
+
+    With ``stream`` each receipt is drawn into its cell as soon as it is
+    rendered and its bitmap released, instead of holding a page's worth of
+    bitmaps; batches are page sized. The last page is centered for the
+    receipts expected on it, so inputs that fail to render there leave
+    their cells empty.
+
+    ``profile`` selects how receipts are encoded, see ENCODING_PROFILES.
+    ``crop`` selects the receipt region, see CROP_MODES.
+
+    Every page selected by ``pages`` is a receipt of its own. Pages are
+    only listed up front; they are rendered one page per poppler run (or in
+    batches) as the grid is filled, never as whole documents.
+
+    With ``metrics`` the render, encode, draw and save stages are measured,
+    per stage and per receipt.
+
+    A receipt's poppler runs are killed once they took ``render_timeout``
+    seconds together (RENDER_TIMEOUT_SECONDS by default) and no render starts
+    ``timeout`` seconds after the merge did; the receipts concerned are
+    skipped and the rest still placed.
+
+    Returns a dict with run statistics (receipts placed, workers, timings,
+    speedup, cache hits, ``skipped`` receipts with their reason and the
+    number of ``timeouts``).
     """
-    from pdf2image import convert_from_path
-    from PIL import Image
-    
+    from reportlab.lib.pagesizes import A4
+    from reportlab.pdfgen import canvas
+
     c = canvas.Canvas(output_file, pagesize=A4)
     page_width, page_height = A4
 
     cell_width = (page_width - (cols + 1) * h_padding) / cols
     cell_height = (page_height - (rows + 1) * v_padding) / rows
 
+    cache = get_render_cache() if use_cache else None
+    cache_stats = {'hits': 0, 'misses': 0}
+
     current_receipts_on_page = []
+    per_page = rows * cols
+    page_capacity = 0
     processed_count = 0
+    render_seconds = 0.0
+    skipped = []
+    started = time.perf_counter()
+    budget = RenderBudget(render_timeout, timeout)
 
-    for input_file in input_files:
-        try:
-            print(f"Processing {input_file}")
-            
-            # Convert PDF to images with optimized settings for serverless
-            images = convert_from_path(
-                input_file, 
-                dpi=150,  # Reduced DPI for better performance
-                first_page=1, 
-                last_page=1,
-                fmt='png',
-                thread_count=1  # Single thread for serverless
+    receipts = list(_iter_receipt_pages(input_files, pages))
+    rendered = _iter_rendered_receipts(
+        receipts, workers, cache, cache_stats, batch_render,
+        batch_size=per_page if stream else None, crop=crop, budget=budget
+    )
+    for index, (input_index, input_file, page_number), outcome in rendered:
+        _report_progress(progress, index, len(receipts))
+        if isinstance(outcome, Exception):
+            skipped.append(_skipped_receipt(input_index, page_number, outcome))
+            continue
+
+        cropped_image, seconds, cpu_seconds = outcome
+        render_seconds += seconds
+        if cropped_image is None:
+            skipped.append(_skipped_receipt(input_index, page_number, None))
+            continue
+
+        # Calculate scaling
+        scaled_w, scaled_h = _scale_to_cell(*cropped_image.size, cell_width, cell_height)
+
+        bitmap_bytes = _image_bytes(cropped_image)
+        with measure(metrics, 'encode', bitmap_bytes) as encoded:
+            image = _encode_receipt(cropped_image, scaled_w, scaled_h, profile)
+        if metrics is not None:
+            input_bytes = _input_size(input_file)
+            metrics.record('render', seconds, cpu_seconds, input_bytes, bitmap_bytes)
+            metrics.receipt(
+                input_index, page_number, bytes_in=input_bytes, bitmap_bytes=bitmap_bytes,
+                render_seconds=seconds, render_cpu_seconds=cpu_seconds,
+                encode_seconds=encoded['wall_seconds'], encode_cpu_seconds=encoded['cpu_seconds'],
             )
-            
-            if not images:
-                print(f"⚠️ No images found in {input_file}. Skipping.")
-                continue
-
-            page_image = images[0]
-            img_w, img_h = page_image.size
-            print(f"Original image size: {img_w}x{img_h}")
-
-            # Crop settings (customize as needed)
-            crop_width = img_w // 2
-            crop_ratio = 0.7275
-            crop_height = int(img_h * crop_ratio)
-
-            # Crop the image
-            cropped_image = page_image.crop((0, 0, crop_width, crop_height))
-            if cropped_image.mode != "RGB":
-                cropped_image = cropped_image.convert("RGB")
-
-            # Calculate scaling
-            cropped_w, cropped_h = cropped_image.size
-            scale_factor = min(cell_width / cropped_w, cell_height / cropped_h)
-            enlargement_factor = 1.08
-            scaled_w = cropped_w * scale_factor * enlargement_factor
-            scaled_h = cropped_h * scale_factor * enlargement_factor
-
-            current_receipts_on_page.append((cropped_image, scaled_w, scaled_h))
+
+        if stream:
+            slot = processed_count % per_page
+            if slot == 0:
+                if processed_count:
+                    c.showPage()
+                # Receipts this page will hold if the remaining inputs render
+                page_capacity = min(per_page, len(receipts) - index)
+            x, y = _receipt_position(
+                slot, page_capacity, cols, cell_width, cell_height,
+                h_padding, v_padding, page_width, page_height, scaled_w, scaled_h
+            )
+            with measure(metrics, 'draw'):
+                c.drawImage(image, x, y, width=scaled_w, height=scaled_h)
+            # The canvas keeps only the compressed image, drop the bitmap now
+            del cropped_image, image, outcome
             processed_count += 1
-            print(f"Added receipt {processed_count} to page")
+            continue
 
-            # When page is full, draw and start new page
-            if len(current_receipts_on_page) == rows * cols:
-                draw_receipts_on_page(
-                    c, current_receipts_on_page, rows, cols,
+        current_receipts_on_page.append((image, scaled_w, scaled_h))
+        processed_count += 1
+        logger.debug('receipt_added', input=input_index, page=page_number, slot=len(current_receipts_on_page))
+
+        # When page is full, draw and start new page
+        if len(current_receipts_on_page) == rows * cols:
+            with measure(metrics, 'draw'):
+                _draw_encoded_page(
+                    c, current_receipts_on_page, cols,
                     cell_width, cell_height, h_padding, v_padding,
                     page_width, page_height
                 )
                 c.showPage()
+            current_receipts_on_page = []
+
+    # Draw remaining receipts if any
+    if current_receipts_on_page:
+        with measure(metrics, 'draw'):
+            _draw_encoded_page(
+                c, current_receipts_on_page, cols,
+                cell_width, cell_height, h_padding, v_padding,
+                page_width, page_height
+            )
+
+    with measure(metrics, 'save') as saved:
+        c.save()
+        saved['bytes_out'] = _output_size(output_file)
+    _report_progress(progress, len(receipts), len(receipts))
+    elapsed = time.perf_counter() - started
+    logger.info('merge_completed', engine='raster', processed=processed_count, receipts=len(receipts),
+                skipped=len(skipped), output=_output_label(output_file), elapsed_seconds=round(elapsed, 4))
+
+    if cache is not None:
+        # Process lifetime counters, for sizing the cache
+        cache_stats['totals'] = cache.stats()
+
+    return {
+        'engine': 'raster',
+        'processed': processed_count,
+        'workers': workers,
+        'batch_render': batch_render,
+        'stream': stream,
+        'profile': profile,
+        'crop': crop,
+        'pages': pages,
+        'receipts': len(receipts),
+        'elapsed_seconds': round(elapsed, 4),
+        'render_seconds': round(render_seconds, 4),
+        # Serial render time over wall time: ~1.0 single worker, ~workers when parallel pays off
+        'speedup': round(render_seconds / elapsed, 2) if elapsed > 0 else 1.0,
+        'cache': cache_stats if cache is not None else None,
+        'skipped': skipped,
+        'timeouts': sum(1 for entry in skipped if entry['reason'] in TIMEOUT_REASONS),
+    }
+
+def _skipped_receipt(input_index, page_number, outcome):
+    """
+    Entry of the ``skipped`` run statistic for a receipt whose render
+    raised ``outcome`` or, with None, rendered empty. Logged as well.
+    """
+    if outcome is None:
+        logger.warning('receipt_empty', input=input_index, page=page_number)
+        return {'input': input_index, 'page': page_number, 'reason': 'empty', 'error': 'page rendered empty'}
+    reason = outcome.reason if isinstance(outcome, RenderTimeout) else 'error'
+    logger.warning('receipt_failed', input=input_index, page=page_number, reason=reason, error=str(outcome))
+    return {'input': input_index, 'page': page_number, 'reason': reason, 'error': str(outcome)}
+
+def _render_receipt(input_file, crop='default', page_number=1, budget=None):
+    """
+    Rasterize and crop one page of an input, the first by default.
+    Returns ``(cropped image or None, seconds spent, CPU seconds spent)``,
+    the CPU time including poppler's.
+    Runs in a pool worker in parallel mode, so it must stay module level.
+
+    Only the receipt region is rasterized: the page is re-issued with its
+    cropbox set to that region and poppler renders the cropbox. Pages this
+    can't be done for (rotated, unparseable) fall back to a full render.
+
+    Poppler runs are bounded by ``budget`` (a RenderBudget, the default
+    per receipt limit if None) and share one receipt limit; RenderTimeout
+    is raised when one is killed or the budget is used up.
+    """
+    started = time.perf_counter()
+    cpu_started = cpu_time()
+    budget = (budget or RenderBudget()).receipt()
+    budget.timeout()
+
+    fractions = _crop_fractions(input_file, crop, page_number, budget)
+    region = _receipt_region_pdf(input_file, fractions, page_number)
+    if region is not None:
+        region_pdf, crop_size = region
+        images = _convert_pages(region_pdf, use_cropbox=True, budget=budget)
+    else:
+        crop_size = None
+        images = _convert_pages(input_file, first_page=page_number, last_page=page_number, budget=budget)
+    if not images:
+        return None, time.perf_counter() - started, cpu_time() - cpu_started
+
+    cropped_image = _crop_receipt_image(images[0], crop_size, fractions)
+    return cropped_image, time.perf_counter() - started, cpu_time() - cpu_started
+
+def _crop_fractions(input_file, crop='default', page_number=1, budget=None):
+    """
+    Receipt region of an input as ``(left, top, right, bottom)`` page
+    fractions: the CROP_PRESETS entry named by ``crop``, or for "auto" the
+    label found on a low resolution preview, the default preset if none is
+    found. A fractions tuple is passed through as is.
+    """
+    if isinstance(crop, tuple):
+        return crop
+    if crop != AUTO_CROP:
+        return CROP_PRESETS[crop]
+
+    import numpy as np
+    from .autocrop import content_box
+
+    try:
+        preview = _convert_pages(
+            input_file, first_page=page_number, last_page=page_number, dpi=AUTO_CROP_PREVIEW_DPI, budget=budget
+        )
+        box = content_box(np.asarray(preview[0].convert('L'))) if preview else None
+    except Exception as e:
+        logger.warning('auto_crop_failed', error=str(e))
+        box = None
+    if box is None:
+        logger.debug('auto_crop_fallback', page=page_number)
+        return CROP_PRESETS['default']
+    return box
+
+def _render_receipt_batch(receipts, crop='default', budget=None):
+    """
+    Rasterize and crop several ``(input_file, page_number)`` receipts with
+    a single poppler run: the receipt regions are concatenated into one
+    document with PdfWriter and the rendered pages are split back out in
+    order. Pages that can't join the batch, or a batch that fails to
+    render, fall back to _render_receipt one page at a time. Each receipt's
+    auto-crop preview counts against its own time limit and a receipt that
+    used it up is skipped; the batch run gets the per receipt limit of
+    ``budget`` once per page and a fallback render a limit of its own.
+    Returns one outcome per receipt, as _iter_rendered_receipts expects.
+    """
+    from PyPDF2 import PdfWriter
+
+    started = time.perf_counter()
+    cpu_started = cpu_time()
+    budget = budget or RenderBudget()
+    outcomes = [None] * len(receipts)
+    writer = PdfWriter()
+    batched = []
+
+    fractions = []
+    for position, (input_file, page_number) in enumerate(receipts):
+        receipt_budget = budget.receipt()
+        fractions.append(_crop_fractions(input_file, crop, page_number, receipt_budget))
+        try:
+            receipt_budget.timeout()
+        except RenderTimeout as e:
+            outcomes[position] = e
+    for position, (input_file, page_number) in enumerate(receipts):
+        if outcomes[position] is not None:
+            continue
+        region = _receipt_region_page(input_file, fractions[position], page_number)
+        if region is not None:
+            page, crop_size = region
+            writer.add_page(page)
+            batched.append((position, crop_size))
+
+    if batched:
+        try:
+            document = BytesIO()
+            writer.write(document)
+            images = _convert_pages(
+                document.getvalue(), first_page=None, last_page=None, use_cropbox=True,
+                budget=budget.receipt(len(batched))
+            )
+            if len(images) != len(batched):
+                raise ValueError(f"expected {len(batched)} pages, poppler returned {len(images)}")
+            seconds = (time.perf_counter() - started) / len(batched)
+            cpu_seconds = (cpu_time() - cpu_started) / len(batched)
+            for (position, crop_size), page_image in zip(batched, images):
+                outcomes[position] = (
+                    _crop_receipt_image(page_image, crop_size, fractions[position]), seconds, cpu_seconds
+                )
+            logger.debug('batch_rendered', receipts=len(batched))
+        except Exception as e:
+            logger.warning('batch_render_failed', receipts=len(batched), error=str(e))
+
+    for position, (input_file, page_number) in enumerate(receipts):
+        if outcomes[position] is None:
+            try:
+                outcomes[position] = _render_receipt(input_file, fractions[position], page_number, budget)
+            except Exception as e:
+                outcomes[position] = e
+
+    return outcomes
+
+def _crop_receipt_image(page_image, crop_size=None, fractions=None):
+    """
+    Crop a rendered page to the receipt. ``crop_size`` is the target size
+    of a region render; without it the full page is cropped to the
+    ``fractions`` region (the default preset if not given).
+    """
+    img_w, img_h = page_image.size
+    logger.debug('page_rendered', width=img_w, height=img_h)
+
+    if crop_size is None:
+        left, top, right, bottom = fractions or CROP_PRESETS['default']
+        crop_box = (int(img_w * left), int(img_h * top), int(img_w * right), int(img_h * bottom))
+    else:
+        # Region render: this only trims the rounding pixel
+        crop_width, crop_height = crop_size
+        crop_box = (0, 0, min(crop_width, img_w), min(crop_height, img_h))
+    cropped_image = page_image.crop(crop_box)
+    if cropped_image.mode != "RGB":
+        cropped_image = cropped_image.convert("RGB")
+    return cropped_image
+
+def _receipt_crop_box(page, fractions=None):
+    """
+    Receipt region of a page in PDF units as ``(left, bottom, right, top)``:
+    the ``fractions`` region of the mediabox, the default preset if not given
+    """
+    frac_left, frac_top, frac_right, frac_bottom = fractions or CROP_PRESETS['default']
+    box = page.mediabox
+    left = float(box.left)
+    top = float(box.top)
+    width = float(box.width)
+    height = float(box.height)
+    return (
+        left + width * frac_left,
+        top - height * frac_bottom,
+        left + width * frac_right,
+        top - height * frac_top,
+    )
+
+def _receipt_region_page(input_file, fractions=None, page_number=1):
+    """
+    Page ``page_number`` of the input with its cropbox set to the receipt region,
+    plus the pixel size a full-page render would have been cropped to.
+    Returns None when the region can't be expressed that way.
+    """
+    from PyPDF2 import PdfReader
+    from PyPDF2.generic import RectangleObject
+
+    try:
+        reader = PdfReader(_as_stream(input_file))
+        if len(reader.pages) < page_number:
+            return None
+        page = reader.pages[page_number - 1]
+        if page.rotation % 360:
+            return None
+
+        # Full-page pixel size as pdftoppm computes it, so the trimmed
+        # region render matches the legacy full render + crop exactly
+        box = page.mediabox
+        full_w = math.ceil(float(box.width) * RENDER_DPI / 72)
+        full_h = math.ceil(float(box.height) * RENDER_DPI / 72)
+        left, top, right, bottom = fractions or CROP_PRESETS['default']
+        crop_size = (
+            int(full_w * right) - int(full_w * left),
+            int(full_h * bottom) - int(full_h * top),
+        )
+
+        page.cropbox = RectangleObject(_receipt_crop_box(page, fractions))
+        return page, crop_size
+    except Exception as e:
+        logger.debug('region_render_unavailable', page=page_number, error=str(e))
+        return None
+
+def _receipt_region_pdf(input_file, fractions=None, page_number=1):
+    """
+    The region page of _receipt_region_page as a standalone PDF
+    """
+    from PyPDF2 import PdfWriter
+
+    region = _receipt_region_page(input_file, fractions, page_number)
+    if region is None:
+        return None
+    page, crop_size = region
+    try:
+        writer = PdfWriter()
+        writer.add_page(page)
+        output = BytesIO()
+        writer.write(output)
+        return output.getvalue(), crop_size
+    except Exception as e:
+        logger.debug('region_render_unavailable', page=page_number, error=str(e))
+        return None
+
+def parse_page_selection(selection):
+    """
+    Normalize a page selection: one of PAGE_SELECTIONS, or 1-based page
+    numbers and ranges such as "1-3,5" or "2-" (through the last page).
+    An int or a list of ints selects those pages.
+    Returns the selection as a string, raises ValueError if it is invalid.
+    """
+    if isinstance(selection, int) and not isinstance(selection, bool):
+        selection = str(selection)
+    elif isinstance(selection, list) and all(
+        isinstance(number, int) and not isinstance(number, bool) for number in selection
+    ):
+        selection = ','.join(str(number) for number in selection)
+    if not isinstance(selection, str):
+        raise ValueError(f"Invalid page selection: {selection!r}")
+
+    selection = selection.replace(' ', '').lower()
+    if selection in PAGE_SELECTIONS:
+        return selection
+    for part in selection.split(','):
+        match = re.fullmatch(r'([1-9][0-9]*)(-([1-9][0-9]*)?)?', part)
+        if not match or (match.group(3) and int(match.group(3)) < int(match.group(1))):
+            raise ValueError(f"Invalid page selection: {part!r}")
+    return selection
+
+def _page_numbers(selection, page_count):
+    """
+    1-based page numbers picked by a parse_page_selection string in a
+    document of ``page_count`` pages, in selection order. Pages past the
+    end are ignored.
+    """
+    if selection == 'all':
+        return list(range(1, page_count + 1))
+    if selection in ('first', 'last'):
+        return [1 if selection == 'first' else page_count] if page_count else []
+
+    numbers = []
+    for part in selection.split(','):
+        start, dash, end = part.partition('-')
+        last = int(end) if end else (page_count if dash else int(start))
+        numbers.extend(range(int(start), min(last, page_count) + 1))
+    return numbers
+
+def _iter_receipt_pages(input_files, pages='all'):
+    """
+    Expand inputs into receipts, one per selected page: yields
+    ``(input_index, input_file, page_number)`` lazily. Only page counts are
+    read here, nothing is rendered. Unreadable inputs yield their first
+    page so the renderer reports the error.
+    """
+    from PyPDF2 import PdfReader
+
+    for input_index, input_file in enumerate(input_files):
+        if pages == 'first':
+            yield input_index, input_file, 1
+            continue
+        try:
+            page_count = len(PdfReader(_as_stream(input_file)).pages)
+        except Exception as e:
+            logger.warning('page_count_failed', input=input_index, error=str(e))
+            yield input_index, input_file, 1
+            continue
+
+        page_numbers = _page_numbers(pages, page_count)
+        if not page_numbers:
+            logger.warning('no_pages_selected', input=input_index, pages=pages)
+        for page_number in page_numbers:
+            yield input_index, input_file, page_number
+
+def _split_evenly(items, parts):
+    """
+    Split ``items`` into at most ``parts`` contiguous chunks of near equal size
+    """
+    parts = max(1, min(parts, len(items)))
+    size, extra = divmod(len(items), parts)
+    chunks = []
+    start = 0
+    for part in range(parts):
+        end = start + size + (1 if part < extra else 0)
+        chunks.append(items[start:end])
+        start = end
+    return chunks
+
+def _render_cache_key(input_file, crop='default', page_number=1):
+    """
+    Cache key of the cropped render of one page, or None if it can't be read
+    """
+    try:
+        if isinstance(input_file, (bytes, bytearray)):
+            pdf_bytes = bytes(input_file)
+        else:
+            with open(input_file, 'rb') as f:
+                pdf_bytes = f.read()
+    except OSError:
+        return None
+    if crop == AUTO_CROP:
+        # The detected region follows from the PDF and the preview settings
+        crop_params = (AUTO_CROP, AUTO_CROP_PREVIEW_DPI)
+    else:
+        crop_params = CROP_PRESETS[crop]
+    return render_cache_key(pdf_bytes, dpi=RENDER_DPI, crop=crop_params, page=page_number)
+
+def _iter_rendered_receipts(receipts, workers=1, cache=None, cache_stats=None, batch_render=False, batch_size=None, crop='default', budget=None):
+    """
+    Yield ``(index, receipt, outcome)`` in order for the
+    ``(input_index, input_file, page_number)`` entries of ``receipts``,
+    where outcome is the result of _render_receipt or the exception it raised.
+    Cache hits are served without rendering; only misses reach the workers.
+    With ``batch_render`` the misses are rendered by _render_receipt_batch,
+    as one contiguous batch per worker, or in batches of ``batch_size``.
+
+    Work is handed out lazily: at most ``2 * workers`` render tasks are in
+    flight ahead of the consumer, so finished bitmaps don't pile up while
+    earlier receipts are still being placed.
+
+    Renders are bounded by ``budget``, see RenderBudget. As a watchdog, a
+    pool task still running WATCHDOG_GRACE_SECONDS after the budget ran
+    out is given up on: its receipts fail with RenderTimeout and the pool
+    is left to wind down on its own.
+    """
+    budget = budget or RenderBudget()
+    keys = [None] * len(receipts)
+    outcomes = {}
+    if cache is not None:
+        for index, (_, input_file, page_number) in enumerate(receipts):
+            keys[index] = _render_cache_key(input_file, crop, page_number)
+            cached = cache.get(keys[index]) if keys[index] else None
+            if cached is not None:
+                outcomes[index] = (cached, 0.0, 0.0)
+                cache_stats['hits'] += 1
+            else:
+                cache_stats['misses'] += 1
+
+    pending = [index for index in range(len(receipts)) if index not in outcomes]
+    if not batch_render:
+        tasks = [[index] for index in pending]
+    elif batch_size:
+        tasks = [pending[start:start + batch_size] for start in range(0, len(pending), batch_size)]
+    else:
+        tasks = _split_evenly(pending, workers) if pending else []
+    task_of = {index: number for number, task in enumerate(tasks) for index in task}
+
+    pool = None
+    futures = {}
+    next_task = 0
+    abandoned = False
+    if workers > 1 and len(tasks) > 1:
+        from concurrent.futures import ProcessPoolExecutor
+
+        pool = ProcessPoolExecutor(max_workers=min(workers, len(tasks)))
+
+    try:
+        # Consume in input order so the grid keeps the input order
+        for index, receipt in enumerate(receipts):
+            if index not in outcomes:
+                number = task_of[index]
+                task_receipts = [receipts[i][1:] for i in tasks[number]]
+                try:
+                    if pool is None:
+                        results = _render_receipts(task_receipts, batch_render, crop, budget)
+                    else:
+                        while next_task < len(tasks) and next_task <= number + 2 * workers:
+                            futures[next_task] = pool.submit(
+                                _render_receipts, [receipts[i][1:] for i in tasks[next_task]], batch_render,
+                                crop, budget
+                            )
+                            next_task += 1
+                        remaining = budget.remaining()
+                        wait = None if remaining is None else max(remaining, 0) + WATCHDOG_GRACE_SECONDS
+                        try:
+                            results = futures.pop(number).result(timeout=wait)
+                        except TimeoutError:
+                            abandoned = True
+                            logger.error('render_watchdog_fired', receipts=len(task_receipts))
+                            raise RenderTimeout(
+                                'request_timeout', 'Render still running when the merge time budget ran out'
+                            )
+                except Exception as e:
+                    results = [e] * len(task_receipts)
+                outcomes.update(zip(tasks[number], results))
+
+            outcome = outcomes.pop(index)
+            rendered = index in task_of and not isinstance(outcome, Exception)
+            if cache is not None and keys[index] and rendered and outcome[0] is not None:
+                cache.put(keys[index], outcome[0])
+
+            yield index, receipt, outcome
+    finally:
+        if pool is not None:
+            # A stuck task would hold up the merge again in shutdown
+            pool.shutdown(wait=not abandoned, cancel_futures=True)
+
+def _render_receipts(receipts, batch_render=False, crop='default', budget=None):
+    """
+    One render task: outcomes for the ``(input_file, page_number)``
+    ``receipts`` in order, each a _render_receipt result or the exception
+    it raised. Module level so it can run in a pool worker.
+    """
+    if batch_render:
+        return _render_receipt_batch(receipts, crop, budget)
+    outcomes = []
+    for input_file, page_number in receipts:
+        try:
+            outcomes.append(_render_receipt(input_file, crop, page_number, budget))
+        except Exception as e:
+            outcomes.append(e)
+    return outcomes
+
+def merge_pdfs_vector(input_files, output_file, rows=3, cols=2, h_padding=20, v_padding=20, progress=None, crop='default', pages='all', metrics=None):
+    """
+    Merge PDFs into the same grid as merge_pdfs_with_images without
+    rasterizing: the receipt region of each selected page is clipped, scaled
+    and translated into its cell with a PDF transformation matrix, so text
+    and barcodes stay vector. An "auto" ``crop`` still renders a small
+    preview to find the label. ``metrics`` measures the clip, compose and
+    write stages.
+    """
+    from PyPDF2 import PageObject, PdfReader, PdfWriter
+    from reportlab.lib.pagesizes import A4
+
+    writer = PdfWriter()
+    page_width, page_height = A4
+
+    cell_width = (page_width - (cols + 1) * h_padding) / cols
+    cell_height = (page_height - (rows + 1) * v_padding) / rows
+
+    current_receipts_on_page = []
+    processed_count = 0
+    started = time.perf_counter()
+
+    receipts = list(_iter_receipt_pages(input_files, pages))
+    reader = None
+    reader_index = None
+    for index, (input_index, input_file, page_number) in enumerate(receipts):
+        _report_progress(progress, index, len(receipts))
+        try:
+            logger.debug('receipt_placing', input=input_index, page=page_number)
+            with measure(metrics, 'clip', _input_size(input_file)) as clipped:
+                # Pages of one input share its reader
+                if reader_index != input_index:
+                    reader, reader_index = PdfReader(_as_stream(input_file)), input_index
+                if len(reader.pages) < page_number:
+                    logger.warning('receipt_empty', input=input_index, page=page_number)
+                    continue
+
+                # reader.pages hands out one shared object per page: a page
+                # selected twice ("1,1") would be transformed and boxed once
+                # per placement, so place a shallow copy instead
+                page = PageObject(reader)
+                page.update(reader.pages[page_number - 1])
+                # Bake /Rotate into the content so the crop sees the page as displayed
+                if page.rotation:
+                    page.transfer_rotation_to_content()
+
+                # Same region the raster engine renders
+                crop_left, crop_bottom, crop_right, crop_top = _receipt_crop_box(page, _crop_fractions(input_file, crop, page_number))
+                crop_w = crop_right - crop_left
+                crop_h = crop_top - crop_bottom
+
+                scaled_w, scaled_h = _scale_to_cell(crop_w, crop_h, cell_width, cell_height)
+            if metrics is not None:
+                metrics.receipt(
+                    input_index, page_number, bytes_in=_input_size(input_file),
+                    clip_seconds=clipped['wall_seconds'], clip_cpu_seconds=clipped['cpu_seconds'],
+                )
+            current_receipts_on_page.append((page, crop_left, crop_bottom, crop_w, scaled_w, scaled_h))
+            processed_count += 1
+
+            if len(current_receipts_on_page) == rows * cols:
+                with measure(metrics, 'compose'):
+                    _place_vector_page(
+                        writer, current_receipts_on_page, cols,
+                        cell_width, cell_height, h_padding, v_padding,
+                        page_width, page_height
+                    )
                 current_receipts_on_page = []
-                print("Page completed, starting new page")
 
         except Exception as e:
-            print(f"❌ Failed to process {input_file}: {e}")
+            logger.warning('receipt_failed', input=input_index, page=page_number, error=str(e))
             continue
 
-    # Draw remaining receipts if any
     if current_receipts_on_page:
-        print(f"Drawing final page with {len(current_receipts_on_page)} receipts")
-        draw_receipts_on_page(
-            c, current_receipts_on_page, rows, cols,
-            cell_width, cell_height, h_padding, v_padding,
-            page_width, page_height
+        with measure(metrics, 'compose'):
+            _place_vector_page(
+                writer, current_receipts_on_page, cols,
+                cell_width, cell_height, h_padding, v_padding,
+                page_width, page_height
+            )
+
+    with measure(metrics, 'save') as saved:
+        writer.write(output_file)
+        saved['bytes_out'] = _output_size(output_file)
+    _report_progress(progress, len(receipts), len(receipts))
+    logger.info('merge_completed', engine='vector', processed=processed_count, receipts=len(receipts),
+                output=_output_label(output_file))
+
+    return {
+        'engine': 'vector',
+        'processed': processed_count,
+        'workers': 1,
+        'crop': crop,
+        'pages': pages,
+        'receipts': len(receipts),
+        'elapsed_seconds': round(time.perf_counter() - started, 4),
+    }
+
+def _place_vector_page(writer, receipts, cols, cell_width, cell_height,
+                       h_padding, v_padding, page_width, page_height):
+    """
+    Add one A4 page to ``writer`` with the given receipt pages merged into
+    their grid cells
+    """
+    from PyPDF2 import PageObject, Transformation
+    from PyPDF2.generic import RectangleObject
+
+    # Build the page before adding it: the writer stores its own copy
+    target = PageObject.create_blank_page(None, page_width, page_height)
+    num_receipts = len(receipts)
+
+    for i, (page, crop_left, crop_bottom, crop_w, scaled_w, scaled_h) in enumerate(receipts):
+        x, y = _receipt_position(
+            i, num_receipts, cols, cell_width, cell_height,
+            h_padding, v_padding, page_width, page_height, scaled_w, scaled_h
         )
+        scale = scaled_w / crop_w
+        page.add_transformation(
+            Transformation().translate(-crop_left, -crop_bottom).scale(scale, scale).translate(x, y)
+        )
+        # merge_page clips the merged content to the trimbox, in target coordinates
+        page.trimbox = RectangleObject((x, y, x + scaled_w, y + scaled_h))
+        target.merge_page(page)
 
-    c.save()
-    print(f"✅ Successfully merged {processed_count} receipts into '{output_file}'")
+    writer.add_page(target)
 
-def merge_pdfs_simple(input_files, output_file):
+def merge_pdfs_simple(input_files, output_file, progress=None, pages='all'):
     """
     Simple PDF merge without image processing - fallback method
     """
@@ -130,34 +1020,129 @@ def merge_pdfs_simple(input_files, output_file):
     writer = PdfWriter()
     processed_count = 0
     
-    for input_file in input_files:
+    for index, input_file in enumerate(input_files):
+        _report_progress(progress, index, len(input_files))
         try:
-            print(f"Adding {input_file} to merge")
-            reader = PdfReader(input_file)
+            logger.debug('input_adding', input=index)
+            reader = PdfReader(_as_stream(input_file))
             
-            # Add all pages from this PDF
-            for page in reader.pages:
-                writer.add_page(page)
+            # Add the selected pages from this PDF
+            for page_number in _page_numbers(pages, len(reader.pages)):
+                writer.add_page(reader.pages[page_number - 1])
                 processed_count += 1
                 
         except Exception as e:
-            print(f"❌ Failed to process {input_file}: {e}")
+            logger.warning('input_failed', input=index, error=str(e))
             continue
     
-    # Write merged PDF
-    with open(output_file, 'wb') as output:
-        writer.write(output)
+    # Write merged PDF (PdfWriter accepts a path or a binary stream)
+    writer.write(output_file)
+    _report_progress(progress, len(input_files), len(input_files))
     
-    print(f"✅ Successfully merged {len(input_files)} PDFs with {processed_count} total pages")
+    logger.info('merge_completed', engine='simple', files=len(input_files), processed=processed_count)
+
+    return {'processed': processed_count, 'workers': 1}
 
 def draw_receipts_on_page(c, receipts, rows, cols,
                           cell_width, cell_height,
                           h_padding, v_padding,
-                          page_width, page_height):
+                          page_width, page_height,
+                          profile='rgb'):
+    """
+    Draw receipts on a single page with proper positioning,
+    encoded with the given ENCODING_PROFILES entry
     """
-    Draw receipts on a single page with proper positioning
+    encoded = [
+        (_encode_receipt(img, scaled_w, scaled_h, profile), scaled_w, scaled_h)
+        for img, scaled_w, scaled_h in receipts
+    ]
+    _draw_encoded_page(
+        c, encoded, cols, cell_width, cell_height,
+        h_padding, v_padding, page_width, page_height
+    )
+
+def _draw_encoded_page(c, receipts, cols, cell_width, cell_height,
+                       h_padding, v_padding, page_width, page_height):
+    """
+    Draw receipts already encoded by _encode_receipt, as
+    ``(ImageReader, scaled_w, scaled_h)``, into their grid cells
     """
     num_receipts = len(receipts)
+
+    for i, (image, scaled_w, scaled_h) in enumerate(receipts):
+        x, y = _receipt_position(
+            i, num_receipts, cols, cell_width, cell_height,
+            h_padding, v_padding, page_width, page_height, scaled_w, scaled_h
+        )
+
+        # Hand the image straight to reportlab, no intermediate PNG file
+        c.drawImage(image, x, y, width=scaled_w, height=scaled_h)
+
+def _encode_receipt(image, scaled_w, scaled_h, profile='rgb'):
+    """
+    ImageReader for a cropped receipt encoded with an ENCODING_PROFILES
+    entry, see _resample_receipt
+    """
+    from reportlab.lib.utils import ImageReader
+
+    image = _resample_receipt(image, scaled_w, scaled_h, profile)
+    if profile == 'photo':
+        # reportlab embeds JPEG data as is (DCTDecode) instead of re-encoding
+        return ImageReader(BytesIO(_jpeg_bytes(image)))
+    return ImageReader(image)
+
+def _resample_receipt(image, scaled_w, scaled_h, profile='rgb'):
+    """
+    Cropped receipt prepared for an ENCODING_PROFILES entry. The image is
+    first downsampled to the profile's DPI at the size the receipt is drawn
+    (``scaled_w`` x ``scaled_h`` points), then converted to the profile's
+    color mode.
+    """
+    from PIL import Image
+
+    settings = ENCODING_PROFILES[profile]
+    if settings['dpi']:
+        target = (
+            max(1, round(scaled_w / 72 * settings['dpi'])),
+            max(1, round(scaled_h / 72 * settings['dpi'])),
+        )
+        if target[0] < image.width:
+            image = image.resize(target, Image.Resampling.BOX if profile == 'bilevel' else Image.Resampling.LANCZOS)
+
+    if profile == 'bilevel':
+        import numpy as np
+
+        # Vectorized threshold: every pixel ends up pure black or white, which
+        # Flate compresses to a fraction of the antialiased gray
+        pixels = np.asarray(image.convert('L'))
+        image = Image.fromarray(np.where(pixels < settings['threshold'], 0, 255).astype(np.uint8), 'L')
+    elif profile == 'gray':
+        image = image.convert('L')
+    elif profile == 'photo':
+        image = image.convert('RGB')
+    return image
+
+def _jpeg_bytes(image, profile='photo'):
+    buffer = BytesIO()
+    image.save(buffer, 'JPEG', quality=ENCODING_PROFILES[profile]['jpeg_quality'])
+    return buffer.getvalue()
+
+def _scale_to_cell(width, height, cell_width, cell_height):
+    """
+    Size of a receipt fitted into a grid cell, plus the enlargement factor.
+    Only the aspect ratio of ``width``/``height`` matters, so pixels and
+    PDF points give the same result.
+    """
+    scale_factor = min(cell_width / width, cell_height / height) * ENLARGEMENT_FACTOR
+    return width * scale_factor, height * scale_factor
+
+def _receipt_position(i, num_receipts, cols, cell_width, cell_height,
+                      h_padding, v_padding, page_width, page_height,
+                      scaled_w, scaled_h):
+    """
+    Bottom-left corner of receipt ``i`` on a page holding ``num_receipts``.
+    The occupied part of the grid is centered on the page.
+    """
     current_rows = (num_receipts + cols - 1) // cols
     current_cols = min(num_receipts, cols)
 
@@ -168,33 +1153,94 @@ def draw_receipts_on_page(c, receipts, rows, cols,
     offset_x = (page_width - total_width) / 2
     offset_y = (page_height - total_height) / 2
 
-    # Create a list to store temp files for cleanup
-    temp_files = []
+    row = i // cols
+    col = i % cols
 
+    # Calculate position
+    x = offset_x + col * (cell_width + h_padding) + (cell_width - scaled_w) / 2
+    y = page_height - (offset_y + (row + 1) * (cell_height + v_padding)) + v_padding + (cell_height - scaled_h) / 2
+    return x, y
+
+def _convert_pages(source, first_page=1, last_page=1, use_cropbox=False, dpi=RENDER_DPI, budget=None):
+    """
+    Rasterize pages of a PDF given as a path or as bytes, the first page
+    only by default, every page when both bounds are None. With
+    ``use_cropbox`` poppler renders only each page's cropbox.
+
+    Bytes are piped to pdftoppm's stdin and the PPM images are read from
+    its stdout, so no temporary files are written (pdf2image's
+    convert_from_bytes goes through one) and there is no separate pdfinfo
+    run. Poppler is killed when it runs past the time ``budget`` has left
+    (see RenderBudget.timeout), raising RenderTimeout.
+    """
+    import subprocess
+    from pdf2image.parsers import parse_buffer_to_ppm
+
+    timeout, reason = (budget or RenderBudget().receipt()).timeout()
+
+    args = ['pdftoppm', '-r', str(dpi)]
+    if first_page is not None:
+        args += ['-f', str(first_page)]
+    if last_page is not None:
+        args += ['-l', str(last_page)]
+    if use_cropbox:
+        args.append('-cropbox')
+    piped = isinstance(source, (bytes, bytearray))
+    args.append('-' if piped else os.fspath(source))
     try:
-        for i, (img, scaled_w, scaled_h) in enumerate(receipts):
-            row = i // cols
-            col = i % cols
+        result = subprocess.run(args, input=bytes(source) if piped else None, capture_output=True, timeout=timeout)
+    except subprocess.TimeoutExpired:
+        raise RenderTimeout(reason, f'Render killed after {timeout:.1f}s')
+    if result.returncode != 0:
+        error = result.stderr.decode('utf8', 'ignore').strip()
+        raise RuntimeError(f'pdftoppm exited with status {result.returncode}: {error}')
+    return parse_buffer_to_ppm(result.stdout)
 
-            # Calculate position
-            x = offset_x + col * (cell_width + h_padding) + (cell_width - scaled_w) / 2
-            y = page_height - (offset_y + (row + 1) * (cell_height + v_padding)) + v_padding + (cell_height - scaled_h) / 2
+def _as_stream(source):
+    """
+    Return something PdfReader can open: raw bytes are wrapped in a buffer
+    """
+    if isinstance(source, (bytes, bytearray)):
+        return BytesIO(source)
+    return source
 
-            # Save image to temporary file with optimization
-            with tempfile.NamedTemporaryFile(delete=False, suffix=".png") as tmp:
-                tmp_path = tmp.name
-                # Optimize image saving for serverless
-                img.save(tmp_path, "PNG", optimize=True, compress_level=6)
-                temp_files.append(tmp_path)
+def _report_progress(progress, done, total):
+    """
+    Call the progress callback, never letting it break the merge
+    """
+    if progress is None:
+        return
+    try:
+        progress(done, total)
+    except Exception as e:
+        logger.warning('progress_callback_failed', error=str(e))
 
-            # Draw image on canvas
-            c.drawImage(tmp_path, x, y, width=scaled_w, height=scaled_h)
+def _image_bytes(image):
+    """
+    Decoded size of a PIL image in bytes
+    """
+    return image.width * image.height * len(image.getbands())
 
-    finally:
-        # Clean up temporary files
-        for temp_file in temp_files:
-            try:
-                if os.path.exists(temp_file):
-                    os.unlink(temp_file)
-            except Exception as e:
-                print(f"Warning: Could not clean up temp file {temp_file}: {e}")
\ No newline at end of file
+def _input_size(source):
+    """
+    Size in bytes of an input given as bytes or as a path
+    """
+    if isinstance(source, (bytes, bytearray)):
+        return len(source)
+    try:
+        return os.path.getsize(source)
+    except OSError:
+        return 0
+
+def _output_size(output_file):
+    """
+    Bytes written to a stream or file after the merge
+    """
+    if hasattr(output_file, 'tell'):
+        return output_file.tell()
+    return _input_size(output_file)
+
+def _output_label(output_file):
+    if hasattr(output_file, 'write'):
+        return "output buffer"
+    return f"'{output_file}'"
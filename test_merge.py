@@ -0,0 +1,197 @@
+#!/usr/bin/env python3
+"""
+Offline tests for the PDF Merger function: merge modes, result cache,
+prepare/compose and render time limits, run against src.main and
+src.utils directly.
+
+poppler is replaced by a small fake ``pdftoppm`` put first on PATH, so the
+tests run anywhere the Python requirements are installed:
+
+    python -m pytest test_merge.py
+    python test_merge.py
+"""
+
+import atexit
+import base64
+import io
+import json
+import os
+import shutil
+import stat
+import sys
+import tempfile
+import time
+
+# Settings are read when the src modules load, so point every store at a
+# scratch directory and turn the result cache on first
+SCRATCH_DIR = tempfile.mkdtemp(prefix='resi-merger-test-')
+atexit.register(shutil.rmtree, SCRATCH_DIR, ignore_errors=True)
+os.environ.update({
+    'PREPARED_STORE_PATH': os.path.join(SCRATCH_DIR, 'prepared.sqlite3'),
+    'JOB_STORE_PATH': os.path.join(SCRATCH_DIR, 'jobs.sqlite3'),
+    'RENDER_CACHE_DIR': os.path.join(SCRATCH_DIR, 'render-cache'),
+    'RESULT_CACHE': '1',
+    'LOG_LEVEL': 'error',
+})
+
+# Marker text that makes the fake pdftoppm hang until it is killed
+SLOW_MARKER = 'SLOW-RENDER'
+
+# Fake pdftoppm: reads the PDF (from stdin for "-"), and writes one PPM per
+# page in range at the page's (crop)box size, white with a black block
+FAKE_PDFTOPPM = f'''#!{sys.executable}
+import io, sys, time
+from PyPDF2 import PdfReader
+
+args = sys.argv[1:]
+options = dict(zip(args[:-1], args[1:]))
+data = sys.stdin.buffer.read() if args[-1] == '-' else open(args[-1], 'rb').read()
+if {SLOW_MARKER!r}.encode() in data:
+    time.sleep(3600)
+pages = PdfReader(io.BytesIO(data)).pages
+dpi = float(options.get('-r', 150))
+first = int(options.get('-f', 1))
+last = min(int(options.get('-l', len(pages))), len(pages))
+for page in pages[first - 1:last]:
+    box = page.cropbox if '-cropbox' in args else page.mediabox
+    width = round(float(box.width) * dpi / 72)
+    height = round(float(box.height) * dpi / 72)
+    blank = b'\\xff' * (width * 3)
+    inked = blank[:width // 10 * 3] + b'\\x00' * ((width // 3 - width // 10) * 3) + blank[width // 3 * 3:]
+    sys.stdout.buffer.write(b'P6\\n%d %d\\n255\\n' % (width, height))
+    for y in range(height):
+        sys.stdout.buffer.write(inked if height // 10 <= y < height // 2 else blank)
+'''
+
+_bin_dir = os.path.join(SCRATCH_DIR, 'bin')
+os.makedirs(_bin_dir)
+_fake_path = os.path.join(_bin_dir, 'pdftoppm')
+with open(_fake_path, 'w') as f:
+    f.write(FAKE_PDFTOPPM)
+os.chmod(_fake_path, os.stat(_fake_path).st_mode | stat.S_IXUSR)
+os.environ['PATH'] = _bin_dir + os.pathsep + os.environ.get('PATH', '')
+
+from reportlab import rl_config
+
+# No timestamps or random IDs in the output, so equal merges are equal bytes
+rl_config.invariant = 1
+
+from src.context import LocalContext, LocalRequest
+from src.main import main
+from src.utils import merge_pdf_bytes
+
+def make_label_pdf(label, pages=1, slow=False):
+    """Small label PDF; ``slow`` ones carry SLOW_MARKER uncompressed"""
+    from reportlab.lib.pagesizes import A4
+    from reportlab.pdfgen import canvas
+
+    buffer = io.BytesIO()
+    c = canvas.Canvas(buffer, pagesize=A4, pageCompression=0)
+    for number in range(pages):
+        c.rect(20, 300, 250, 500, fill=1)
+        c.drawString(30, 820, f'{SLOW_MARKER if slow else "label"} {label} page {number + 1}')
+        c.showPage()
+    c.save()
+    return buffer.getvalue()
+
+def call(body, path='/', headers=None):
+    """Run main on a JSON request, returning (status, headers, parsed body)"""
+    request = LocalRequest('POST', path, dict({'Content-Type': 'application/json'}, **(headers or {})),
+                           json.dumps(body).encode())
+    status, response_headers, content = main(LocalContext(request, log_stream=None))
+    return status, response_headers, json.loads(content) if content else None
+
+def files_payload(pdfs, **options):
+    return dict({'files': [{'content': base64.b64encode(pdf).decode()} for pdf in pdfs]}, **options)
+
+def merged_pdf(response_body):
+    return base64.b64decode(response_body['file']['content'])
+
+LABELS = [make_label_pdf('a'), make_label_pdf('b', pages=2), make_label_pdf('c'), make_label_pdf('a')]
+
+def test_modes_produce_the_same_pdf():
+    """Buffered, stream, workers, pipeline and sharded merges are identical"""
+    expected = merge_pdf_bytes(LABELS, use_cache=False)
+    modes = {
+        'stream': {'stream': True},
+        'workers': {'workers': 2},
+        'pipeline': {'pipeline': True},
+        'sharded': {'sharded': True, 'workers': 2, 'rows': 1, 'cols': 2},
+    }
+    for mode, options in modes.items():
+        layout = {key: options.pop(key) for key in ('rows', 'cols') if key in options}
+        baseline = merge_pdf_bytes(LABELS, use_cache=False, **layout) if layout else expected
+        stats = {}
+        output = merge_pdf_bytes(LABELS, stats=stats, use_cache=False, **layout, **options)
+        assert output == baseline, f'{mode} output differs from the buffered merge'
+        assert stats['processed'] == 5, mode
+
+def test_result_cache_hit_and_not_modified():
+    body = files_payload(LABELS[:2], profile='gray', cache=False)
+    status, headers, first = call(body)
+    assert status == 200
+    assert headers['X-Result-Cache'] == 'miss'
+    etag = headers['ETag']
+
+    status, headers, second = call(body)
+    assert status == 200
+    assert headers['X-Result-Cache'] == 'hit'
+    assert second['file']['content'] == first['file']['content']
+
+    status, headers, content = call(body, headers={'If-None-Match': etag})
+    assert status == 304
+    assert headers['ETag'] == etag
+    assert content is None
+
+def test_idempotency_key_reused_for_another_body():
+    headers = {'Idempotency-Key': 'test-merge-key'}
+    status, _, _ = call(files_payload(LABELS[:1], cache=False), headers=headers)
+    assert status == 200
+    status, response_headers, _ = call(files_payload(LABELS[:1], cache=False), headers=headers)
+    assert status == 200
+    assert response_headers['X-Result-Cache'] == 'hit'
+    status, _, error = call(files_payload(LABELS[2:3], cache=False), headers=headers)
+    assert status == 422
+    assert 'Idempotency-Key' in error['error']
+
+def test_render_timeout_skips_the_receipt():
+    stats = {}
+    started = time.perf_counter()
+    output = merge_pdf_bytes([LABELS[0], make_label_pdf('late', slow=True), LABELS[2]], stats=stats,
+                             use_cache=False, render_timeout=1)
+    assert time.perf_counter() - started < 30
+    assert output.startswith(b'%PDF')
+    assert stats['processed'] == 2
+    assert stats['timeouts'] == 1
+    assert [(entry['input'], entry['reason']) for entry in stats['skipped']] == [(1, 'render_timeout')]
+
+def test_prepare_then_compose_matches_a_merge():
+    tokens = []
+    for pdf in LABELS[:3]:
+        status, _, prepared = call(files_payload([pdf], profile='gray', cache=False), path='/prepare')
+        assert status == 200
+        tokens.append(prepared['token'])
+
+    status, _, composed = call({'tokens': tokens}, path='/compose')
+    assert status == 200
+    status, _, merged = call(files_payload(LABELS[:3], profile='gray', cache=False, result_cache=False))
+    assert status == 200
+    assert merged_pdf(composed) == merged_pdf(merged)
+
+def test_compose_unknown_token():
+    unknown = '0' * 32
+    status, _, error = call({'tokens': [unknown]}, path='/compose')
+    assert status == 404
+    assert error['tokens'] == [unknown]
+
+if __name__ == '__main__':
+    tests = [value for name, value in sorted(globals().items()) if name.startswith('test_') and callable(value)]
+    failed = 0
+    for test in tests:
+        try:
+            test()
+            print(f'✅ {test.__name__}')
+        except Exception as e:
+            failed += 1
+            print(f'❌ {test.__name__}: {e!r}')
+    sys.exit(1 if failed else 0)